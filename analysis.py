@@ -0,0 +1,261 @@
+"""
+Image analysis core: provider calls (OpenAI vision, Google Vision, local CLIP) behind the result cache.
+The Google Vision and CLIP specifics live in google_vision.py and clip_engine.py.
+
+Shared by the single-image endpoint, the batch endpoint and background jobs.
+"""
+import json
+import math
+import os
+from typing import Any, Dict, Optional, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+
+from analysis_cache import get_analysis_cache, make_cache_key
+from circuit_breaker import ProviderUnavailableError, get_provider_guard
+from clip_engine import CLIP_MODEL, CLIP_PRETRAINED, clip_backend, clip_options, clip_prompt_version, get_clip_engine, has_clip
+from embedding_store import record_image
+from http_client import OPENAI_API_BASE, get_http_client
+from google_vision import get_google_batcher, has_google_vision
+from perceptual_hash import PHASH_MAX_DISTANCE, get_near_duplicate_index
+from preprocess_pool import get_image_details, get_preprocess_pool
+from rate_limit import PRIORITY_IMAGE, estimate_tokens, get_rate_limiter
+from tag_index import get_tag_index
+from taxonomy import with_taxonomy
+from utils import ImageSource, read_source
+
+# --- Vision model / prompt identifiers ---
+# These are part of the analysis cache key: bump the prompt version whenever the prompt or
+# the result shape changes so stale cached analyses are not served.
+OPENAI_VISION_MODEL = os.getenv("OPENAI_VISION_MODEL", "gpt-4o")
+OPENAI_VISION_PROMPT = "Analyze this image and provide: 1) A short caption, 2) Five specific tags that categorize what's in the image, 3) A brief explanation about the image content and context. Format your response as JSON with keys: caption, tags, explanation."
+OPENAI_VISION_PROMPT_VERSION = "v1"
+GOOGLE_VISION_MODEL = "google-vision"
+GOOGLE_VISION_PROMPT_VERSION = "v1"
+# INT8 ONNX and fp32 torch tags differ slightly, so the backend is part of the cache key
+CLIP_CACHE_MODEL = f"clip-{CLIP_MODEL}-{CLIP_PRETRAINED}-{clip_backend}"
+# Expected completion size, reserved against the tokens-per-minute budget before the call
+OPENAI_VISION_OUTPUT_TOKENS = 300
+
+# --- Helper functions (copied and adapted from app.py) ---
+def get_api_key(service_name: str) -> Optional[str]:
+    """Get API key from environment variables or return None"""
+    if service_name == "OpenAI":
+        api_key = os.environ.get("OPENAI_API_KEY")
+        if api_key:
+            print(f"Found {service_name} API key in environment variables (length: {len(api_key)})")
+        else:
+            print(f"No {service_name} API key found in environment variables")
+        return api_key
+    return None
+
+def get_google_credentials_path() -> Optional[str]:
+    """Get Google credentials path from environment variables or return None"""
+    cred_path = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS")
+    if cred_path:
+        print(f"Found Google credentials path: {cred_path}")
+        if os.path.exists(cred_path):
+            print(f"Google credentials file exists.")
+        else:
+            print(f"Warning: Google credentials file not found at {cred_path}")
+    else:
+        print("No Google credentials path found in environment variables")
+    return cred_path
+
+class AnalysisRequestError(ValueError):
+    """Raised for an unsupported provider or missing credentials (maps to HTTP 400)"""
+
+# --- Analysis Functions (copied and adapted from app.py) ---
+
+async def run_cached_analysis(
+    image: ImageSource,
+    image_digest: str,
+    model: str,
+    prompt_version: str,
+    analyze,
+    reuse_similar: bool = True,
+    encode: bool = False,
+) -> Tuple[Dict[str, Any], str]:
+    """Serve an analysis from the result cache, or run `analyze(prepared)` and store a successful result.
+    On a miss the image is preprocessed once in the process pool (preprocess_pool.py): its perceptual
+    hash finds near-duplicates whose analysis can be reused, its thumbnail and EXIF details are stored,
+    and with `encode` the provider-ready bytes are passed to analyze() as `prepared` (None otherwise,
+    or when preprocessing failed). Returns the result and an RFC 9211 Cache-Status value."""
+    cache = get_analysis_cache()
+    cache_key = make_cache_key(image_digest, model, prompt_version)
+    # SQLite reads and commits of the disk tier stay off the event loop
+    cached, tier = await run_in_threadpool(cache.get, cache_key)
+    if cached is not None:
+        return cached, f"skypad-analysis; hit; detail={tier}"
+
+    namespace = f"{model}:{prompt_version}"
+    image_hash, prepared = None, None
+    try:
+        details = await get_preprocess_pool().run(image, encode=encode)
+        image_hash = details["dhash"] if PHASH_MAX_DISTANCE >= 0 else None
+        prepared = details.get("prepared")
+        await run_in_threadpool(get_image_details().add, image_digest, details)
+    except Exception as e:
+        print(f"Image preprocessing failed, skipping near-duplicate lookup: {e}")
+    if reuse_similar and image_hash is not None:
+        match = get_near_duplicate_index().find(namespace, image_hash)
+        if match is not None:
+            distance, similar_key = match
+            cached, _ = await run_in_threadpool(cache.get, similar_key)
+            if cached is not None:
+                return cached, f"skypad-analysis; hit; detail=near-duplicate-{distance}"
+
+    result = await analyze(prepared)
+    if not result.get("success"):
+        return result, "skypad-analysis; fwd=uri-miss"
+    await run_in_threadpool(cache.put, cache_key, result)
+    if image_hash is not None:
+        await run_in_threadpool(get_near_duplicate_index().add, namespace, image_hash, cache_key)
+    return result, "skypad-analysis; fwd=uri-miss; stored"
+
+def resolve_provider(model_name: str, openai_api_key: Optional[str] = None, google_credentials_path: Optional[str] = None) -> Tuple[str, str]:
+    """Validate the requested provider and return (provider, credential), falling back to the environment"""
+    provider = model_name.lower()
+    if provider == "openai":
+        api_key_to_use = openai_api_key or get_api_key("OpenAI")
+        if not api_key_to_use:
+            raise AnalysisRequestError("OpenAI API key not provided or found in environment.")
+        return provider, api_key_to_use
+    elif provider == "google":
+        creds_path_to_use = google_credentials_path or get_google_credentials_path()
+        if not creds_path_to_use:
+            raise AnalysisRequestError("Google credentials path not provided or found in environment.")
+        if not os.path.isfile(creds_path_to_use):
+            raise AnalysisRequestError(f"Google credentials file not found: {creds_path_to_use}")
+        return provider, creds_path_to_use
+    elif provider == "clip":
+        # Runs locally: no credential needed
+        return provider, ""
+    raise AnalysisRequestError(f"Unsupported model: {model_name}. Choose 'openai', 'google' or 'clip'.")
+
+async def analyze_image(
+    image: ImageSource,
+    image_digest: str,
+    provider: str,
+    credential: str,
+    reuse_similar: bool = True,
+    priority: int = PRIORITY_IMAGE,
+    clip_settings: Optional[Dict[str, Any]] = None,
+) -> Tuple[Dict[str, Any], Optional[str]]:
+    """Analyze one image with a resolved provider, going through the result cache, normalize its tags
+    to the Skypad taxonomy, and index it for /images/similar and /images/search.
+    `priority` orders the provider call within its rate-limit quota (see rate_limit.py);
+    `clip_settings` are the clip_options() for model_name=clip (defaults if omitted)."""
+    if provider == "openai":
+        model, prompt_version = OPENAI_VISION_MODEL, OPENAI_VISION_PROMPT_VERSION
+        analyze = lambda prepared: analyze_image_with_openai(image, credential, priority, prepared)
+    elif provider == "google":
+        if not has_google_vision:
+            return {"success": False, "error": "Google Cloud Vision API is not installed on the server."}, None
+        model, prompt_version = GOOGLE_VISION_MODEL, GOOGLE_VISION_PROMPT_VERSION
+        analyze = lambda prepared: get_google_batcher().analyze(image, credential, priority)
+    elif provider == "clip":
+        if not has_clip:
+            return {"success": False, "error": "CLIP is not available on the server (needs the exported ONNX model and onnxruntime, or torch and open_clip)."}, None
+        settings = clip_settings or clip_options()
+        model, prompt_version = CLIP_CACHE_MODEL, clip_prompt_version(settings)
+        analyze = lambda prepared: get_clip_engine().analyze(image, settings)
+    else:
+        raise AnalysisRequestError(f"Unsupported provider: {provider}")
+    result, cache_status = await run_cached_analysis(image, image_digest, model, prompt_version, analyze, reuse_similar,
+                                                     encode=provider == "openai")
+    # Canonical taxonomy ids are attached outside the cache, so a taxonomy update needs no re-analysis
+    result = with_taxonomy(result)
+    if result.get("success"):
+        await record_image(image, image_digest, result)
+        await run_in_threadpool(get_tag_index().add, image_digest, result)
+        result = {**result, "image_id": image_digest}
+    return result, cache_status
+
+def vision_image_tokens(width: Optional[int], height: Optional[int], detail: str) -> int:
+    """Input tokens OpenAI bills for an image: 85 at low detail, plus 170 per 512px tile otherwise"""
+    if detail == "low":
+        return 85
+    if not width or not height:
+        return 765
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    return 85 + 170 * math.ceil(width * scale / 512) * math.ceil(height * scale / 512)
+
+async def analyze_image_with_openai(image: ImageSource, api_key: str, priority: int = PRIORITY_IMAGE,
+                                    prepared: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """`prepared`: the image already oriented, downscaled and re-encoded (see run_cached_analysis)"""
+    try:
+        import base64
+        try:
+            if prepared is None:
+                # Orient, downscale and re-encode in the preprocessing pool before base64-encoding
+                prepared = (await get_preprocess_pool().run(image, encode=True))["prepared"]
+        except Exception as e:
+            print(f"Image preprocessing failed, sending original bytes: {e}")
+            prepared = {"bytes": read_source(image), "mime_type": "image/jpeg", "detail": "auto"}
+        base64_image = base64.b64encode(prepared["bytes"]).decode('utf-8')
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {api_key}"
+        }
+        payload = {
+            "model": OPENAI_VISION_MODEL,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": OPENAI_VISION_PROMPT
+                        },
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": f"data:{prepared['mime_type']};base64,{base64_image}",
+                                "detail": prepared["detail"]
+                            }
+                        }
+                    ]
+                }
+            ],
+            "response_format": {"type": "json_object"}
+        }
+        # Shared pooled client - the await frees the event loop while GPT-4o works on the image.
+        # The rate limiter queues the call within the key's RPM/TPM budget and retries 429s;
+        # the provider guard fails fast while OpenAI vision is unhealthy.
+        client = get_http_client()
+        tokens = (estimate_tokens(OPENAI_VISION_PROMPT) + OPENAI_VISION_OUTPUT_TOKENS
+                  + vision_image_tokens(prepared.get("width"), prepared.get("height"), prepared["detail"]))
+        response = await get_rate_limiter("openai", api_key).run(
+            lambda: get_provider_guard("openai_vision").call(lambda: client.post(
+                f"{OPENAI_API_BASE}/chat/completions",
+                headers=headers,
+                json=payload
+            )),
+            tokens=tokens,
+            priority=priority,
+        )
+        if response.status_code == 200:
+            result = response.json()
+            content = json.loads(result["choices"][0]["message"]["content"])
+            return {
+                "success": True,
+                "tags": content.get("tags", []),
+                "caption": content.get("caption", ""),
+                "explanation": content.get("explanation", ""),
+                "raw_response": content
+            }
+        else:
+            return {
+                "success": False,
+                "error": f"Error: {response.status_code} - {response.text}"
+            }
+    except ProviderUnavailableError as e:
+        return {"success": False, "error": str(e), "retry_after": e.retry_after}
+    except Exception as e:
+        return {
+            "success": False,
+            "error": f"Exception: {str(e)}"
+        }
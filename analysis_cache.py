@@ -0,0 +1,114 @@
+"""
+Content-addressed cache for image analysis results.
+
+Keys are SHA-256(image bytes) + model name + prompt version, so the same image re-uploaded by
+another team is answered without a new GPT-4o / Google Vision call. Two tiers:
+  - memory: LRU bounded by the total size of the serialized results
+  - disk:   SQLite table that survives restarts
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from utils import data_path, ensure_parent_dir
+
+ANALYSIS_CACHE_MEMORY_MB = float(os.getenv("ANALYSIS_CACHE_MEMORY_MB", "64"))
+ANALYSIS_CACHE_DB = os.getenv("ANALYSIS_CACHE_DB") or data_path("analysis_cache.sqlite3")
+
+
+def make_cache_key(image_digest: str, model_name: str, prompt_version: str) -> str:
+    """Build the cache key from the image content hash, model and prompt version"""
+    return f"{image_digest}:{model_name}:{prompt_version}"
+
+
+class AnalysisCache:
+    """Two-tier (memory LRU + SQLite) store of successful analysis results"""
+
+    def __init__(self, db_path: str = ANALYSIS_CACHE_DB, max_memory_bytes: int = int(ANALYSIS_CACHE_MEMORY_MB * 1024 * 1024)):
+        self.max_memory_bytes = max_memory_bytes
+        self._memory: "OrderedDict[str, str]" = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+        self._db = sqlite3.connect(ensure_parent_dir(db_path), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS analysis_cache ("
+            " key TEXT PRIMARY KEY, result TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._db.commit()
+
+    def get(self, key: str) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+        """Return (result, tier) where tier is 'memory', 'disk' or None on a miss"""
+        with self._lock:
+            payload = self._memory.get(key)
+            if payload is not None:
+                self._memory.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return json.loads(payload), "memory"
+
+            row = self._db.execute("SELECT result FROM analysis_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.counters["misses"] += 1
+                return None, None
+            self.counters["disk_hits"] += 1
+            self._remember(key, row[0])
+            return json.loads(row[0]), "disk"
+
+    def put(self, key: str, result: Dict[str, Any]) -> None:
+        """Store a successful analysis in both tiers"""
+        payload = json.dumps(result)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO analysis_cache (key, result, created_at) VALUES (?, ?, ?)",
+                (key, payload, time.time()),
+            )
+            self._db.commit()
+            self._remember(key, payload)
+            self.counters["stores"] += 1
+
+    def _remember(self, key: str, payload: str) -> None:
+        """Insert into the memory tier and evict least-recently-used entries over the size budget"""
+        size = len(payload)
+        if size > self.max_memory_bytes:
+            return
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_bytes -= len(previous)
+        self._memory[key] = payload
+        self._memory_bytes += size
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+            self.counters["evictions"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            disk_entries = self._db.execute("SELECT COUNT(*) FROM analysis_cache").fetchone()[0]
+            return {
+                **self.counters,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "memory_limit_bytes": self.max_memory_bytes,
+                "disk_entries": disk_entries,
+            }
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+_cache: Optional[AnalysisCache] = None
+
+
+def get_analysis_cache() -> AnalysisCache:
+    """Return the process-wide cache, opening the SQLite tier on first use"""
+    global _cache
+    if _cache is None:
+        _cache = AnalysisCache()
+    return _cache
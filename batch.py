@@ -0,0 +1,165 @@
+"""
+Batch image analysis with bounded per-provider concurrency.
+
+Uploaded files (and images inside uploaded zip archives) are analysed through the same cached
+provider path as /analyze-image/, with at most PROVIDER_CONCURRENCY[provider] images in flight per
+provider across all batches in the worker. Results are yielded in completion order, so the caller can
+stream each one back (NDJSON) as soon as it finishes.
+"""
+import asyncio
+import json
+import os
+import posixpath
+import time
+import zipfile
+from typing import Any, AsyncIterator, BinaryIO, Dict, Iterator, List
+
+from fastapi import UploadFile
+from fastapi.concurrency import run_in_threadpool
+
+from analysis import analyze_image
+from rate_limit import PRIORITY_BATCH
+from uploads import MAX_UPLOAD_BYTES, hash_file, spool_stream
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".gif", ".bmp", ".tif", ".tiff")
+# Largest accepted request body for a batch upload (many files or a zip)
+MAX_BATCH_UPLOAD_BYTES = int(os.getenv("MAX_BATCH_UPLOAD_BYTES", str(512 * 1024 * 1024)))
+PROVIDER_CONCURRENCY = {
+    "openai": int(os.getenv("OPENAI_BATCH_CONCURRENCY", "8")),
+    "google": int(os.getenv("GOOGLE_BATCH_CONCURRENCY", "8")),
+}
+
+_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+
+def provider_semaphore(provider: str) -> asyncio.Semaphore:
+    """Process-wide concurrency limit for batch work against one provider"""
+    if provider not in _semaphores:
+        _semaphores[provider] = asyncio.Semaphore(PROVIDER_CONCURRENCY.get(provider, 4))
+    return _semaphores[provider]
+
+
+def is_zip_upload(upload: UploadFile) -> bool:
+    return (upload.filename or "").lower().endswith(".zip") or upload.content_type in ("application/zip", "application/x-zip-compressed")
+
+
+def iter_batch_images(uploads: List[UploadFile]) -> Iterator[Dict[str, Any]]:
+    """Yield one entry per image: {"filename", "file", "digest", "owned"} or {"filename", "error"}.
+
+    Blocking (hashing, zip decompression): advance it from a worker thread. Zip members are
+    spooled one at a time as the consumer asks for them, so memory stays bounded by concurrency.
+    """
+    for upload in uploads:
+        if not is_zip_upload(upload):
+            digest, _ = hash_file(upload.file)
+            yield {"filename": upload.filename, "file": upload.file, "digest": digest, "owned": False}
+            continue
+        yield from iter_zip_images(upload.file, upload.filename)
+
+
+def iter_zip_images(fileobj: BinaryIO, archive_name: str) -> Iterator[Dict[str, Any]]:
+    """The images inside one zip archive, as iter_batch_images entries named <archive>/<member>"""
+    try:
+        archive = zipfile.ZipFile(fileobj)
+    except zipfile.BadZipFile as e:
+        yield {"filename": archive_name, "error": f"Invalid zip archive: {e}"}
+        return
+    with archive:
+        for member in archive.infolist():
+            base_name = posixpath.basename(member.filename)
+            if member.is_dir() or base_name.startswith(".") or member.filename.startswith("__MACOSX/"):
+                continue
+            if not base_name.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            filename = f"{archive_name}/{member.filename}"
+            if member.file_size > MAX_UPLOAD_BYTES:
+                yield {"filename": filename, "error": f"File exceeds the maximum size of {MAX_UPLOAD_BYTES} bytes."}
+                continue
+            try:
+                with archive.open(member) as stream:
+                    spooled, digest = spool_stream(stream)
+            except Exception as e:
+                yield {"filename": filename, "error": f"Could not extract file: {e}"}
+                continue
+            yield {"filename": filename, "file": spooled, "digest": digest, "owned": True}
+
+
+async def analyze_batch(
+    uploads: List[UploadFile],
+    provider: str,
+    credential: str,
+    reuse_similar: bool = True,
+) -> AsyncIterator[Dict[str, Any]]:
+    """Analyse every image in the uploads and yield results as they complete, then a summary"""
+    semaphore = provider_semaphore(provider)
+    results: asyncio.Queue = asyncio.Queue()
+    items = iter_batch_images(uploads)
+    tasks: List[asyncio.Task] = []
+    done = object()
+    started = time.perf_counter()
+
+    async def analyze_one(index: int, item: Dict[str, Any]) -> None:
+        try:
+            result, cache_status = await analyze_image(item["file"], item["digest"], provider, credential, reuse_similar, PRIORITY_BATCH)
+        except Exception as e:
+            result, cache_status = {"success": False, "error": f"Exception: {str(e)}"}, None
+        finally:
+            semaphore.release()
+            if item["owned"]:
+                item["file"].close()
+        await results.put({"index": index, "filename": item["filename"], "cache_status": cache_status, **result})
+
+    async def produce() -> None:
+        index = 0
+        try:
+            while True:
+                # Take a slot before extracting the next image so at most `limit` are spooled at once
+                await semaphore.acquire()
+                try:
+                    item = await run_in_threadpool(next, items, None)
+                except BaseException:
+                    semaphore.release()
+                    raise
+                if item is None:
+                    semaphore.release()
+                    break
+                if "error" in item:
+                    semaphore.release()
+                    await results.put({"index": index, "filename": item["filename"], "success": False, "error": item["error"]})
+                else:
+                    tasks.append(asyncio.create_task(analyze_one(index, item)))
+                index += 1
+            await asyncio.gather(*tasks)
+        except Exception as e:
+            await results.put({"index": index, "filename": None, "success": False, "error": f"Batch aborted: {str(e)}"})
+        finally:
+            await results.put(done)
+
+    producer = asyncio.create_task(produce())
+    total = succeeded = 0
+    try:
+        while True:
+            entry = await results.get()
+            if entry is done:
+                break
+            total += 1
+            succeeded += bool(entry.get("success"))
+            yield entry
+        await producer  # surface unexpected producer errors
+        yield {"summary": {"total": total, "succeeded": succeeded, "failed": total - succeeded,
+                           "elapsed_seconds": round(time.perf_counter() - started, 3)}}
+    finally:
+        # Client went away or the batch finished: stop outstanding work and release spooled files
+        producer.cancel()
+        for task in tasks:
+            task.cancel()
+        try:
+            items.close()
+        except ValueError:
+            pass  # generator is mid-step in a worker thread; it is closed when collected
+
+
+async def ndjson_lines(entries: AsyncIterator[Dict[str, Any]]) -> AsyncIterator[str]:
+    """Encode each entry as one line of newline-delimited JSON"""
+    async for entry in entries:
+        yield json.dumps(entry) + "\n"
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Compare the INT8 ONNX CLIP image encoder with fp32 on a fixed image set.
+
+Each backend runs in its own process (so its memory is measured in isolation) over the same images:
+  - torch-fp32: open_clip/PyTorch (when torch and open_clip are installed),
+  - onnx-fp32:  the unquantized export (`python clip_onnx.py export --keep-fp32`),
+  - onnx-int8:  the quantized export the server uses.
+Reported per backend: model load time, images/sec at the given batch size, peak and current RSS,
+and accuracy drift against the fp32 reference (embedding cosine similarity, top-1 agreement and
+top-5 overlap of the furniture tags).
+
+    python clip_onnx.py export --keep-fp32
+    python benchmarks/bench_clip_onnx.py --images path/to/fixed/images --batch 16
+"""
+import argparse
+import importlib.util
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from clip_engine import CATEGORY_SETS, CLIP_MODEL, CLIP_ONNX_DIR, CLIP_PRETRAINED, CLIP_THREADS, score_embeddings
+from clip_onnx import FP32_FILENAME, INT8_FILENAME, TEXT_FILENAME
+
+
+def fixed_image_set(directory, count: int):
+    """Images from `directory` (sorted), or a deterministic synthetic set of shapes when none is given"""
+    if directory:
+        names = sorted(name for name in os.listdir(directory) if name.lower().endswith((".jpg", ".jpeg", ".png", ".webp")))
+        return [Image.open(os.path.join(directory, name)).convert("RGB") for name in names[:count]]
+    rng = np.random.default_rng(0)
+    images = []
+    for _ in range(count):
+        image = Image.new("RGB", (320, 240), tuple(int(c) for c in rng.integers(0, 255, 3)))
+        draw = ImageDraw.Draw(image)
+        for _ in range(6):
+            x0, y0 = int(rng.integers(0, 260)), int(rng.integers(0, 180))
+            draw.rectangle((x0, y0, x0 + int(rng.integers(20, 60)), y0 + int(rng.integers(20, 60))), fill=tuple(int(c) for c in rng.integers(0, 255, 3)))
+        images.append(image)
+    return images
+
+
+def rss_mb():
+    """(peak, current) resident set size of this process in MB"""
+    values = {}
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith(("VmHWM:", "VmRSS:")):
+                key, value = line.split(":")
+                values[key] = int(value.split()[0]) / 1024
+    return values.get("VmHWM", 0.0), values.get("VmRSS", 0.0)
+
+
+def run_backend(backend: str, onnx_dir: str, directory, count: int, batch: int, threads: int, results):
+    images = fixed_image_set(directory, count)
+    started = time.perf_counter()
+    if backend == "torch-fp32":
+        from clip_engine import load_torch_encoder
+        encode, text_embeddings = load_torch_encoder(CLIP_MODEL, CLIP_PRETRAINED, threads)
+    else:
+        from clip_onnx import load_onnx_encoder
+        filename = FP32_FILENAME if backend == "onnx-fp32" else INT8_FILENAME
+        encode, text_embeddings = load_onnx_encoder(os.path.join(onnx_dir, filename), os.path.join(onnx_dir, TEXT_FILENAME), threads)
+    load_seconds = time.perf_counter() - started
+
+    encode(images[:batch])  # warm up
+    started = time.perf_counter()
+    embeddings = np.concatenate([encode(images[i:i + batch]) for i in range(0, len(images), batch)])
+    elapsed = time.perf_counter() - started
+    peak, current = rss_mb()
+    results[backend] = {
+        "embeddings": embeddings,
+        "text": text_embeddings["furniture"],
+        "load_seconds": load_seconds,
+        "images_per_second": len(images) / elapsed,
+        "peak_rss_mb": peak,
+        "rss_mb": current,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", help="Directory of images to compare on (default: synthetic fixed set)")
+    parser.add_argument("--count", type=int, default=64)
+    parser.add_argument("--batch", type=int, default=16)
+    parser.add_argument("--threads", type=int, default=CLIP_THREADS)
+    parser.add_argument("--onnx-dir", default=CLIP_ONNX_DIR)
+    args = parser.parse_args()
+
+    backends = []
+    if importlib.util.find_spec("torch") and importlib.util.find_spec("open_clip"):
+        backends.append("torch-fp32")
+    if os.path.exists(os.path.join(args.onnx_dir, FP32_FILENAME)):
+        backends.append("onnx-fp32")
+    if os.path.exists(os.path.join(args.onnx_dir, INT8_FILENAME)):
+        backends.append("onnx-int8")
+    if "onnx-int8" not in backends or len(backends) < 2:
+        sys.exit("Need the INT8 export and an fp32 reference: run `python clip_onnx.py export --keep-fp32` first.")
+
+    context = multiprocessing.get_context("spawn")
+    results = context.Manager().dict()
+    for backend in backends:
+        process = context.Process(target=run_backend, args=(backend, args.onnx_dir, args.images, args.count, args.batch, args.threads, results))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            sys.exit(f"{backend} failed (exit code {process.exitcode})")
+
+    reference_name = backends[0]
+    reference = results[reference_name]
+    temperatures = np.full(len(reference["embeddings"]), 1.0, dtype=np.float32)
+    reference_probabilities = score_embeddings(reference["embeddings"], reference["text"], temperatures)
+    reference_top5 = np.argsort(reference_probabilities, axis=1)[:, ::-1][:, :5]
+
+    print(f"{len(reference['embeddings'])} images, batch {args.batch}, {args.threads} threads, reference: {reference_name}")
+    print(f"{'backend':<12} {'load s':>7} {'img/s':>8} {'peak RSS MB':>12} {'RSS MB':>8} {'cos mean':>9} {'cos min':>8} {'top1 agree':>11} {'top5 overlap':>13}")
+    for backend in backends:
+        result = results[backend]
+        cosine = np.sum(result["embeddings"] * reference["embeddings"], axis=1)
+        probabilities = score_embeddings(result["embeddings"], reference["text"], temperatures)
+        top5 = np.argsort(probabilities, axis=1)[:, ::-1][:, :5]
+        top1_agreement = np.mean(top5[:, 0] == reference_top5[:, 0])
+        top5_overlap = np.mean([len(set(a) & set(b)) / 5 for a, b in zip(top5, reference_top5)])
+        print(f"{backend:<12} {result['load_seconds']:>7.2f} {result['images_per_second']:>8.1f} {result['peak_rss_mb']:>12.0f} "
+              f"{result['rss_mb']:>8.0f} {cosine.mean():>9.4f} {cosine.min():>8.4f} {top1_agreement:>11.1%} {top5_overlap:>13.1%}")
+    print(f"Categories scored: {len(CATEGORY_SETS['furniture'])} furniture prompts")
+
+
+if __name__ == "__main__":
+    main()
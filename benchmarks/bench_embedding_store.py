@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Open time and memory of the memory-mapped embedding store at 100k and 1M images.
+
+Builds a store directory per size (one merged base segment of random unit vectors with ids, tags
+and captions, the layout EmbeddingStore writes), then opens it in a fresh process and reports:
+  - open:   mapping the segments and reading the headers (what each server worker does at startup),
+  - lookup: one id -> vector lookup through the sorted id column,
+  - search: the first and a warm exact search (the first one faults the vector pages in),
+  - memory: resident and private memory of the process after opening and after searching; the
+            vector pages a search touches are page cache shared with every other worker, not copies,
+  - load:   for comparison, reading the whole vector column into process memory, which is the
+            least a deserializing store has to do.
+
+    python benchmarks/bench_embedding_store.py --sizes 100000 1000000 --dir /tmp/skypad-bench
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from segment_store import Segment, pack_tags, write_segment
+
+BUILD_CHUNK_ROWS = 65536
+
+
+def memory_mb():
+    """(resident, private) memory of this process: mapped file pages count as resident but are shared"""
+    with open("/proc/self/statm") as f:
+        _, resident, shared = (int(value) * os.sysconf("SC_PAGE_SIZE") / 1e6 for value in f.read().split()[:3])
+    return resident, resident - shared
+
+
+def build(directory: str, size: int, dim: int) -> None:
+    """Write a store of `size` rows: fill an append segment of that capacity, then merge it into the base"""
+    os.makedirs(directory, exist_ok=True)
+    staging = os.path.join(directory, "staging.seg")
+    write_segment(staging, dim, np.dtype("<f4"), [], capacity=size, generation=1)
+    segment = Segment(staging, writable=True)
+    rng = np.random.default_rng(0)
+    tags = pack_tags(["lounge chair", "velvet", "mid-century modern"])
+    for start in range(0, size, BUILD_CHUNK_ROWS):
+        stop = min(start + BUILD_CHUNK_ROWS, size)
+        block = rng.normal(size=(stop - start, dim)).astype(np.float32)
+        segment.columns["vectors"][start:stop] = block / np.linalg.norm(block, axis=1, keepdims=True)
+        segment.columns["ids"][start:stop] = [f"{row:064x}".encode() for row in range(start, stop)]
+        segment.columns["tags"][start:stop] = tags
+        segment.columns["caption"][start:stop] = b"A velvet lounge chair"
+        segment.columns["created_at"][start:stop] = time.time()
+    segment.header["count"][0] = size
+    write_segment(os.path.join(directory, "base.seg"), dim, np.dtype("<f4"), [segment], merged_generation=1)
+    write_segment(os.path.join(directory, "append.seg"), dim, np.dtype("<f4"), [], capacity=BUILD_CHUNK_ROWS, generation=2)
+    del segment
+    os.remove(staging)
+
+
+def measure(directory: str) -> None:
+    """Runs in a fresh process: prints one JSON line of measurements"""
+    from embedding_store import EmbeddingStore, scan, top_k
+
+    before = memory_mb()
+    started = time.perf_counter()
+    store = EmbeddingStore("bench", directory=directory)
+    open_ms = (time.perf_counter() - started) * 1000
+    after_open = memory_mb()
+
+    image_id = f"{store.count // 2:064x}"
+    started = time.perf_counter()
+    vector = store.vector(image_id)
+    lookup_ms = (time.perf_counter() - started) * 1000
+
+    timings = []
+    for _ in range(2):
+        started = time.perf_counter()
+        store.search(vector, 10, exact=True)
+        timings.append((time.perf_counter() - started) * 1000)
+    after_search = memory_mb()
+
+    started = time.perf_counter()
+    loaded = np.array(store._rows()[1][0:store.count])
+    load_ms = (time.perf_counter() - started) * 1000
+    top_k(scan(loaded, vector), 10)
+    print(json.dumps({
+        "open_ms": open_ms, "lookup_ms": lookup_ms, "first_search_ms": timings[0], "search_ms": timings[1],
+        "rss_open_mb": after_open[0] - before[0], "rss_search_mb": after_search[0] - before[0],
+        "private_search_mb": after_search[1] - before[1], "load_ms": load_ms,
+        "load_mb": loaded.nbytes / 1e6,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100000, 1000000])
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--dir", default="/tmp/skypad-bench", help="Where the store directories are built (reused across runs)")
+    parser.add_argument("--measure", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.measure:
+        measure(args.measure)
+        return
+
+    print(f"dim {args.dim}, float32 vectors")
+    print(f"{'images':>9} {'open ms':>8} {'lookup ms':>10} {'1st search':>11} {'search ms':>10} {'rss open':>9} {'rss search':>11} {'private':>9} {'load ms':>8}")
+    for size in args.sizes:
+        directory = os.path.join(args.dir, f"store-{size}-{args.dim}")
+        if not os.path.exists(os.path.join(directory, "base.seg")):
+            started = time.perf_counter()
+            build(directory, size, args.dim)
+            print(f"{'':>9} (built {size} rows in {time.perf_counter() - started:.1f}s)")
+        # No background IVF build while measuring
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "--measure", directory], capture_output=True,
+                                text=True, check=True, env={**os.environ, "EMBEDDING_ANN_THRESHOLD": str(2 * size)}).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f"{size:>9} {result['open_ms']:>8.2f} {result['lookup_ms']:>10.3f} {result['first_search_ms']:>11.1f} "
+              f"{result['search_ms']:>10.1f} {result['rss_open_mb']:>7.1f}MB {result['rss_search_mb']:>9.1f}MB {result['private_search_mb']:>7.1f}MB {result['load_ms']:>8.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Concurrent throughput benchmark for the OpenAI vision path.
+
+Starts a local fake chat-completions endpoint that sleeps for --latency seconds per call
+(standing in for GPT-4o vision), then fires --requests analyses at it, either one at a time
+or all in flight on the shared pooled client. The fake reports an ample quota in its
+x-ratelimit-* headers, and each phase starts with fresh rate limiters, so the numbers measure
+the client and not the rate-limit scheduler.
+
+    python benchmarks/bench_openai_vision.py --requests 50 --latency 0.5
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_fake_openai(port: int, latency: float):
+    """Run a fake /v1/chat/completions server in a background thread"""
+    import uvicorn
+    from fastapi import FastAPI
+    from fastapi.responses import JSONResponse
+
+    fake = FastAPI()
+    quota = {
+        "x-ratelimit-limit-requests": "100000", "x-ratelimit-remaining-requests": "99999",
+        "x-ratelimit-limit-tokens": "100000000", "x-ratelimit-remaining-tokens": "99999999",
+    }
+
+    @fake.post("/v1/chat/completions")
+    async def completions(payload: dict):
+        await asyncio.sleep(latency)
+        content = {"caption": "A lounge chair", "tags": ["chair", "lounge", "hotel", "fabric", "oak"], "explanation": "Fake"}
+        body = {"choices": [{"message": {"content": json.dumps(content)}}], "usage": {"prompt_tokens": 1, "completion_tokens": 1}}
+        return JSONResponse(body, headers=quota)
+
+    server = uvicorn.Server(uvicorn.Config(fake, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+async def run(n: int, concurrent: bool) -> float:
+    import rate_limit
+    from analysis import analyze_image_with_openai
+    from http_client import close_http_client
+    from PIL import Image
+
+    # The budget the previous phase used up must not slow this one down
+    rate_limit._limiters.clear()
+    buffer = BytesIO()
+    Image.effect_noise((1600, 1200), 40).convert("RGB").save(buffer, format="JPEG", quality=95)
+    image_bytes = buffer.getvalue()
+    start = time.perf_counter()
+    if concurrent:
+        results = await asyncio.gather(*(analyze_image_with_openai(image_bytes, "sk-fake") for _ in range(n)))
+    else:
+        results = [await analyze_image_with_openai(image_bytes, "sk-fake") for _ in range(n)]
+    elapsed = time.perf_counter() - start
+    await close_http_client()
+    failures = [r for r in results if not r.get("success")]
+    if failures:
+        print(f"  {len(failures)} failures, first: {failures[0].get('error')}")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.5, help="Simulated provider latency in seconds")
+    args = parser.parse_args()
+
+    port = _free_port()
+    os.environ["OPENAI_API_BASE"] = f"http://127.0.0.1:{port}/v1"
+    server = start_fake_openai(port, args.latency)
+
+    for label, concurrent in (("sequential", False), ("concurrent", True)):
+        elapsed = asyncio.run(run(args.requests, concurrent))
+        print(f"{label:>10}: {args.requests} analyses in {elapsed:.2f}s -> {args.requests / elapsed:.1f} images/s")
+
+    server.should_exit = True
+
+
+if __name__ == "__main__":
+    main()
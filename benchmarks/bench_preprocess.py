@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Throughput of image preprocessing (decode, EXIF, hashes, thumbnail, provider re-encode) by number of
+worker processes.
+
+Runs PreprocessPool.run(image, encode=True) - what an OpenAI analysis does on a cache miss - for a
+set of synthetic camera-sized JPEGs with `--concurrency` requests in flight, once in the server's
+thread pool (--workers 0, the GIL-bound baseline) and once per process pool size. Images go to the
+workers through shared memory. Throughput should scale with the pool size up to the number of cores.
+
+    python benchmarks/bench_preprocess.py --workers 0 1 2 4 8 --images 64
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from PIL import Image
+
+from preprocess_pool import PreprocessPool
+
+
+def camera_jpeg(width: int, height: int, seed: int) -> bytes:
+    """Photo-like JPEG: smooth gradients plus sensor-like noise, with a little EXIF"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    channels = [128 + 100 * np.sin(x / rng.uniform(50, 400) + y / rng.uniform(50, 400) + phase) for phase in rng.uniform(0, 6, 3)]
+    pixels = np.stack(channels, axis=-1) + rng.normal(0, 6, (height, width, 3))
+    exif = Image.Exif()
+    exif[0x010F], exif[0x0110] = "Canon", "EOS R5"
+    buffer = BytesIO()
+    Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(buffer, "JPEG", quality=92, exif=exif)
+    return buffer.getvalue()
+
+
+async def run(pool: PreprocessPool, images, concurrency: int) -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(image: bytes) -> None:
+        async with semaphore:
+            await pool.run(image, encode=True)
+
+    await pool.warm()
+    await one(images[0])
+    started = time.perf_counter()
+    await asyncio.gather(*(one(image) for image in images))
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 1, 2, 4, 8], help="Pool sizes; 0 = server thread pool")
+    parser.add_argument("--images", type=int, default=32)
+    parser.add_argument("--size", type=int, nargs=2, default=[4000, 3000], metavar=("WIDTH", "HEIGHT"))
+    parser.add_argument("--concurrency", type=int, default=16, help="Requests in flight")
+    args = parser.parse_args()
+
+    distinct = [camera_jpeg(*args.size, seed) for seed in range(4)]
+    images = [distinct[i % len(distinct)] for i in range(args.images)]
+    print(f"{args.images} JPEGs of {args.size[0]}x{args.size[1]} (~{np.mean([len(image) for image in distinct]) / 1e6:.1f} MB), "
+          f"{args.concurrency} in flight, {os.cpu_count()} cores")
+    print(f"{'workers':>8} {'seconds':>8} {'images/s':>9} {'speedup':>8}")
+    baseline = None
+    for workers in args.workers:
+        pool = PreprocessPool(workers=workers)
+        try:
+            seconds = asyncio.run(run(pool, images, args.concurrency))
+        finally:
+            pool.close()
+        rate = args.images / seconds
+        baseline = baseline or rate
+        label = "threads" if workers == 0 else str(workers)
+        print(f"{label:>8} {seconds:>8.2f} {rate:>9.1f} {rate / baseline:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
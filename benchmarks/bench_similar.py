@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Recall and latency of /images/similar search at 10k, 100k and 1M vectors.
+
+Uses the same code paths as EmbeddingStore.search on a synthetic clustered collection (unit
+vectors around random centers, which is how image embeddings of a catalogue behave):
+  - exact: chunked float32 scan of the EMBEDDING_DTYPE matrix + argpartition top-k,
+  - ivf:   the IVF index built above EMBEDDING_ANN_THRESHOLD, at several nprobe values.
+Queries are perturbed copies of stored vectors; recall@k is measured against the exact top-k.
+
+    python benchmarks/bench_similar.py --sizes 10000 100000 1000000 --queries 200
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from embedding_store import EMBEDDING_ANN_THRESHOLD, EMBEDDING_DTYPE, IVFIndex, scan, top_k
+
+
+def clustered_vectors(count: int, dim: int, clusters: int, spread: float, seed: int = 0) -> np.ndarray:
+    """Normalized vectors scattered around `clusters` random centers, generated in chunks"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim)).astype(np.float32)
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+    matrix = np.empty((count, dim), dtype=EMBEDDING_DTYPE)
+    for start in range(0, count, 65536):
+        size = min(65536, count - start)
+        block = centers[rng.integers(0, clusters, size)] + spread * rng.normal(size=(size, dim)).astype(np.float32) / np.sqrt(dim)
+        matrix[start:start + size] = block / np.linalg.norm(block, axis=1, keepdims=True)
+    return matrix
+
+
+def percentiles(seconds):
+    return np.percentile(np.array(seconds) * 1000, 50), np.percentile(np.array(seconds) * 1000, 95)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--spread", type=float, default=2.0, help="Noise around the cluster centers (higher = harder)")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[8, 16, 32, 64])
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(1)
+    print(f"dim {args.dim}, {EMBEDDING_DTYPE}, {args.queries} queries, k={args.k} (server switches to IVF above {EMBEDDING_ANN_THRESHOLD} vectors)")
+    print(f"{'vectors':>9} {'method':<10} {'build s':>8} {'p50 ms':>8} {'p95 ms':>8} {'recall@k':>9}")
+    for size in args.sizes:
+        matrix = clustered_vectors(size, args.dim, clusters=max(10, size // 500), spread=args.spread)
+        queries = matrix[rng.integers(0, size, args.queries)].astype(np.float32)
+        queries += 0.3 * rng.normal(size=queries.shape).astype(np.float32) / np.sqrt(args.dim)
+        queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+        truth, timings = [], []
+        for query in queries:
+            started = time.perf_counter()
+            truth.append(set(top_k(scan(matrix, query), args.k).tolist()))
+            timings.append(time.perf_counter() - started)
+        p50, p95 = percentiles(timings)
+        print(f"{size:>9} {'exact':<10} {0.0:>8.2f} {p50:>8.2f} {p95:>8.2f} {1.0:>9.3f}")
+
+        started = time.perf_counter()
+        index = IVFIndex(matrix)
+        build_seconds = time.perf_counter() - started
+        for nprobe in args.nprobe:
+            hits, timings = 0, []
+            for query, expected in zip(queries, truth):
+                started = time.perf_counter()
+                rows = index.candidates(query, nprobe)
+                found = rows[top_k(scan(matrix, query, rows), args.k)]
+                timings.append(time.perf_counter() - started)
+                hits += len(expected & set(found.tolist()))
+            p50, p95 = percentiles(timings)
+            label = f"ivf/{nprobe}"
+            print(f"{size:>9} {label:<10} {build_seconds:>8.2f} {p50:>8.2f} {p95:>8.2f} {hits / (len(queries) * args.k):>9.3f}")
+        print(f"{'':>9} ({index.lists} lists, {matrix.nbytes / 1e6:.0f} MB matrix)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""
+Bella chat completions, streamed to the browser as Server-Sent Events.
+
+POST /api/chat/stream opens a streaming chat completion (stream=True) on the API key's shared
+AsyncOpenAI client (openai_clients.py) and forwards every content delta as soon as it arrives, so
+the time to the first token - not the whole generation - is what the user waits for:
+
+    event: token
+    data: {"text": "Hel"}
+
+    event: done
+    data: {"model": "...", "finish_reason": "stop", "usage": {...}, "ttft_ms": 412.3, "total_ms": 2210.5}
+
+An upstream failure after the stream has started is sent as an `error` event. Opening the stream goes
+through the rate limiter and the openai_chat circuit breaker like every other chat call, so throttling
+and outages surface as HTTP errors before the first byte is sent.
+
+Both chat endpoints send the conversation so far (chat_sessions.py), trimmed to its token budget,
+and record the user's message and Bella's reply once the reply is complete; older turns are folded
+into a running summary in the background (chat_summary.py).
+
+Prompts are laid out for the provider's automatic prompt caching, which reuses the work for the
+longest prefix a recent request shared: first the static prefix (the system prompt, then the stable
+knowledge in CHAT_KNOWLEDGE_FILE), built once at startup and byte-identical across requests, then
+the per-session summary and history, then the new turn. Cached prompt tokens reported in each
+response's usage are counted in /metrics.
+"""
+import json
+import os
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from openai import AsyncStream
+
+from bella_prompt import BELLA_SYSTEM_PROMPT
+from chat_sessions import CHAT_HISTORY_TOKEN_BUDGET, ChatSession, chat_turn, prompt_message
+from circuit_breaker import get_provider_guard
+from openai_clients import get_openai_client
+from rate_limit import PRIORITY_CHAT, get_rate_limiter
+from utils import sha256_hex
+
+CHAT_MODEL = os.getenv("CHAT_MODEL", "gpt-3.5-turbo")
+CHAT_MAX_TOKENS = 800
+
+CHAT_KNOWLEDGE_FILE = os.getenv("CHAT_KNOWLEDGE_FILE", "")  # optional reference text sent after the system prompt
+
+CHAT_STATS = {
+    "streams": 0, "completed": 0, "errors": 0, "ttft_ms_total": 0.0, "total_ms_total": 0.0, "last_ttft_ms": 0.0,
+    "usage_reports": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0,
+}
+
+
+class PromptPrefix:
+    """The static start of every Bella prompt - system prompt, then stable knowledge - built once, so
+    every request sends it byte for byte the same and its token count is known up front"""
+
+    def __init__(self, system_prompt: str = BELLA_SYSTEM_PROMPT, knowledge: str = ""):
+        self.messages = [{"role": "system", "content": system_prompt}]
+        if knowledge:
+            self.messages.append({"role": "system", "content": knowledge})
+        self.tokens = sum(chat_turn(message["role"], message["content"])["tokens"] for message in self.messages)
+        self.digest = sha256_hex(json.dumps(self.messages).encode())[:16]
+
+
+_prefix: Optional[PromptPrefix] = None
+
+
+def get_prompt_prefix() -> PromptPrefix:
+    """The process-wide prompt prefix; built at startup"""
+    global _prefix
+    if _prefix is None:
+        knowledge = ""
+        if CHAT_KNOWLEDGE_FILE:
+            with open(CHAT_KNOWLEDGE_FILE, encoding="utf-8") as f:
+                knowledge = f.read().strip()
+        _prefix = PromptPrefix(BELLA_SYSTEM_PROMPT, knowledge)
+        print(f"Bella prompt prefix: {_prefix.tokens} tokens ({_prefix.digest})")
+    return _prefix
+
+
+def bella_messages(session: ChatSession, turn: Dict[str, Any]) -> Tuple[List[Dict[str, str]], int]:
+    """The prompt for a new user turn and its token count. Most stable first, so consecutive requests
+    share the longest possible prefix: the static prefix, the session's running summary, its recent
+    history that fits the budget, the turn."""
+    prefix = get_prompt_prefix()
+    summary = session.summary_message()
+    summary_tokens = summary["tokens"] if summary else 0
+    history, history_tokens = session.window(CHAT_HISTORY_TOKEN_BUDGET - summary_tokens - turn["tokens"])
+    context = [prompt_message(summary)] if summary else []
+    messages = [*prefix.messages, *context, *history, prompt_message(turn)]
+    return messages, prefix.tokens + summary_tokens + history_tokens + turn["tokens"]
+
+
+def prefix_messages(message: str) -> Tuple[List[Dict[str, str]], int]:
+    """A single-turn prompt (no session) and its token count"""
+    turn = chat_turn("user", message)
+    prefix = get_prompt_prefix()
+    return [*prefix.messages, prompt_message(turn)], prefix.tokens + turn["tokens"]
+
+
+def record_usage(usage: Optional[Dict[str, Any]]) -> None:
+    """Count a completion's token usage, including the prompt tokens the provider served from its cache"""
+    if not usage:
+        return
+    CHAT_STATS["usage_reports"] += 1
+    CHAT_STATS["prompt_tokens"] += usage.get("prompt_tokens") or 0
+    CHAT_STATS["completion_tokens"] += usage.get("completion_tokens") or 0
+    CHAT_STATS["cached_tokens"] += (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+
+
+def sse_event(event: str, data: Dict[str, Any]) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode()
+
+
+async def open_chat_stream(messages: List[Dict[str, str]], prompt_tokens: int, api_key: str, model: str = CHAT_MODEL,
+                           max_tokens: int = CHAT_MAX_TOKENS) -> AsyncStream:
+    """Start a streaming completion (prompt_tokens: from bella_messages()); returns the open stream
+    once the response headers arrived. Raises ProviderUnavailableError or an openai.APIError."""
+    client = get_openai_client(api_key)
+    tokens = prompt_tokens + max_tokens
+    # The raw response exposes the x-ratelimit-* headers the scheduler learns the budget from
+    raw_response = await get_rate_limiter("openai", api_key).run(
+        lambda: get_provider_guard("openai_chat").call(lambda: client.chat.completions.with_raw_response.create(
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            stream=True,
+            stream_options={"include_usage": True},
+        )),
+        tokens=tokens,
+        priority=PRIORITY_CHAT,
+    )
+    return raw_response.parse()
+
+
+async def stream_chat_events(stream: AsyncStream, started: float,
+                             on_reply: Optional[Callable[[str], Awaitable[None]]] = None) -> AsyncIterator[bytes]:
+    """SSE events for an open completion stream (`started`: perf_counter() when the request came in).
+    on_reply gets the complete reply text before the done event. The upstream stream is closed when
+    it ends or the client disconnects."""
+    CHAT_STATS["streams"] += 1
+    first_token_at = None
+    parts: List[str] = []
+    done: Dict[str, Any] = {"model": None, "finish_reason": None, "usage": None}
+    try:
+        async for chunk in stream:
+            done["model"] = chunk.model or done["model"]
+            if chunk.usage is not None:
+                done["usage"] = chunk.usage.model_dump(exclude_none=True)
+            for choice in chunk.choices:
+                if choice.delta.content:
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
+                    parts.append(choice.delta.content)
+                    yield sse_event("token", {"text": choice.delta.content})
+                done["finish_reason"] = choice.finish_reason or done["finish_reason"]
+        finished = time.perf_counter()
+        done["ttft_ms"] = round(((first_token_at or finished) - started) * 1000, 1)
+        done["total_ms"] = round((finished - started) * 1000, 1)
+        CHAT_STATS["completed"] += 1
+        CHAT_STATS["ttft_ms_total"] += done["ttft_ms"]
+        CHAT_STATS["total_ms_total"] += done["total_ms"]
+        CHAT_STATS["last_ttft_ms"] = done["ttft_ms"]
+        record_usage(done["usage"])
+        if on_reply is not None:
+            await on_reply("".join(parts))
+        yield sse_event("done", done)
+    except Exception as e:
+        CHAT_STATS["errors"] += 1
+        print(f"Chat stream failed: {e}")
+        yield sse_event("error", {"detail": f"The reply was interrupted: {e}"})
+    finally:
+        await stream.close()
+
+
+def chat_stats() -> Dict[str, Any]:
+    completed = CHAT_STATS["completed"]
+    return {
+        "streams": CHAT_STATS["streams"],
+        "completed": completed,
+        "errors": CHAT_STATS["errors"],
+        "last_ttft_ms": CHAT_STATS["last_ttft_ms"],
+        "avg_ttft_ms": round(CHAT_STATS["ttft_ms_total"] / completed, 1) if completed else 0.0,
+        "avg_total_ms": round(CHAT_STATS["total_ms_total"] / completed, 1) if completed else 0.0,
+        "prefix_tokens": _prefix.tokens if _prefix else None,
+        "prompt_tokens": CHAT_STATS["prompt_tokens"],
+        "cached_tokens": CHAT_STATS["cached_tokens"],
+        "completion_tokens": CHAT_STATS["completion_tokens"],
+        "cached_ratio": round(CHAT_STATS["cached_tokens"] / CHAT_STATS["prompt_tokens"], 3) if CHAT_STATS["prompt_tokens"] else 0.0,
+    }
@@ -0,0 +1,244 @@
+"""
+Server-side Bella conversations, keyed by a session id cookie.
+
+/api/chat and /api/chat/stream keep each browser's messages in a ChatSession, so Bella sees the
+conversation instead of only the latest message. A prompt carries as much of the most recent history
+as fits CHAT_HISTORY_TOKEN_BUDGET. Every message is tokenized once, when it is added - with tiktoken
+when it is installed (the encoding is loaded once per process), else the ~4 characters per token
+estimate - and its count is stored with it, so trimming walks back over stored counts instead of
+re-tokenizing the history on every turn.
+
+Sessions are kept in memory, least recently used first, and expire after CHAT_SESSION_TTL_SECONDS
+without a message; at most CHAT_SESSION_MAX are held. With CHAT_SESSION_DB set, sessions are also
+written through to SQLite: they survive restarts, and a session evicted from memory is reloaded on
+its next message.
+
+Older turns are folded into a running summary in the background (chat_summary.py); a session keeps
+the summary as a ready-made prompt message with its token count, rebuilt only when its
+compaction_version changes.
+"""
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import Response
+
+from rate_limit import estimate_tokens
+
+CHAT_SESSION_COOKIE = "bella_session"
+CHAT_SESSION_TTL_SECONDS = float(os.getenv("CHAT_SESSION_TTL_SECONDS", str(24 * 3600)))
+CHAT_SESSION_MAX = int(os.getenv("CHAT_SESSION_MAX", "10000"))
+CHAT_SESSION_MAX_MESSAGES = int(os.getenv("CHAT_SESSION_MAX_MESSAGES", "200"))
+CHAT_SESSION_DB = os.getenv("CHAT_SESSION_DB", "")  # SQLite path; empty keeps sessions in memory only
+CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", "3000"))
+CHAT_TOKENIZER_ENCODING = os.getenv("CHAT_TOKENIZER_ENCODING", "cl100k_base")
+
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+MESSAGE_OVERHEAD_TOKENS = 4  # role and separators the chat format adds to every message
+EXPIRED_SWEEP_SECONDS = 60
+
+try:
+    import tiktoken
+    has_tiktoken = True
+except ImportError:
+    has_tiktoken = False
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    """The tokenizer, loaded once per process; None (also cached) when it cannot be loaded"""
+    if not has_tiktoken:
+        return None
+    try:
+        return tiktoken.get_encoding(CHAT_TOKENIZER_ENCODING)
+    except Exception as e:  # e.g. the encoding file cannot be downloaded
+        print(f"Tokenizer unavailable, estimating token counts: {e}")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """Token count of a text with the chat model's tokenizer, or the character estimate without it"""
+    encoding = _encoding()
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def chat_turn(role: str, content: str) -> Dict[str, Any]:
+    """A history entry: the message with its token count, computed once"""
+    return {"role": role, "content": content, "tokens": count_tokens(content) + MESSAGE_OVERHEAD_TOKENS}
+
+
+def prompt_message(turn: Dict[str, Any]) -> Dict[str, str]:
+    return {"role": turn["role"], "content": turn["content"]}
+
+
+class ChatSession:
+    """One conversation: the running summary of its older turns and its recent messages, oldest first,
+    each with its token count"""
+
+    def __init__(self, session_id: str, messages: Optional[List[Dict[str, Any]]] = None, updated_at: Optional[float] = None,
+                 summary: Optional[Dict[str, Any]] = None, compaction_version: int = 0):
+        self.session_id = session_id
+        self.messages: List[Dict[str, Any]] = messages or []
+        self.updated_at = updated_at or time.time()
+        self.summary = summary  # chat_turn() of the summary message, plus the compaction version it belongs to
+        self.compaction_version = compaction_version
+
+    def add(self, *turns: Dict[str, Any]) -> None:
+        self.messages.extend(turns)
+        if len(self.messages) > CHAT_SESSION_MAX_MESSAGES:
+            del self.messages[:len(self.messages) - CHAT_SESSION_MAX_MESSAGES]
+        self.updated_at = time.time()
+
+    def history_tokens(self) -> int:
+        return sum(turn["tokens"] for turn in self.messages) + (self.summary["tokens"] if self.summary else 0)
+
+    def compact(self, folded: List[Dict[str, Any]], summary: str, version: int) -> bool:
+        """Replace the `folded` oldest messages with a new running summary. Returns False (and changes
+        nothing) when the history changed since compaction `version` started."""
+        if version != self.compaction_version or self.messages[:len(folded)] != folded:
+            return False
+        del self.messages[:len(folded)]
+        self.compaction_version += 1
+        self.summary = {**chat_turn("system", SUMMARY_PREFIX + summary), "version": self.compaction_version}
+        return True
+
+    def summary_message(self) -> Optional[Dict[str, Any]]:
+        """The cached summary turn, if it matches the current history"""
+        if self.summary is None or self.summary.get("version") != self.compaction_version:
+            return None
+        return self.summary
+
+    def window(self, budget: int) -> Tuple[List[Dict[str, str]], int]:
+        """The most recent messages whose token counts add up to at most `budget`, oldest first, and
+        their token count"""
+        start, used = len(self.messages), 0
+        while start > 0 and used + self.messages[start - 1]["tokens"] <= budget:
+            start -= 1
+            used += self.messages[start]["tokens"]
+        # Never open the window on a reply whose question was cut off
+        if start < len(self.messages) and self.messages[start]["role"] == "assistant":
+            used -= self.messages[start]["tokens"]
+            start += 1
+        return [prompt_message(turn) for turn in self.messages[start:]], used
+
+
+class ChatSessionStore:
+    """Sessions in memory (LRU, idle TTL, bounded count), optionally written through to SQLite"""
+
+    def __init__(self, ttl_seconds: float = CHAT_SESSION_TTL_SECONDS, max_sessions: int = CHAT_SESSION_MAX,
+                 db_path: Optional[str] = CHAT_SESSION_DB or None):
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max(1, max_sessions)
+        self._sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_sweep = 0.0
+        self.stats = {"created": 0, "memory_hits": 0, "disk_hits": 0, "expired": 0, "evictions": 0}
+
+        self._db: Optional[sqlite3.Connection] = None
+        if db_path:
+            os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS chat_sessions ("
+                " session_id TEXT PRIMARY KEY, messages TEXT NOT NULL, updated_at REAL NOT NULL,"
+                " summary TEXT, compaction_version INTEGER NOT NULL DEFAULT 0)"
+            )
+            self._db.commit()
+
+    def get(self, session_id: Optional[str]) -> ChatSession:
+        """The live session for a cookie value, or a new session (with a new id) when it is unknown or expired"""
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            session = self._sessions.get(session_id) if session_id else None
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+                self.stats["memory_hits"] += 1
+                return session
+            if session_id and self._db is not None:
+                row = self._db.execute(
+                    "SELECT messages, updated_at, summary, compaction_version FROM chat_sessions"
+                    " WHERE session_id = ? AND updated_at >= ?",
+                    (session_id, now - self.ttl_seconds),
+                ).fetchone()
+                if row is not None:
+                    self.stats["disk_hits"] += 1
+                    session = ChatSession(session_id, json.loads(row[0]), row[1], json.loads(row[2] or "null"), row[3])
+                    self._remember(session)
+                    return session
+            self.stats["created"] += 1
+            return ChatSession(secrets.token_urlsafe(24))
+
+    def save(self, session: ChatSession) -> None:
+        with self._lock:
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO chat_sessions (session_id, messages, updated_at, summary, compaction_version)"
+                    " VALUES (?, ?, ?, ?, ?)",
+                    (session.session_id, json.dumps(session.messages), session.updated_at, json.dumps(session.summary),
+                     session.compaction_version),
+                )
+                self._db.commit()
+            self._remember(session)
+
+    def delete(self, session_id: str) -> None:
+        with self._lock:
+            self._sessions.pop(session_id, None)
+            if self._db is not None:
+                self._db.execute("DELETE FROM chat_sessions WHERE session_id = ?", (session_id,))
+                self._db.commit()
+
+    def _remember(self, session: ChatSession) -> None:
+        self._sessions[session.session_id] = session
+        self._sessions.move_to_end(session.session_id)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def _expire(self, now: float) -> None:
+        """Drop idle sessions: the least recently used are at the front of the LRU"""
+        cutoff = now - self.ttl_seconds
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if session.updated_at >= cutoff:
+                break
+            self._sessions.popitem(last=False)
+            self.stats["expired"] += 1
+        if self._db is not None and now - self._last_sweep >= EXPIRED_SWEEP_SECONDS:
+            self._last_sweep = now
+            self._db.execute("DELETE FROM chat_sessions WHERE updated_at < ?", (cutoff,))
+            self._db.commit()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                **self.stats,
+                "sessions": len(self._sessions),
+                "backend": "sqlite" if self._db is not None else "memory",
+                "tokenizer": CHAT_TOKENIZER_ENCODING if _encoding() is not None else "estimate",
+            }
+
+
+def set_session_cookie(response: Response, session: ChatSession) -> None:
+    response.set_cookie(
+        CHAT_SESSION_COOKIE, session.session_id, max_age=int(CHAT_SESSION_TTL_SECONDS), httponly=True, samesite="lax"
+    )
+
+
+_store: Optional[ChatSessionStore] = None
+
+
+def get_chat_sessions() -> ChatSessionStore:
+    global _store
+    if _store is None:
+        _store = ChatSessionStore()
+    return _store
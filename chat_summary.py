@@ -0,0 +1,142 @@
+"""
+Rolling summaries of long Bella conversations.
+
+Dropping the oldest turns once a conversation outgrows CHAT_HISTORY_TOKEN_BUDGET loses what the
+user said early on, and sending everything makes every turn slower and more expensive. Instead,
+once a session's history (summary included) passes CHAT_COMPACTION_TRIGGER_TOKENS, the oldest
+exchanges are folded into a running summary by a cheap model (CHAT_SUMMARY_MODEL) until about
+CHAT_COMPACTION_KEEP_TOKENS of recent messages remain. The prompt is then the system prompt, the
+summary (at most CHAT_SUMMARY_MAX_TOKENS) and the recent turns, so its size stays roughly constant
+however long the conversation runs.
+
+Compaction runs as a background task once a reply has been recorded, never on the request path, and
+at most one per session at a time. It runs at batch priority in the rate-limit scheduler. If the
+session's history changed underneath it (another compaction, or the message cap trimmed it), the
+result is dropped. Every compaction bumps the session's compaction_version.
+"""
+import asyncio
+import os
+from typing import Any, Dict, List, Optional
+
+from fastapi.concurrency import run_in_threadpool
+
+from chat_sessions import CHAT_HISTORY_TOKEN_BUDGET, SUMMARY_PREFIX, ChatSession, ChatSessionStore
+from circuit_breaker import get_provider_guard
+from openai_clients import get_openai_client
+from rate_limit import PRIORITY_BATCH, estimate_tokens, get_rate_limiter
+
+CHAT_SUMMARY_MODEL = os.getenv("CHAT_SUMMARY_MODEL", "gpt-4o-mini")
+CHAT_SUMMARY_MAX_TOKENS = int(os.getenv("CHAT_SUMMARY_MAX_TOKENS", "400"))
+CHAT_COMPACTION_TRIGGER_TOKENS = int(os.getenv("CHAT_COMPACTION_TRIGGER_TOKENS", str(CHAT_HISTORY_TOKEN_BUDGET * 3 // 4)))
+CHAT_COMPACTION_KEEP_TOKENS = int(os.getenv("CHAT_COMPACTION_KEEP_TOKENS", str(CHAT_HISTORY_TOKEN_BUDGET // 3)))
+
+SUMMARY_INSTRUCTIONS = (
+    "You keep a running summary of a conversation between a customer and Bella, Skypad's furniture "
+    "and interior design guide. Merge the new messages into the current summary. Keep the customer's "
+    "needs, rooms, budget, style and material preferences, the products and ideas discussed, decisions "
+    "made and open questions. Drop greetings and small talk. Write plain prose in the third person, "
+    f"at most {CHAT_SUMMARY_MAX_TOKENS * 3 // 4} words, with no preamble."
+)
+SPEAKERS = {"user": "Customer", "assistant": "Bella"}
+
+
+def turns_to_fold(session: ChatSession, keep_tokens: int = CHAT_COMPACTION_KEEP_TOKENS) -> List[Dict[str, Any]]:
+    """The oldest messages to fold so that about `keep_tokens` of recent messages remain. Whole
+    exchanges only: what remains starts with a user message."""
+    kept, start = 0, len(session.messages)
+    while start > 0 and kept + session.messages[start - 1]["tokens"] <= keep_tokens:
+        start -= 1
+        kept += session.messages[start]["tokens"]
+    while start < len(session.messages) and session.messages[start]["role"] != "user":
+        start += 1
+    return session.messages[:start]
+
+
+def summary_request(previous: Optional[str], turns: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+    transcript = "\n\n".join(f"{SPEAKERS.get(turn['role'], turn['role'])}: {turn['content']}" for turn in turns)
+    return [
+        {"role": "system", "content": SUMMARY_INSTRUCTIONS},
+        {"role": "user", "content": f"Current summary:\n{previous or '(none yet)'}\n\nNew messages:\n{transcript}"},
+    ]
+
+
+async def summarize(previous: Optional[str], turns: List[Dict[str, Any]], api_key: str) -> str:
+    """Fold `turns` into the previous summary with the summary model"""
+    client = get_openai_client(api_key)
+    messages = summary_request(previous, turns)
+    raw_completion = await get_rate_limiter("openai", api_key).run(
+        lambda: get_provider_guard("openai_chat").call(
+            lambda: client.chat.completions.with_raw_response.create(
+                model=CHAT_SUMMARY_MODEL,
+                messages=messages,
+                max_tokens=CHAT_SUMMARY_MAX_TOKENS,
+                temperature=0.2,
+            )
+        ),
+        tokens=sum(estimate_tokens(message["content"]) for message in messages) + CHAT_SUMMARY_MAX_TOKENS,
+        priority=PRIORITY_BATCH,
+    )
+    summary = raw_completion.parse().choices[0].message.content
+    if not summary:
+        raise ValueError("The summary model returned an empty message")
+    return summary.strip()
+
+
+class ConversationCompactor:
+    """Background compaction tasks, at most one per session"""
+
+    def __init__(self, trigger_tokens: int = CHAT_COMPACTION_TRIGGER_TOKENS):
+        self.trigger_tokens = trigger_tokens
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self.stats = {"scheduled": 0, "compactions": 0, "folded_messages": 0, "stale": 0, "failures": 0}
+
+    def schedule(self, session: ChatSession, store: ChatSessionStore, api_key: str) -> bool:
+        """Start compacting the session if its history passed the trigger; call once a reply is recorded"""
+        if session.session_id in self._tasks or session.history_tokens() <= self.trigger_tokens:
+            return False
+        task = asyncio.get_running_loop().create_task(self._compact(session, store, api_key))
+        self._tasks[session.session_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(session.session_id, None))
+        self.stats["scheduled"] += 1
+        return True
+
+    async def _compact(self, session: ChatSession, store: ChatSessionStore, api_key: str) -> None:
+        version = session.compaction_version
+        folded = turns_to_fold(session)
+        if not folded:
+            return
+        summary = session.summary_message()
+        previous = summary["content"][len(SUMMARY_PREFIX):] if summary else None
+        try:
+            text = await summarize(previous, folded, api_key)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.stats["failures"] += 1
+            print(f"Conversation compaction failed: {e}")
+            return
+        if not session.compact(folded, text, version):
+            self.stats["stale"] += 1
+            return
+        self.stats["compactions"] += 1
+        self.stats["folded_messages"] += len(folded)
+        await run_in_threadpool(store.save, session)
+
+    async def close(self) -> None:
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {**self.stats, "in_flight": len(self._tasks), "model": CHAT_SUMMARY_MODEL}
+
+
+_compactor: Optional[ConversationCompactor] = None
+
+
+def get_chat_compactor() -> ConversationCompactor:
+    global _compactor
+    if _compactor is None:
+        _compactor = ConversationCompactor()
+    return _compactor
@@ -0,0 +1,252 @@
+"""
+Per-provider circuit breakers and bulkheads.
+
+Each provider (OpenAI chat, OpenAI vision, Google Vision) is called through its own ProviderGuard:
+  - a circuit breaker over a rolling window of outcomes: once at least BREAKER_MIN_CALLS calls in the
+    last BREAKER_WINDOW_SECONDS failed at BREAKER_FAILURE_RATE or more, the circuit opens and calls
+    fail immediately for BREAKER_OPEN_SECONDS; then a few half-open trial calls decide whether it
+    closes again or re-opens,
+  - a bulkhead: at most `max_concurrency` calls in flight and `max_queue` waiting, plus (for blocking
+    SDK calls) a dedicated thread pool, so a degraded provider cannot use up the shared threadpool or
+    the slots the other providers need.
+Rejected calls raise ProviderUnavailableError with a retry hint in seconds.
+"""
+import asyncio
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+BREAKER_WINDOW_SECONDS = float(os.getenv("BREAKER_WINDOW_SECONDS", "60"))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "10"))
+BREAKER_FAILURE_RATE = float(os.getenv("BREAKER_FAILURE_RATE", "0.5"))
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "30"))
+BREAKER_HALF_OPEN_CALLS = int(os.getenv("BREAKER_HALF_OPEN_CALLS", "3"))
+
+# Bulkhead sizes: (max in flight, max waiting, dedicated threads for blocking calls)
+PROVIDER_LIMITS = {
+    "openai_chat": (int(os.getenv("OPENAI_CHAT_MAX_CONCURRENCY", "16")), int(os.getenv("OPENAI_CHAT_MAX_QUEUE", "64")), int(os.getenv("OPENAI_CHAT_MAX_CONCURRENCY", "16"))),
+    "openai_vision": (int(os.getenv("OPENAI_VISION_MAX_CONCURRENCY", "32")), int(os.getenv("OPENAI_VISION_MAX_QUEUE", "256")), 0),
+    "google_vision": (int(os.getenv("GOOGLE_VISION_MAX_CONCURRENCY", "8")), int(os.getenv("GOOGLE_VISION_MAX_QUEUE", "64")), int(os.getenv("GOOGLE_VISION_MAX_CONCURRENCY", "8"))),
+}
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class ProviderUnavailableError(Exception):
+    """A provider call was rejected without being attempted (open circuit or full bulkhead)"""
+
+    def __init__(self, provider: str, reason: str, retry_after: float):
+        self.provider = provider
+        self.reason = reason
+        self.retry_after = max(1.0, round(retry_after, 1))
+        super().__init__(f"{provider} is temporarily unavailable ({reason}); retry in {self.retry_after:.0f}s")
+
+
+# Exception types (matched by class name, so the optional SDKs need not be importable here) that mean
+# the provider itself failed: connection errors and timeouts of httpx / the OpenAI SDK / google-auth,
+# and Google's transient gRPC statuses
+UPSTREAM_ERROR_NAMES = {
+    "TransportError", "APIConnectionError", "APITimeoutError", "RetryError",
+    "ServiceUnavailable", "DeadlineExceeded",
+}
+
+
+def is_failure(outcome: Any) -> bool:
+    """Whether a call's result or exception counts against the circuit: server errors, timeouts and
+    connection failures do. Client and configuration errors (bad credentials files, invalid input,
+    other 4xx) do not - one caller's bad request must not open the circuit for everyone - and neither
+    do 429s (OpenAI's, or Google's ResourceExhausted), which the rate limiter pauses and retries."""
+    if not isinstance(outcome, BaseException):
+        status = getattr(outcome, "status_code", None)
+        return isinstance(status, int) and status >= 500
+    if any(cls.__name__ in UPSTREAM_ERROR_NAMES for cls in type(outcome).__mro__):
+        return True
+    status = getattr(outcome, "status_code", None) or getattr(outcome, "code", None)
+    if isinstance(status, int):
+        return status >= 500
+    # Checked before OSError, which they subclass: a bad credentials path is an OSError too
+    return isinstance(outcome, (TimeoutError, asyncio.TimeoutError, ConnectionError))
+
+
+class CircuitBreaker:
+    """Closed/open/half-open breaker over a rolling window of call outcomes"""
+
+    def __init__(
+        self,
+        window_seconds: float = BREAKER_WINDOW_SECONDS,
+        min_calls: int = BREAKER_MIN_CALLS,
+        failure_rate: float = BREAKER_FAILURE_RATE,
+        open_seconds: float = BREAKER_OPEN_SECONDS,
+        half_open_calls: int = BREAKER_HALF_OPEN_CALLS,
+    ):
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self.state = CLOSED
+        self.opened_until = 0.0
+        self.opened_count = 0
+        self._outcomes: Deque[Tuple[float, bool]] = deque()  # (time, succeeded)
+        self._trials = 0  # half-open calls admitted
+        self._trial_successes = 0
+
+    def _prune(self, now: float) -> None:
+        while self._outcomes and self._outcomes[0][0] < now - self.window_seconds:
+            self._outcomes.popleft()
+
+    def retry_after(self) -> float:
+        return max(0.0, self.opened_until - time.monotonic()) if self.state == OPEN else self.open_seconds / 2
+
+    def allow(self) -> bool:
+        """Whether a call may go ahead now (half-open admits a limited number of trial calls)"""
+        if self.state == OPEN:
+            if time.monotonic() < self.opened_until:
+                return False
+            self.state, self._trials, self._trial_successes = HALF_OPEN, 0, 0
+        if self.state == HALF_OPEN:
+            if self._trials >= self.half_open_calls:
+                return False
+            self._trials += 1
+        return True
+
+    def cancel_trial(self) -> None:
+        """A half-open trial call was abandoned before it produced an outcome"""
+        if self.state == HALF_OPEN and self._trials > 0:
+            self._trials -= 1
+
+    def record(self, succeeded: bool) -> None:
+        now = time.monotonic()
+        if self.state == HALF_OPEN:
+            if not succeeded:
+                self._open(now)
+                return
+            self._trial_successes += 1
+            if self._trial_successes >= self.half_open_calls:
+                self.state = CLOSED
+                self._outcomes.clear()
+            return
+
+        self._outcomes.append((now, succeeded))
+        self._prune(now)
+        if self.state == CLOSED and len(self._outcomes) >= self.min_calls and self.error_rate() >= self.failure_rate:
+            self._open(now)
+
+    def _open(self, now: float) -> None:
+        self.state = OPEN
+        self.opened_until = now + self.open_seconds
+        self.opened_count += 1
+        self._outcomes.clear()
+
+    def error_rate(self) -> float:
+        self._prune(time.monotonic())
+        if not self._outcomes:
+            return 0.0
+        return sum(1 for _, succeeded in self._outcomes if not succeeded) / len(self._outcomes)
+
+
+class ProviderGuard:
+    """Circuit breaker + bulkhead (bounded concurrency, bounded queue, own threads) for one provider"""
+
+    def __init__(self, name: str, max_concurrency: int, max_queue: int, threads: int = 0, breaker: Optional[CircuitBreaker] = None):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.breaker = breaker or CircuitBreaker()
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._threads = threads
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.in_flight = 0
+        self.waiting = 0
+        self.stats = {"calls": 0, "failures": 0, "rejected_open": 0, "rejected_full": 0}
+
+    async def call(self, send: Callable[[], Awaitable[Any]]) -> Any:
+        """Run `send()` if the circuit and bulkhead allow it; record the outcome on the breaker"""
+        if self.in_flight >= self.max_concurrency and self.waiting >= self.max_queue:
+            self.stats["rejected_full"] += 1
+            raise ProviderUnavailableError(self.name, "too many concurrent requests", 1.0)
+        if not self.breaker.allow():
+            self.stats["rejected_open"] += 1
+            raise ProviderUnavailableError(self.name, "circuit open", self.breaker.retry_after())
+
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        except asyncio.CancelledError:
+            self.breaker.cancel_trial()
+            raise
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        self.stats["calls"] += 1
+        try:
+            result = await send()
+        except asyncio.CancelledError:
+            self.breaker.cancel_trial()
+            raise
+        except Exception as e:
+            self._record(is_failure(e))
+            raise
+        else:
+            self._record(is_failure(result))
+            return result
+        finally:
+            self.in_flight -= 1
+            self._slots.release()
+
+    def _record(self, failed: bool) -> None:
+        self.stats["failures"] += failed
+        self.breaker.record(not failed)
+
+    async def run_blocking(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """Guarded call of a blocking function on this provider's own thread pool"""
+        loop = asyncio.get_running_loop()
+        return await self.call(lambda: loop.run_in_executor(self.executor, lambda: fn(*args, **kwargs)))
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self._threads or self.max_concurrency, thread_name_prefix=f"skypad-{self.name}")
+        return self._executor
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def snapshot(self) -> Dict[str, Any]:
+        breaker = self.breaker
+        return {
+            **self.stats,
+            "state": breaker.state,
+            "error_rate": round(breaker.error_rate(), 4),
+            "window_calls": len(breaker._outcomes),
+            "times_opened": breaker.opened_count,
+            "retry_after_seconds": round(breaker.retry_after(), 1) if breaker.state == OPEN else None,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+        }
+
+
+_guards: Dict[str, ProviderGuard] = {}
+
+
+def get_provider_guard(name: str) -> ProviderGuard:
+    """The process-wide guard for "openai_chat", "openai_vision" or "google_vision" """
+    if name not in _guards:
+        max_concurrency, max_queue, threads = PROVIDER_LIMITS.get(name, (8, 64, 8))
+        _guards[name] = ProviderGuard(name, max_concurrency, max_queue, threads)
+    return _guards[name]
+
+
+def provider_status() -> Dict[str, Any]:
+    return {name: get_provider_guard(name).snapshot() for name in PROVIDER_LIMITS}
+
+
+def shutdown_provider_guards() -> None:
+    for guard in _guards.values():
+        guard.shutdown()
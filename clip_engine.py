@@ -0,0 +1,344 @@
+"""
+Local CPU CLIP tagging (model_name=clip).
+
+The model runs in a dedicated process pool (CLIP_WORKERS processes, CPU only) so inference never
+blocks the event loop or competes with it for the GIL. Each worker loads the image encoder once -
+lazily on the first request or at startup when CLIP_WARMUP is set - together with the normalized
+text embeddings of the category prompts. Tagging an image is then one image forward pass plus one
+matrix multiply against the category matrix.
+
+Two encoder backends (CLIP_BACKEND):
+  - "onnx":  the INT8-quantized image encoder exported by `python clip_onnx.py export`, run with
+             onnxruntime; the category embeddings are precomputed at export time, so torch is not
+             needed at runtime (the default when the exported files exist),
+  - "torch": open_clip/PyTorch fp32, computing the category embeddings when the worker starts.
+
+Concurrent requests are micro-batched: images queue in ClipEngine until CLIP_MAX_BATCH are waiting
+or CLIP_BATCH_WAIT_MS has passed since the first one, and a batch is only dispatched when a worker is
+free, so batches grow with load instead of queueing inside the pool.
+"""
+import asyncio
+import importlib.util
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from fastapi.concurrency import run_in_threadpool
+
+from utils import ImageSource, read_source
+
+CLIP_MODEL = os.getenv("CLIP_MODEL", "ViT-B-32")
+CLIP_PRETRAINED = os.getenv("CLIP_PRETRAINED", "laion2b_s34b_b79k")
+CLIP_BACKEND = os.getenv("CLIP_BACKEND", "auto").lower()  # auto, onnx, torch
+# Output of `python clip_onnx.py export` (the Docker build runs it)
+CLIP_ONNX_DIR = os.getenv("CLIP_ONNX_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "models"))
+CLIP_ONNX_MODEL = os.path.join(CLIP_ONNX_DIR, "clip_image_int8.onnx")
+CLIP_ONNX_TEXT = os.path.join(CLIP_ONNX_DIR, "clip_text_embeddings.npz")
+
+
+def resolve_clip_backend() -> Optional[str]:
+    """The encoder backend to use, or None when neither is available.
+    Checked without importing: torch and onnxruntime are only ever loaded inside the worker processes."""
+    has_onnx = importlib.util.find_spec("onnxruntime") is not None and os.path.exists(CLIP_ONNX_MODEL) and os.path.exists(CLIP_ONNX_TEXT)
+    has_torch = importlib.util.find_spec("torch") is not None and importlib.util.find_spec("open_clip") is not None
+    if CLIP_BACKEND == "onnx":
+        return "onnx" if has_onnx else None
+    if CLIP_BACKEND == "torch":
+        return "torch" if has_torch else None
+    return "onnx" if has_onnx else ("torch" if has_torch else None)
+
+
+CLIP_WORKERS = int(os.getenv("CLIP_WORKERS", "1"))
+# Intra-op threads per worker (torch or onnxruntime); the workers split the cores between them
+CLIP_THREADS = int(os.getenv("CLIP_THREADS", str(max(1, (os.cpu_count() or 1) // max(1, CLIP_WORKERS)))))
+CLIP_MAX_BATCH = int(os.getenv("CLIP_MAX_BATCH", "16"))
+CLIP_BATCH_WAIT_MS = float(os.getenv("CLIP_BATCH_WAIT_MS", "25"))
+CLIP_WARMUP = os.getenv("CLIP_WARMUP", "").lower() in ("1", "true", "yes")
+CLIP_TOP_K = int(os.getenv("CLIP_TOP_K", "5"))
+CLIP_PROMPT_VERSION = "v1"
+# CLIP's learned logit scale; the request temperature divides it
+CLIP_LOGIT_SCALE = 100.0
+
+clip_backend = resolve_clip_backend()
+has_clip = clip_backend is not None
+if not has_clip:
+    print("Warning: CLIP dependencies not installed. CLIP model will not be available.")
+
+PROMPT_TEMPLATE = "a photo of {}"
+
+FURNITURE_CATEGORIES = [
+    "armchair", "lounge chair", "dining chair", "bar stool", "counter stool", "banquette", "sofa",
+    "sectional sofa", "loveseat", "chaise lounge", "ottoman", "bench", "daybed", "bed", "headboard",
+    "nightstand", "dresser", "wardrobe", "luggage rack", "desk", "desk chair", "coffee table",
+    "side table", "console table", "dining table", "bar table", "reception desk", "bar counter",
+    "bookshelf", "cabinet", "sideboard", "media unit", "mirror", "floor lamp", "table lamp",
+    "pendant light", "chandelier", "wall sconce", "rug", "curtains", "outdoor sofa", "sun lounger",
+    "patio dining set", "umbrella", "planter", "hotel lobby", "hotel guest room", "restaurant interior",
+    "bar interior", "pool deck",
+]
+
+GENERAL_CATEGORIES = [
+    "person", "people", "animal", "dog", "cat", "car", "building", "house", "city street", "landscape",
+    "mountain", "beach", "forest", "food", "drink", "plant", "flower", "furniture", "interior room",
+    "kitchen", "bathroom", "office", "electronics", "book", "artwork", "text document", "clothing",
+    "sports", "sky", "water",
+]
+
+CATEGORY_SETS = {"furniture": FURNITURE_CATEGORIES, "general": GENERAL_CATEGORIES}
+
+
+def clip_options(use_furniture_categories: bool = True, min_confidence: float = 0.05, temperature: float = 0.9) -> Dict[str, Any]:
+    """Per-request tagging options (they are part of the analysis cache key)"""
+    return {
+        "category_set": "furniture" if use_furniture_categories else "general",
+        "min_confidence": float(min_confidence),
+        "temperature": max(float(temperature), 1e-3),
+    }
+
+
+def clip_prompt_version(options: Dict[str, Any]) -> str:
+    return f"{CLIP_PROMPT_VERSION}:{options['category_set']}:{options['min_confidence']}:{options['temperature']}"
+
+
+def score_embeddings(image_embeddings: np.ndarray, text_embeddings: np.ndarray, temperatures: np.ndarray) -> np.ndarray:
+    """Category probabilities for a batch: one (images x dim) @ (dim x categories) matmul, then a
+    row-wise softmax with each image's own temperature. Embeddings are L2-normalized."""
+    logits = (image_embeddings @ text_embeddings.T) * (CLIP_LOGIT_SCALE / temperatures[:, None])
+    logits -= logits.max(axis=1, keepdims=True)
+    probabilities = np.exp(logits)
+    return probabilities / probabilities.sum(axis=1, keepdims=True)
+
+
+def result_from_probabilities(probabilities: np.ndarray, labels: List[str], min_confidence: float) -> Dict[str, Any]:
+    top = np.argsort(probabilities)[::-1][:CLIP_TOP_K]
+    scored = [{"description": labels[i], "score": round(float(probabilities[i]), 4)} for i in top if probabilities[i] >= min_confidence]
+    if not scored:
+        scored = [{"description": labels[top[0]], "score": round(float(probabilities[top[0]]), 4)}]
+    tags = [label["description"] for label in scored]
+    return {
+        "success": True,
+        "tags": tags,
+        "caption": f"Image of {tags[0]}",
+        "explanation": f"CLIP ({CLIP_MODEL}) matches this image best with: "
+                       + ", ".join(f"{label['description']} ({label['score']:.0%})" for label in scored) + ".",
+        "raw_response": {"labels": scored, "model": CLIP_MODEL, "pretrained": CLIP_PRETRAINED, "backend": clip_backend},
+    }
+
+
+# --- Worker process side ---
+# State of the model loaded in this worker process (set by _load_worker)
+_worker: Dict[str, Any] = {}
+
+
+def load_torch_encoder(model_name: str, pretrained: str, threads: int):
+    """open_clip fp32 encoder: returns (encode(list of PIL images) -> normalized embeddings, category text embeddings)"""
+    import torch
+    import open_clip
+
+    torch.set_num_threads(threads)
+    model, _, preprocess = open_clip.create_model_and_transforms(model_name, pretrained=pretrained, device="cpu")
+    model.eval()
+    tokenizer = open_clip.get_tokenizer(model_name)
+    text_embeddings = {}
+    with torch.no_grad():
+        for name, labels in CATEGORY_SETS.items():
+            embeddings = model.encode_text(tokenizer([PROMPT_TEMPLATE.format(label) for label in labels]))
+            embeddings /= embeddings.norm(dim=-1, keepdim=True)
+            text_embeddings[name] = embeddings.numpy().astype(np.float32)
+
+    def encode(images) -> np.ndarray:
+        pixels = torch.stack([preprocess(image) for image in images])
+        with torch.no_grad():
+            embeddings = model.encode_image(pixels)
+            embeddings /= embeddings.norm(dim=-1, keepdim=True)
+        return embeddings.numpy().astype(np.float32)
+
+    return encode, text_embeddings
+
+
+def _load_worker(backend: str, model_name: str, pretrained: str, threads: int) -> None:
+    """Process pool initializer: load the image encoder and the category text embeddings"""
+    if backend == "onnx":
+        from clip_onnx import load_onnx_encoder
+        encode, text_embeddings = load_onnx_encoder(CLIP_ONNX_MODEL, CLIP_ONNX_TEXT, threads)
+    else:
+        encode, text_embeddings = load_torch_encoder(model_name, pretrained, threads)
+    _worker.update(encode=encode, text_embeddings=text_embeddings)
+
+
+def _ping() -> bool:
+    return bool(_worker)
+
+
+def _analyze_batch(contents: List[bytes], options: List[Optional[Dict[str, Any]]]) -> List[Any]:
+    """Tag a batch of images in one forward pass (runs in a worker process).
+    Entries without options only want their embedding, which is returned as the result."""
+    from PIL import Image
+
+    results: List[Optional[Dict[str, Any]]] = [None] * len(contents)
+    # Fully decode each image here (verify() does not read the pixel data), so a truncated or corrupt
+    # upload fails only its own request rather than the whole batch
+    decodable, images = [], []
+    for i, content in enumerate(contents):
+        try:
+            with Image.open(BytesIO(content)) as image:
+                images.append(image.convert("RGB"))
+            decodable.append(i)
+        except Exception as e:
+            results[i] = {"success": False, "error": f"Could not decode image: {e}"}
+    if decodable:
+        embeddings = _worker["encode"](images)
+        for row, i in enumerate(decodable):
+            if options[i] is None:
+                results[i] = embeddings[row]
+        for category_set, labels in CATEGORY_SETS.items():
+            rows = [row for row, i in enumerate(decodable) if options[i] is not None and options[i]["category_set"] == category_set]
+            if not rows:
+                continue
+            temperatures = np.array([options[decodable[row]]["temperature"] for row in rows], dtype=np.float32)
+            probabilities = score_embeddings(embeddings[rows], _worker["text_embeddings"][category_set], temperatures)
+            for row, row_probabilities in zip(rows, probabilities):
+                i = decodable[row]
+                results[i] = result_from_probabilities(row_probabilities, labels, options[i]["min_confidence"])
+    return results
+
+
+# --- Server side ---
+
+class ClipEngine:
+    """Micro-batches concurrent CLIP requests onto a pool of model worker processes"""
+
+    def __init__(self, workers: int = CLIP_WORKERS, max_batch: int = CLIP_MAX_BATCH, wait_ms: float = CLIP_BATCH_WAIT_MS):
+        self.workers = max(1, workers)
+        self.max_batch = max(1, max_batch)
+        self.wait = wait_ms / 1000
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._pending: List[Any] = []  # (content, options or None for an embedding, future)
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._busy = 0
+        self._running: set = set()
+        self.stats = {"batches": 0, "images": 0, "max_batch_size": 0, "pool_restarts": 0}
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # spawn: the workers must not inherit the server's threads and sockets
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_load_worker,
+                initargs=(clip_backend, CLIP_MODEL, CLIP_PRETRAINED, CLIP_THREADS),
+            )
+        return self._pool
+
+    async def warm(self) -> None:
+        """Start every worker process and load the model before the first request"""
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self.pool, _ping) for _ in range(self.workers)))
+
+    async def analyze(self, image_source: ImageSource, options: Dict[str, Any]) -> Dict[str, Any]:
+        content = await run_in_threadpool(read_source, image_source)
+        return await self._submit(content, options)
+
+    async def embed(self, content: bytes) -> np.ndarray:
+        """L2-normalized image embedding, batched together with the tagging requests"""
+        result = await self._submit(content, None)
+        if isinstance(result, dict):
+            raise RuntimeError(result["error"])
+        return result
+
+    async def _submit(self, content: bytes, options: Optional[Dict[str, Any]]) -> Any:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((content, options, future))
+        if len(self._pending) >= self.max_batch:
+            self._dispatch(partial=False)
+        if self._pending and self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.wait, self._on_deadline)
+        return await future
+
+    def _on_deadline(self) -> None:
+        self._timer = None
+        self._dispatch(partial=True)
+
+    def _dispatch(self, partial: bool) -> None:
+        """Send batches to free workers; a short batch only goes once its wait deadline has passed"""
+        while self._pending and self._busy < self.workers:
+            if len(self._pending) < self.max_batch and not partial:
+                break
+            batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+            self._busy += 1
+            task = asyncio.ensure_future(self._run(batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+        if not self._pending and self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    async def _run(self, batch: List[Any]) -> None:
+        self.stats["batches"] += 1
+        self.stats["images"] += len(batch)
+        self.stats["max_batch_size"] = max(self.stats["max_batch_size"], len(batch))
+        loop = asyncio.get_running_loop()
+        pool = self.pool
+        try:
+            results = await loop.run_in_executor(pool, _analyze_batch, [content for content, _, _ in batch], [options for _, options, _ in batch])
+        except BrokenProcessPool as e:
+            # A worker died (e.g. out of memory) or failed to load the model: shut the broken pool
+            # down and start fresh next time
+            pool.shutdown(wait=False, cancel_futures=True)
+            if self._pool is pool:
+                self._pool = None
+                self.stats["pool_restarts"] += 1
+            results = [{"success": False, "error": f"CLIP worker failed: {str(e)}"} for _ in batch]
+        except Exception as e:
+            results = [{"success": False, "error": f"Exception: {str(e)}"} for _ in batch]
+        finally:
+            self._busy -= 1
+        for (_, _, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+        # Requests that queued while every worker was busy have waited long enough
+        self._dispatch(partial=True)
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def snapshot(self) -> Dict[str, Any]:
+        batches = self.stats["batches"]
+        return {
+            **self.stats,
+            "avg_batch_size": round(self.stats["images"] / batches, 2) if batches else 0.0,
+            "queued": len(self._pending),
+            "busy_workers": self._busy,
+            "workers": self.workers,
+            "model": f"{CLIP_MODEL}/{CLIP_PRETRAINED}",
+            "backend": clip_backend,
+            "started": self._pool is not None,
+        }
+
+
+_engine: Optional[ClipEngine] = None
+
+
+def get_clip_engine() -> ClipEngine:
+    global _engine
+    if _engine is None:
+        _engine = ClipEngine()
+    return _engine
+
+
+async def warm_clip_engine() -> None:
+    """Load the CLIP model at startup when CLIP_WARMUP is set (otherwise on first use)"""
+    if not has_clip or not CLIP_WARMUP:
+        return
+    try:
+        await get_clip_engine().warm()
+        print("CLIP model loaded.")
+    except Exception as e:
+        print(f"Warning: could not load CLIP model: {e}")
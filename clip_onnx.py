@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+ONNX export and runtime for the CLIP image encoder.
+
+Build step (needs the packages in requirements-clip.txt; the Docker build runs it in its own stage):
+
+    python clip_onnx.py export [--output-dir models] [--keep-fp32]
+
+writes to CLIP_ONNX_DIR
+  - clip_image_int8.onnx: the image encoder (pixels -> L2-normalized embedding) with dynamic INT8
+    quantization of its MatMul/Gemm weights, roughly a quarter of the fp32 size,
+  - clip_text_embeddings.npz: the normalized category prompt embeddings and the preprocessing
+    constants, so the server needs neither torch nor the text encoder,
+  - clip_image_fp32.onnx with --keep-fp32 (reference for benchmarks/bench_clip_onnx.py).
+
+At runtime load_onnx_encoder() opens the model in an onnxruntime CPU session with the given number
+of intra-op threads and preprocesses images with Pillow/numpy the way open_clip does (bicubic resize
+of the short side, center crop, mean/std normalization).
+"""
+import argparse
+import inspect
+import os
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+from PIL import Image
+
+from clip_engine import CATEGORY_SETS, CLIP_MODEL, CLIP_ONNX_DIR, CLIP_ONNX_MODEL, CLIP_ONNX_TEXT, CLIP_PRETRAINED, PROMPT_TEMPLATE
+
+FP32_FILENAME = "clip_image_fp32.onnx"
+INT8_FILENAME = os.path.basename(CLIP_ONNX_MODEL)
+TEXT_FILENAME = os.path.basename(CLIP_ONNX_TEXT)
+ONNX_OPSET = 17
+
+
+def preprocess_image(image: Image.Image, size: int, mean: np.ndarray, std: np.ndarray) -> np.ndarray:
+    """PIL image -> normalized CHW float32 array, equivalent to open_clip's eval transform"""
+    image = image.convert("RGB")
+    width, height = image.size
+    scale = size / min(width, height)
+    image = image.resize((max(size, round(width * scale)), max(size, round(height * scale))), Image.BICUBIC)
+    left, top = (image.width - size) // 2, (image.height - size) // 2
+    image = image.crop((left, top, left + size, top + size))
+    pixels = np.asarray(image, dtype=np.float32) / 255.0
+    return ((pixels - mean) / std).transpose(2, 0, 1)
+
+
+def load_onnx_encoder(model_path: str, text_path: str, threads: int) -> Tuple[Callable[[List[Image.Image]], np.ndarray], Dict[str, np.ndarray]]:
+    """onnxruntime encoder: returns (encode(list of PIL images) -> normalized embeddings, category text embeddings)"""
+    import onnxruntime as ort
+
+    exported = np.load(text_path)
+    text_embeddings = {}
+    for name, labels in CATEGORY_SETS.items():
+        if list(exported[f"labels_{name}"]) != labels:
+            raise RuntimeError(f"{text_path} was exported for different '{name}' categories; re-run `python clip_onnx.py export`")
+        text_embeddings[name] = exported[f"text_{name}"].astype(np.float32)
+    size = int(exported["image_size"])
+    mean = exported["mean"].astype(np.float32)
+    std = exported["std"].astype(np.float32)
+
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = threads
+    options.inter_op_num_threads = 1
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+    input_name = session.get_inputs()[0].name
+
+    def encode(images: List[Image.Image]) -> np.ndarray:
+        pixels = np.stack([preprocess_image(image, size, mean, std) for image in images])
+        embeddings = session.run(None, {input_name: pixels})[0].astype(np.float32)
+        # Quantization can nudge the norm; keep the embeddings unit length for the cosine scores
+        return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+    return encode, text_embeddings
+
+
+def export(output_dir: str, model_name: str = CLIP_MODEL, pretrained: str = CLIP_PRETRAINED, keep_fp32: bool = False) -> None:
+    """Export the image encoder to ONNX, quantize it to INT8 and save the category text embeddings"""
+    import torch
+    import open_clip
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    os.makedirs(output_dir, exist_ok=True)
+    fp32_path = os.path.join(output_dir, FP32_FILENAME)
+    int8_path = os.path.join(output_dir, INT8_FILENAME)
+
+    model, _, _ = open_clip.create_model_and_transforms(model_name, pretrained=pretrained, device="cpu")
+    model.eval()
+    image_size = model.visual.image_size
+    image_size = image_size[0] if isinstance(image_size, (tuple, list)) else image_size
+    mean = getattr(model.visual, "image_mean", None) or open_clip.OPENAI_DATASET_MEAN
+    std = getattr(model.visual, "image_std", None) or open_clip.OPENAI_DATASET_STD
+
+    class ImageEncoder(torch.nn.Module):
+        def __init__(self, clip_model):
+            super().__init__()
+            self.clip_model = clip_model
+
+        def forward(self, pixels):
+            embeddings = self.clip_model.encode_image(pixels)
+            return embeddings / embeddings.norm(dim=-1, keepdim=True)
+
+    export_kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        export_kwargs["dynamo"] = False  # the TorchScript exporter handles dynamic_axes
+    with torch.no_grad():
+        torch.onnx.export(
+            ImageEncoder(model),
+            torch.randn(1, 3, image_size, image_size),
+            fp32_path,
+            input_names=["pixels"],
+            output_names=["embeddings"],
+            dynamic_axes={"pixels": {0: "batch"}, "embeddings": {0: "batch"}},
+            opset_version=ONNX_OPSET,
+            **export_kwargs,
+        )
+    print(f"Exported fp32 image encoder: {fp32_path} ({os.path.getsize(fp32_path) / 1e6:.1f} MB)")
+
+    quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8, op_types_to_quantize=["MatMul", "Gemm"])
+    print(f"Quantized INT8 image encoder: {int8_path} ({os.path.getsize(int8_path) / 1e6:.1f} MB)")
+
+    tokenizer = open_clip.get_tokenizer(model_name)
+    arrays = {"image_size": np.array(image_size), "mean": np.array(mean, dtype=np.float32), "std": np.array(std, dtype=np.float32)}
+    with torch.no_grad():
+        for name, labels in CATEGORY_SETS.items():
+            embeddings = model.encode_text(tokenizer([PROMPT_TEMPLATE.format(label) for label in labels]))
+            embeddings /= embeddings.norm(dim=-1, keepdim=True)
+            arrays[f"text_{name}"] = embeddings.numpy().astype(np.float32)
+            arrays[f"labels_{name}"] = np.array(labels)
+    text_path = os.path.join(output_dir, TEXT_FILENAME)
+    np.savez(text_path, **arrays)
+    print(f"Saved category text embeddings: {text_path}")
+
+    if not keep_fp32:
+        os.remove(fp32_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the CLIP image encoder to INT8 ONNX")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    export_parser = subcommands.add_parser("export")
+    export_parser.add_argument("--output-dir", default=CLIP_ONNX_DIR)
+    export_parser.add_argument("--model", default=CLIP_MODEL)
+    export_parser.add_argument("--pretrained", default=CLIP_PRETRAINED)
+    export_parser.add_argument("--keep-fp32", action="store_true", help="Also keep the fp32 ONNX model (for accuracy comparisons)")
+    args = parser.parse_args()
+    if args.command == "export":
+        export(args.output_dir, args.model, args.pretrained, args.keep_fp32)
+
+
+if __name__ == "__main__":
+    main()
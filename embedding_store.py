@@ -0,0 +1,409 @@
+"""
+Image embedding store and "find similar images" search.
+
+Every successfully analysed image gets one L2-normalized embedding, keyed by its content digest
+(the image_id returned by /analyze-image/):
+  - the CLIP image embedding when CLIP is available (computed by the CLIP workers, micro-batched
+    with tagging requests),
+  - otherwise one derived from the provider's tags and taxonomy ids (hashed character trigrams),
+    which finds images that were tagged alike.
+Each embedding space has its own store, so vectors of different models are never compared.
+
+The vectors and their fixed-width metadata (image id, tags, caption) live in memory-mapped segment
+files (segment_store.py) under EMBEDDING_DIR: opening a store maps the files instead of loading
+them, and all server workers share the pages through the OS page cache. New vectors are appended to
+a preallocated append segment, merged into the base segment every EMBEDDING_SEGMENT_ROWS vectors.
+Appends and merges go through their own mapping of the files, under the directory's writer lock
+only, so lookups and searches keep running while a merge rewrites the base file; they pick up the
+new files on their next refresh, as they would after a merge by another worker.
+Search is an exact vectorized top-k (chunked matrix-vector product and argpartition) up to
+EMBEDDING_ANN_THRESHOLD vectors; above it an IVF index (spherical k-means coarse quantizer,
+EMBEDDING_IVF_NPROBE lists scanned per query) is built in a background thread and rebuilt as the
+collection grows. Vectors added since the last build are scanned exactly.
+EMBEDDING_DTYPE=float16 halves the memory, but every scan then pays a float16 -> float32
+conversion that costs several times the matrix product itself.
+"""
+import asyncio
+import fcntl
+import os
+import re
+import shutil
+import threading
+import time
+import zlib
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+from fastapi.concurrency import run_in_threadpool
+
+from clip_engine import CLIP_MODEL, CLIP_PRETRAINED, get_clip_engine, has_clip
+from segment_store import Segment, SegmentedStore
+from taxonomy import normalize_text, trigram_embedding
+from utils import ImageSource, data_path, read_source
+
+EMBEDDING_DIR = os.getenv("EMBEDDING_DIR") or data_path("embeddings")
+# Rows of the append segment; it is merged into the base segment when full
+EMBEDDING_SEGMENT_ROWS = int(os.getenv("EMBEDDING_SEGMENT_ROWS", "65536"))
+EMBEDDING_DTYPE = np.dtype(os.getenv("EMBEDDING_DTYPE", "float32"))  # float32 or float16
+# Collection size above which searches use the approximate IVF index
+EMBEDDING_ANN_THRESHOLD = int(os.getenv("EMBEDDING_ANN_THRESHOLD", "50000"))
+EMBEDDING_IVF_NPROBE = int(os.getenv("EMBEDDING_IVF_NPROBE", "32"))
+# Rebuild the IVF index once this fraction of vectors has been added since the last build
+EMBEDDING_IVF_REBUILD_GROWTH = float(os.getenv("EMBEDDING_IVF_REBUILD_GROWTH", "0.2"))
+SIMILAR_MAX_K = 100
+TAG_EMBEDDING_DIM = 512
+# Rows per block in exact scans (bounds the temporary float32 copy of a float16 matrix)
+SCAN_CHUNK_ROWS = 65536
+
+# The embedding space new images are recorded in
+EMBEDDING_SPACE = f"clip-{CLIP_MODEL}-{CLIP_PRETRAINED}" if has_clip else "tags-v1"
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k largest scores, best first"""
+    if k >= len(scores):
+        return np.argsort(scores)[::-1]
+    top = np.argpartition(scores, -k)[-k:]
+    return top[np.argsort(scores[top])[::-1]]
+
+
+def scan(matrix: np.ndarray, query: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+    """Dot products of `query` with every row of `matrix` (or the given rows), in float32 chunks"""
+    count = len(matrix) if rows is None else len(rows)
+    scores = np.empty(count, dtype=np.float32)
+    for start in range(0, count, SCAN_CHUNK_ROWS):
+        block = matrix[start:start + SCAN_CHUNK_ROWS] if rows is None else matrix[rows[start:start + SCAN_CHUNK_ROWS]]
+        scores[start:start + len(block)] = block.astype(np.float32, copy=False) @ query
+    return scores
+
+
+def spherical_kmeans(data: np.ndarray, clusters: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """Unit-length centroids of normalized float32 vectors (cosine k-means)"""
+    rng = np.random.default_rng(seed)
+    centroids = data[rng.choice(len(data), clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(data @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, data)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        empty = norms[:, 0] == 0
+        # Re-seed empty clusters with random points
+        sums[empty] = data[rng.choice(len(data), int(empty.sum()), replace=False)]
+        norms[empty] = 1.0
+        centroids = sums / norms
+    return centroids.astype(np.float32)
+
+
+class StackedRows:
+    """Several matrices (the store's segments) addressed as one by global row number. Supports the
+    len(), slice and integer-array indexing that scan() and IVFIndex use."""
+
+    def __init__(self, parts: List[np.ndarray]):
+        self.parts = parts
+        self.starts = np.cumsum([0] + [len(part) for part in parts])
+
+    def __len__(self) -> int:
+        return int(self.starts[-1])
+
+    def __getitem__(self, key) -> np.ndarray:
+        if isinstance(key, slice):
+            start, stop, _ = key.indices(len(self))
+            blocks = [part[max(start - offset, 0):max(stop - offset, 0)]
+                      for part, offset in zip(self.parts, self.starts) if start < offset + len(part) and stop > offset]
+            return blocks[0] if len(blocks) == 1 else np.concatenate(blocks)
+        rows = np.asarray(key)
+        taken = np.empty((len(rows), self.parts[0].shape[1]), dtype=self.parts[0].dtype)
+        for part, offset in zip(self.parts, self.starts):
+            inside = (rows >= offset) & (rows < offset + len(part))
+            taken[inside] = part[rows[inside] - offset]
+        return taken
+
+
+class IVFIndex:
+    """Inverted file index: vectors grouped by their nearest k-means centroid. A query scores the
+    centroids, then only the vectors of the `nprobe` closest lists."""
+
+    def __init__(self, matrix: np.ndarray, seed: int = 0):
+        self.size = len(matrix)
+        self.lists = int(min(4096, max(16, np.sqrt(self.size))))
+        rng = np.random.default_rng(seed)
+        sample = matrix[np.sort(rng.choice(self.size, min(self.size, 64 * self.lists), replace=False))].astype(np.float32)
+        self.centroids = spherical_kmeans(sample, self.lists, seed=seed)
+        assignment = np.empty(self.size, dtype=np.int32)
+        for start in range(0, self.size, SCAN_CHUNK_ROWS):
+            block = matrix[start:start + SCAN_CHUNK_ROWS].astype(np.float32)
+            assignment[start:start + len(block)] = np.argmax(block @ self.centroids.T, axis=1)
+        # Rows grouped by list: rows of list i are order[offsets[i]:offsets[i + 1]]
+        self.order = np.argsort(assignment, kind="stable").astype(np.int64)
+        self.offsets = np.concatenate(([0], np.cumsum(np.bincount(assignment, minlength=self.lists))))
+
+    def candidates(self, query: np.ndarray, nprobe: int) -> np.ndarray:
+        probe = top_k(self.centroids @ query, min(nprobe, self.lists))
+        return np.concatenate([self.order[self.offsets[i]:self.offsets[i + 1]] for i in probe])
+
+    def save(self, directory: str) -> None:
+        """Write the index as .npy files (into a temporary directory renamed into place)"""
+        temporary = f"{directory}.tmp"
+        shutil.rmtree(temporary, ignore_errors=True)
+        os.makedirs(temporary)
+        for name in ("centroids", "order", "offsets"):
+            np.save(os.path.join(temporary, f"{name}.npy"), getattr(self, name))
+        os.rename(temporary, directory)
+
+    @classmethod
+    def load(cls, directory: str) -> "IVFIndex":
+        """Memory-map an index written by save(), sharing its pages with the other workers"""
+        index = cls.__new__(cls)
+        for name in ("centroids", "order", "offsets"):
+            setattr(index, name, np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r"))
+        index.size, index.lists = len(index.order), len(index.centroids)
+        return index
+
+
+class EmbeddingStore:
+    """Embedding matrix and metadata of one embedding space, memory-mapped from segment files"""
+
+    def __init__(self, space: str, directory: Optional[str] = None, dtype: np.dtype = EMBEDDING_DTYPE):
+        self.space = space
+        self.directory = directory or os.path.join(EMBEDDING_DIR, re.sub(r"[^A-Za-z0-9._-]", "_", space))
+        self.dtype = dtype
+        self._segments: Optional[SegmentedStore] = None  # created with the first vector
+        self._writer: Optional[SegmentedStore] = None  # separate mapping for appends and merges
+        self._ivf: Optional[IVFIndex] = None
+        self._building = False
+        self._lock = threading.Lock()
+        self.stats = {"searches": 0, "exact_searches": 0, "ivf_searches": 0, "index_builds": 0, "last_build_seconds": 0.0}
+
+        started = time.perf_counter()
+        if self._open():
+            print(f"Opened embedding store {self.space}: {self.count} vectors in {(time.perf_counter() - started) * 1000:.1f} ms")
+        self._maybe_build_index()
+
+    def _open(self, dim: Optional[int] = None) -> bool:
+        """Map the segment files (creating them when a dimension is given); False if there are none yet"""
+        if self._segments is None and (dim is not None or os.path.exists(os.path.join(self.directory, "base.seg"))):
+            self._segments = SegmentedStore(self.directory, dim or 0, self.dtype, EMBEDDING_SEGMENT_ROWS)
+        return self._segments is not None
+
+    def _rows(self) -> Tuple[List[Segment], StackedRows]:
+        """Current segments (reopened after a merge by any process) and their vectors as one matrix"""
+        with self._lock:
+            if not self._open():
+                return [], StackedRows([])
+            self._segments.refresh()
+            segments = self._segments.segments()
+        return segments, StackedRows([segment.vectors for segment in segments])
+
+    @property
+    def count(self) -> int:
+        return len(self._rows()[1])
+
+    def _find(self, image_id: str) -> Tuple[Optional[Segment], int]:
+        with self._lock:
+            if not self._open():
+                return None, -1
+            self._segments.refresh()
+            return self._segments.find(image_id)
+
+    def has(self, image_id: str) -> bool:
+        return self._find(image_id)[0] is not None
+
+    def vector(self, image_id: str) -> Optional[np.ndarray]:
+        segment, row = self._find(image_id)
+        return None if segment is None else segment.columns["vectors"][row].astype(np.float32)
+
+    def add(self, image_id: str, vector: np.ndarray, metadata: Dict[str, Any]) -> None:
+        vector = np.asarray(vector, dtype=np.float32)
+        vector = vector / (np.linalg.norm(vector) or 1.0)
+        with self._lock:
+            self._open(len(vector))
+            if len(vector) != self._segments.dim:
+                raise ValueError(f"Embedding dimension {len(vector)} does not match {self._segments.dim} in space {self.space}")
+            if self._writer is None:
+                self._writer = SegmentedStore(self.directory, self._segments.dim, self.dtype, EMBEDDING_SEGMENT_ROWS)
+            writer = self._writer
+        # Outside the store lock: a merge rewrites the whole base file. Writers serialize on the
+        # directory lock, and readers see the new rows through the shared mapping or their refresh().
+        writer.add_many([(image_id, vector, metadata.get("tags", []), metadata.get("caption", ""))])
+        self._maybe_build_index()
+
+    # --- IVF index ---
+    # Global row numbers (base rows, then append rows) never change, since merges keep the row order:
+    # an index stays valid as the store grows, and rows past its size are scanned exactly. Indexes are
+    # saved next to the segments so that one worker builds them and the others map the files.
+
+    def _saved_index(self) -> Optional[str]:
+        saved = sorted(name for name in os.listdir(self.directory) if name.startswith("ivf-") and not name.endswith(".tmp"))
+        return os.path.join(self.directory, saved[-1]) if saved else None
+
+    def _maybe_build_index(self) -> None:
+        """Start a background IVF (re)build when the collection crossed the threshold or grew enough"""
+        segments, matrix = self._rows()
+        count = len(matrix)
+        with self._lock:
+            if self._building or count < EMBEDDING_ANN_THRESHOLD:
+                return
+            if self._ivf is not None and count - self._ivf.size < EMBEDDING_IVF_REBUILD_GROWTH * self._ivf.size:
+                return
+            saved = self._saved_index()
+            if saved is not None and (self._ivf is None or int(saved[-10:]) > self._ivf.size):
+                # Built by another worker
+                self._ivf = IVFIndex.load(saved)
+                if count - self._ivf.size < EMBEDDING_IVF_REBUILD_GROWTH * self._ivf.size:
+                    return
+            build_lock = open(os.path.join(self.directory, "ivf.lock"), "a")
+            try:
+                fcntl.flock(build_lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                build_lock.close()  # another worker is building it
+                return
+            self._building = True
+        threading.Thread(target=self._build_index, args=(matrix, build_lock), name=f"ivf-{self.space}", daemon=True).start()
+
+    def _build_index(self, matrix: StackedRows, build_lock) -> None:
+        started = time.perf_counter()
+        try:
+            index = IVFIndex(matrix)
+            previous = self._saved_index()
+            index.save(os.path.join(self.directory, f"ivf-{index.size:010d}"))
+            if previous is not None:
+                # Workers that mapped the old files keep them until they switch
+                shutil.rmtree(previous, ignore_errors=True)
+            with self._lock:
+                self._ivf = index
+                self.stats["index_builds"] += 1
+                self.stats["last_build_seconds"] = round(time.perf_counter() - started, 2)
+            print(f"Built IVF index for {self.space}: {index.size} vectors in {index.lists} lists ({self.stats['last_build_seconds']}s)")
+        except Exception as e:
+            print(f"IVF index build failed for {self.space}: {e}")
+        finally:
+            build_lock.close()
+            with self._lock:
+                self._building = False
+        # Catch up with vectors added during the build
+        self._maybe_build_index()
+
+    def search(self, query: np.ndarray, k: int = 10, exclude: Optional[str] = None, exact: bool = False,
+               nprobe: int = EMBEDDING_IVF_NPROBE) -> Dict[str, Any]:
+        """Top-k most similar images by cosine similarity. Blocking: call from a worker thread."""
+        query = np.asarray(query, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        segments, matrix = self._rows()
+        count, ivf = len(matrix), self._ivf
+        if ivf is not None and ivf.size > count:
+            ivf = None  # the store files were replaced by a smaller store
+        if not count:
+            return {"method": "exact", "results": []}
+
+        wanted = k + (exclude is not None)
+        if ivf is None or exact:
+            rows = np.arange(count)
+            scores = scan(matrix, query)
+            method = "exact"
+        else:
+            # Rows added since the index was built are not in any list yet: scan them exactly
+            rows = np.concatenate((ivf.candidates(query, nprobe), np.arange(ivf.size, count)))
+            scores = scan(matrix, query, rows)
+            method = "ivf"
+        best = top_k(scores, wanted)
+
+        self.stats["searches"] += 1
+        self.stats[f"{method}_searches"] += 1
+        results = []
+        for i in best:
+            row = int(rows[i])
+            part = int(np.searchsorted(matrix.starts, row, side="right")) - 1
+            segment, row = segments[part], row - int(matrix.starts[part])
+            image_id = segment.image_id(row)
+            if image_id == exclude:
+                continue
+            results.append({"image_id": image_id, "score": round(float(scores[i]), 4), **segment.metadata(row)})
+        self._maybe_build_index()
+        return {"method": method, "results": results[:k]}
+
+    def snapshot(self) -> Dict[str, Any]:
+        segments, matrix = self._rows()
+        return {
+            **self.stats,
+            "vectors": len(matrix),
+            "base_vectors": len(segments[0].vectors) if segments else 0,
+            "append_vectors": len(segments[1].vectors) if len(segments) > 1 else 0,
+            "generation": self._segments.append_segment.generation if self._segments else 0,
+            "dimensions": self._segments.dim if self._segments else 0,
+            "dtype": str(self._segments.vector_dtype if self._segments else self.dtype),
+            "mapped_bytes": sum(segment.stat.st_size for segment in segments),
+            "ivf_vectors": self._ivf.size if self._ivf else 0,
+            "ivf_lists": self._ivf.lists if self._ivf else 0,
+            "building": self._building,
+        }
+
+
+_stores: Dict[str, EmbeddingStore] = {}
+_stores_lock = threading.Lock()
+_background: Set[asyncio.Task] = set()
+
+
+def get_embedding_store(space: str = EMBEDDING_SPACE) -> EmbeddingStore:
+    with _stores_lock:
+        if space not in _stores:
+            _stores[space] = EmbeddingStore(space)
+        return _stores[space]
+
+
+def embedding_stats() -> Dict[str, Any]:
+    return {space: store.snapshot() for space, store in list(_stores.items())}
+
+
+def tag_embedding(result: Dict[str, Any], dim: int = TAG_EMBEDDING_DIM) -> np.ndarray:
+    """Provider-derived embedding: trigrams of the tags plus the canonical taxonomy ids, weighted up"""
+    vector = np.zeros(dim, dtype=np.float32)
+    for tag in result.get("tags") or []:
+        vector += trigram_embedding(" ".join(normalize_text(tag)), dim)
+    for concept_id in (result.get("taxonomy") or {}).get("ids", []):
+        vector[zlib.crc32(concept_id.encode()) % dim] += 2.0
+    return vector
+
+
+async def embed(content: Optional[bytes], result: Dict[str, Any]) -> np.ndarray:
+    """Embedding of an analysed image in EMBEDDING_SPACE"""
+    if has_clip:
+        return await get_clip_engine().embed(content)
+    return tag_embedding(result)
+
+
+async def _record(content: Optional[bytes], image_id: str, metadata: Dict[str, Any], result: Dict[str, Any]) -> None:
+    try:
+        vector = await embed(content, result)
+        await run_in_threadpool(get_embedding_store().add, image_id, vector, metadata)
+    except Exception as e:
+        print(f"Could not store embedding for image {image_id[:12]}: {e}")
+
+
+async def record_image(image: ImageSource, image_id: str, result: Dict[str, Any]) -> None:
+    """Store the embedding of a successfully analysed image in the background (once per image)"""
+    # has() takes the store lock and refreshes the segment files
+    if not result.get("success") or await run_in_threadpool(get_embedding_store().has, image_id):
+        return
+    # Read now: an upload's file is closed once the response has been sent
+    content = await run_in_threadpool(read_source, image) if has_clip else None
+    metadata = {"tags": result.get("tags") or [], "caption": result.get("caption", "")}
+    task = asyncio.create_task(_record(content, image_id, metadata, result))
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+
+
+async def find_similar(image_id: Optional[str] = None, image: Optional[bytes] = None, k: int = 10) -> Dict[str, Any]:
+    """Images most similar to a stored image (by image_id) or to an uploaded image"""
+    store = get_embedding_store()
+    k = max(1, min(k, SIMILAR_MAX_K))
+    if image_id is not None:
+        query = await run_in_threadpool(store.vector, image_id)
+        if query is None:
+            return {"success": False, "error": f"Image {image_id} has no stored embedding. Analyse it first."}
+    elif has_clip:
+        query = await get_clip_engine().embed(image)
+    else:
+        return {"success": False, "error": "Searching by upload needs CLIP on the server; pass the image_id of an analysed image instead."}
+    found = await run_in_threadpool(store.search, query, k, image_id)
+    count = await run_in_threadpool(lambda: store.count)
+    return {"success": True, "space": store.space, "count": count, **found}
@@ -0,0 +1,131 @@
+"""
+Multi-provider ensemble analysis.
+
+Runs OpenAI vision and Google Vision on the same image concurrently, then either
+  - "fuse":  waits for both and merges their tags into one ranked list with combined confidence
+             (Google label scores, OpenAI tag position), or
+  - "first": returns whichever provider succeeds first and lets the other finish in the background
+             so its result still lands in the analysis cache.
+Each provider call goes through the normal cached path, so a repeated image costs nothing.
+"""
+import asyncio
+import os
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from analysis import analyze_image, resolve_provider
+from taxonomy import with_taxonomy
+
+ENSEMBLE_MODES = ("fuse", "first")
+# Relative trust in each provider's tags when fusing
+ENSEMBLE_WEIGHTS = {
+    "google": float(os.getenv("ENSEMBLE_GOOGLE_WEIGHT", "0.5")),
+    "openai": float(os.getenv("ENSEMBLE_OPENAI_WEIGHT", "0.5")),
+}
+ENSEMBLE_MAX_TAGS = int(os.getenv("ENSEMBLE_MAX_TAGS", "10"))
+
+# Provider calls still running after a "first" response was sent
+_background: Set[asyncio.Task] = set()
+
+
+def resolve_ensemble(openai_api_key: Optional[str] = None, google_credentials_path: Optional[str] = None) -> Dict[str, str]:
+    """Credentials for every ensemble provider; raises AnalysisRequestError if one is missing"""
+    return dict(resolve_provider(provider, openai_api_key, google_credentials_path) for provider in ("openai", "google"))
+
+
+def normalize_tag(tag: str) -> str:
+    return " ".join(str(tag).casefold().split())
+
+
+def provider_tag_scores(provider: str, result: Dict[str, Any]) -> Dict[str, Tuple[str, float]]:
+    """Map normalized tag -> (display form, confidence in [0, 1]) for one provider's result"""
+    scores: Dict[str, Tuple[str, float]] = {}
+    if provider == "google":
+        for label in (result.get("raw_response") or {}).get("labels", []):
+            scores.setdefault(normalize_tag(label["description"]), (label["description"], float(label.get("score", 0.0))))
+    else:
+        # OpenAI returns tags most-relevant first without scores: decay confidence with position
+        for position, tag in enumerate(result.get("tags") or []):
+            scores.setdefault(normalize_tag(tag), (str(tag), max(0.3, 1.0 - 0.12 * position)))
+    return scores
+
+
+def fuse_tags(results: Dict[str, Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Merge provider tags; a tag's score is the weighted mean of provider confidences (0 when absent)"""
+    per_provider = {provider: provider_tag_scores(provider, result) for provider, result in results.items() if result.get("success")}
+    total_weight = sum(ENSEMBLE_WEIGHTS.get(provider, 0.5) for provider in per_provider) or 1.0
+    fused: Dict[str, Dict[str, Any]] = {}
+    for provider, scores in per_provider.items():
+        weight = ENSEMBLE_WEIGHTS.get(provider, 0.5)
+        for key, (display, confidence) in scores.items():
+            entry = fused.setdefault(key, {"tag": display, "score": 0.0, "sources": {}})
+            entry["score"] += weight * confidence / total_weight
+            entry["sources"][provider] = round(confidence, 4)
+    ranked = sorted(fused.values(), key=lambda entry: entry["score"], reverse=True)[:ENSEMBLE_MAX_TAGS]
+    for entry in ranked:
+        entry["score"] = round(entry["score"], 4)
+    return ranked
+
+
+def fused_result(results: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    succeeded = {provider: result for provider, result in results.items() if result.get("success")}
+    if not succeeded:
+        errors = "; ".join(f"{provider}: {result.get('error')}" for provider, result in results.items())
+        failure = {"success": False, "error": f"All providers failed - {errors}"}
+        retry_hints = [result["retry_after"] for result in results.values() if result.get("retry_after")]
+        if len(retry_hints) == len(results):
+            failure["retry_after"] = min(retry_hints)
+        return failure
+    fused = fuse_tags(succeeded)
+    primary = succeeded.get("openai") or succeeded["google"]
+    return with_taxonomy({
+        "success": True,
+        "tags": [entry["tag"] for entry in fused],
+        "caption": primary.get("caption", ""),
+        "explanation": primary.get("explanation", ""),
+        "raw_response": {
+            "fused_tags": fused,
+            "providers": {provider: result.get("raw_response") for provider, result in succeeded.items()},
+            "errors": {provider: result.get("error") for provider, result in results.items() if not result.get("success")},
+        },
+    })
+
+
+async def analyze_ensemble(
+    image_bytes: bytes,
+    image_digest: str,
+    credentials: Dict[str, str],
+    reuse_similar: bool = True,
+    mode: str = "fuse",
+) -> Tuple[Dict[str, Any], Optional[str], List[str]]:
+    """Analyse with every provider in `credentials` concurrently.
+    Returns (result, combined Cache-Status, providers that contributed)."""
+
+    async def run(provider: str) -> Tuple[str, Dict[str, Any], Optional[str]]:
+        try:
+            result, cache_status = await analyze_image(image_bytes, image_digest, provider, credentials[provider], reuse_similar)
+        except Exception as e:
+            result, cache_status = {"success": False, "error": f"Exception: {str(e)}"}, None
+        return provider, result, cache_status
+
+    tasks = [asyncio.create_task(run(provider)) for provider in credentials]
+
+    if mode == "first":
+        failures: Dict[str, Dict[str, Any]] = {}
+        for completed in asyncio.as_completed(tasks):
+            provider, result, cache_status = await completed
+            if result.get("success"):
+                for task in tasks:
+                    if not task.done():
+                        _background.add(task)
+                        task.add_done_callback(_background.discard)
+                return result, cache_status, [provider]
+            failures[provider] = result
+        return fused_result(failures), None, []
+
+    outcomes = await asyncio.gather(*tasks)
+    results = {provider: result for provider, result, _ in outcomes}
+    cache_status = ", ".join(status for _, _, status in outcomes if status) or None
+    fused = fused_result(results)
+    if fused.get("success"):
+        fused["image_id"] = image_digest
+    return fused, cache_status, [provider for provider, result in results.items() if result.get("success")]
@@ -33,15 +33,19 @@ const ChatPage: React.FC = () => {
     setMessages((prevMessages) => [...prevMessages, userMessage]);
     setStatus('Bella is thinking...');
 
+    const bellaId = Date.now().toString() + '-bella';
+    let reply = '';
+
     try {
-      // Use relative URL that will work both locally and in Cloud Run
-      const response = await fetch('/api/chat', {
+      // Use relative URL that will work both locally and in Cloud Run.
+      // The reply streams in as Server-Sent Events and is rendered as it arrives.
+      const response = await fetch('/api/chat/stream', {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: { 'Content-Type': 'application/json', Accept: 'text/event-stream' },
         body: JSON.stringify({ message: text }),
       });
 
-      if (!response.ok) {
+      if (!response.ok || !response.body) {
         let errorDetail = 'Network response was not ok.';
         try {
           const errorData = await response.json();
@@ -52,14 +56,55 @@ const ChatPage: React.FC = () => {
         throw new Error(errorDetail);
       }
 
-      const data = await response.json();
-      const bellaMessage: Message = {
-        id: Date.now().toString() + '-bella',
-        text: data.reply,
-        sender: 'bella',
-      };
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      let finished = false;
+
+      while (!finished) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        // Events are separated by a blank line: "event: <name>\ndata: <json>\n\n"
+        let boundary = buffer.indexOf('\n\n');
+        while (boundary !== -1) {
+          const frame = buffer.slice(0, boundary);
+          buffer = buffer.slice(boundary + 2);
+          boundary = buffer.indexOf('\n\n');
 
-      setMessages((prevMessages) => [...prevMessages, bellaMessage]);
+          let event = 'message';
+          let data = '';
+          for (const line of frame.split('\n')) {
+            if (line.startsWith('event:')) event = line.slice(6).trim();
+            else if (line.startsWith('data:')) data += line.slice(5).trim();
+          }
+          if (!data) continue;
+          const payload = JSON.parse(data);
+
+          if (event === 'token') {
+            const isFirstToken = reply === '';
+            reply += payload.text;
+            const current = reply;
+            if (isFirstToken) {
+              setMessages((prevMessages) => [...prevMessages, { id: bellaId, text: current, sender: 'bella' }]);
+              setStatus('Bella is typing...');
+            } else {
+              setMessages((prevMessages) =>
+                prevMessages.map((message) => (message.id === bellaId ? { ...message, text: current } : message))
+              );
+            }
+          } else if (event === 'error') {
+            throw new Error(payload.detail);
+          } else if (event === 'done') {
+            finished = true;
+          }
+        }
+      }
+
+      if (reply === '') {
+        throw new Error('Bella did not reply. Please try again.');
+      }
       setStatus('Online');
     } catch (error) {
       console.error("Failed to send message:", error);
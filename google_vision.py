@@ -0,0 +1,291 @@
+"""
+Google Cloud Vision analysis with batched annotate requests and reusable clients.
+
+Labels, web entities and text are requested as features of a single AnnotateImageRequest instead of
+three separate label/web/text detection calls, so each image is uploaded once per analysis. Concurrent
+analyses against the same credentials are packed by GoogleVisionBatcher into one
+batch_annotate_images call (up to GOOGLE_VISION_MAX_BATCH images and GOOGLE_VISION_MAX_BATCH_BYTES of
+image data) and demultiplexed back into the usual tags/caption/explanation/raw_response result shape.
+
+Clients are kept in GoogleClientRegistry, keyed by credentials path and file mtime, so the
+service-account file is parsed, the access token fetched and the gRPC channel opened once per
+credentials file rather than once per request.
+"""
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Set
+
+from fastapi.concurrency import run_in_threadpool
+
+from circuit_breaker import ProviderUnavailableError, get_provider_guard
+from rate_limit import PRIORITY_IMAGE, get_rate_limiter
+from utils import ImageSource, read_source
+
+# Try to import Google Vision - not critical
+try:
+    from google.oauth2 import service_account
+    from google.cloud import vision
+    has_google_vision = True
+except ImportError:
+    has_google_vision = False
+    print("Warning: Google Cloud Vision not installed. Google Vision API will not be available.")
+
+# images:annotate accepts at most 16 images per request
+GOOGLE_VISION_MAX_BATCH = min(int(os.getenv("GOOGLE_VISION_MAX_BATCH", "16")), 16)
+# Raw image bytes per batch_annotate_images call; base64 inflates them by 4/3 and the API rejects
+# request bodies over 10 MB
+GOOGLE_VISION_MAX_BATCH_BYTES = int(os.getenv("GOOGLE_VISION_MAX_BATCH_BYTES", str(7 * 1024 * 1024)))
+# How long a request waits for others to share its batch
+GOOGLE_VISION_BATCH_WINDOW_MS = float(os.getenv("GOOGLE_VISION_BATCH_WINDOW_MS", "20"))
+# Optional endpoint/transport override (e.g. a local fake server with transport "rest")
+GOOGLE_VISION_API_ENDPOINT = os.getenv("GOOGLE_VISION_API_ENDPOINT")
+GOOGLE_VISION_TRANSPORT = os.getenv("GOOGLE_VISION_TRANSPORT")
+# Per-call deadline, so an outage fails the call instead of waiting out the gRPC defaults
+GOOGLE_VISION_TIMEOUT_SECONDS = float(os.getenv("GOOGLE_VISION_TIMEOUT_SECONDS", "30"))
+
+# Clients kept alive at most; idle clients are closed after GOOGLE_CLIENT_IDLE_SECONDS
+GOOGLE_CLIENT_MAX = int(os.getenv("GOOGLE_CLIENT_MAX", "8"))
+GOOGLE_CLIENT_IDLE_SECONDS = float(os.getenv("GOOGLE_CLIENT_IDLE_SECONDS", "900"))
+
+
+def load_credentials(credentials_path: str):
+    return service_account.Credentials.from_service_account_file(credentials_path)
+
+
+def build_client(credentials):
+    """Create an ImageAnnotatorClient (and its channel) for loaded credentials"""
+    client_options = {"api_endpoint": GOOGLE_VISION_API_ENDPOINT} if GOOGLE_VISION_API_ENDPOINT else None
+    return vision.ImageAnnotatorClient(
+        credentials=credentials,
+        transport=GOOGLE_VISION_TRANSPORT,
+        client_options=client_options,
+    )
+
+
+class GoogleClientRegistry:
+    """Process-wide cache of ImageAnnotatorClients (and their credentials and channels).
+
+    Entries are keyed by (absolute credentials path, file mtime): rotating the key file yields a
+    fresh client and closes the stale one. Least-recently-used clients beyond max_clients, and
+    clients idle for longer than idle_seconds, are closed.
+    """
+
+    def __init__(self, max_clients: int = GOOGLE_CLIENT_MAX, idle_seconds: float = GOOGLE_CLIENT_IDLE_SECONDS):
+        self.max_clients = max_clients
+        self.idle_seconds = idle_seconds
+        self._clients: "OrderedDict[tuple, list]" = OrderedDict()  # key -> [client, credentials, last_used]
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "builds": 0, "evictions": 0}
+
+    def get(self, credentials_path: str):
+        return self._entry(credentials_path)[0]
+
+    def _entry(self, credentials_path: str) -> list:
+        path = os.path.abspath(credentials_path)
+        key = (path, os.stat(path).st_mtime_ns)
+        with self._lock:
+            self._evict_idle()
+            entry = self._clients.get(key)
+            if entry is not None:
+                entry[2] = time.monotonic()
+                self._clients.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry
+
+            for stale_key in [k for k in self._clients if k[0] == path]:
+                self._close(stale_key)
+            credentials = load_credentials(path)
+            entry = [build_client(credentials), credentials, time.monotonic()]
+            self._clients[key] = entry
+            self.stats["builds"] += 1
+            while len(self._clients) > self.max_clients:
+                self._close(next(iter(self._clients)))
+            return entry
+
+    def warm(self, credentials_path: str) -> None:
+        """Build the client and fetch an access token up front so the first request is not slow"""
+        _, credentials, _ = self._entry(credentials_path)
+        if not credentials.valid:
+            import google.auth.transport.requests
+            credentials.refresh(google.auth.transport.requests.Request())
+
+    def close_all(self) -> None:
+        with self._lock:
+            for key in list(self._clients):
+                self._close(key)
+
+    def _evict_idle(self) -> None:
+        cutoff = time.monotonic() - self.idle_seconds
+        for key in [k for k, (_, _, last_used) in self._clients.items() if last_used < cutoff]:
+            self._close(key)
+
+    def _close(self, key: tuple) -> None:
+        client = self._clients.pop(key)[0]
+        self.stats["evictions"] += 1
+        try:
+            client.transport.close()
+        except Exception as e:
+            print(f"Error closing Google Vision client: {e}")
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self.stats, "clients": len(self._clients)}
+
+
+_registry: Optional[GoogleClientRegistry] = None
+
+
+def get_google_client_registry() -> GoogleClientRegistry:
+    global _registry
+    if _registry is None:
+        _registry = GoogleClientRegistry()
+    return _registry
+
+
+async def warm_default_google_client() -> None:
+    """Build the client for GOOGLE_APPLICATION_CREDENTIALS and fetch a token (startup warmup)"""
+    credentials_path = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS")
+    if not has_google_vision or not credentials_path or not os.path.exists(credentials_path):
+        return
+    try:
+        await run_in_threadpool(get_google_client_registry().warm, credentials_path)
+        print("Google Vision client warmed up.")
+    except Exception as e:
+        print(f"Warning: could not warm up Google Vision client: {e}")
+
+
+def annotation_features() -> List[Any]:
+    return [
+        vision.Feature(type_=vision.Feature.Type.LABEL_DETECTION, max_results=10),
+        vision.Feature(type_=vision.Feature.Type.WEB_DETECTION),
+        vision.Feature(type_=vision.Feature.Type.TEXT_DETECTION),
+    ]
+
+
+def result_from_annotation(annotation) -> Dict[str, Any]:
+    """Convert one AnnotateImageResponse into the analysis result shape"""
+    if annotation.error and annotation.error.message:
+        return {"success": False, "error": f"Google Vision error {annotation.error.code}: {annotation.error.message}"}
+
+    labels = [
+        {"description": label.description, "score": float(label.score)}
+        for label in annotation.label_annotations[:5]
+    ]
+
+    web_entities = [
+        {"description": entity.description, "score": float(entity.score)}
+        for entity in annotation.web_detection.web_entities
+        if entity.description
+    ][:5]
+
+    text = annotation.text_annotations[0].description if annotation.text_annotations else ""
+
+    caption_parts = [label["description"] for label in labels[:3]] if labels else ["Image"]
+    caption = "Image containing " + ", ".join(caption_parts)
+
+    explanation = "This image was analyzed. "
+    if labels:
+        explanation = f"This image appears to show {', '.join([label['description'] for label in labels[:3]])}. "
+    if web_entities:
+        explanation += f"Web analysis suggests it's related to {', '.join([entity['description'] for entity in web_entities[:3]])}. "
+    if text:
+        explanation += f"The image contains text: '{text[:100]}{'...' if len(text) > 100 else ''}'"
+
+    return {
+        "success": True,
+        "tags": [label["description"] for label in labels],
+        "caption": caption,
+        "explanation": explanation,
+        "raw_response": {"labels": labels, "webEntities": web_entities, "text": text}
+    }
+
+
+def batch_annotate(contents: List[bytes], credentials_path: str) -> List[Dict[str, Any]]:
+    """One batch_annotate_images call (blocking); API errors such as ResourceExhausted propagate"""
+    client = get_google_client_registry().get(credentials_path)
+    features = annotation_features()
+    requests = [vision.AnnotateImageRequest(image=vision.Image(content=content), features=features) for content in contents]
+    response = client.batch_annotate_images(requests=requests, timeout=GOOGLE_VISION_TIMEOUT_SECONDS)
+    return [result_from_annotation(annotation) for annotation in response.responses]
+
+
+class GoogleVisionBatcher:
+    """Packs concurrent single-image analyses into shared batch_annotate_images requests.
+
+    Requests are grouped per credentials path; a group is flushed when it reaches
+    GOOGLE_VISION_MAX_BATCH images or GOOGLE_VISION_BATCH_WINDOW_MS after its first image arrived,
+    and before an image would take it over GOOGLE_VISION_MAX_BATCH_BYTES (an image larger than that
+    on its own is sent alone).
+    """
+
+    def __init__(self, max_batch: int = GOOGLE_VISION_MAX_BATCH, window_ms: float = GOOGLE_VISION_BATCH_WINDOW_MS,
+                 max_batch_bytes: int = GOOGLE_VISION_MAX_BATCH_BYTES):
+        self.max_batch = max_batch
+        self.max_batch_bytes = max_batch_bytes
+        self.window = window_ms / 1000
+        self._pending: Dict[str, List[Any]] = {}  # credentials path -> [(content, future, priority)]
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._running: Set[asyncio.Task] = set()
+        self.stats = {"requests": 0, "images": 0}
+
+    async def analyze(self, image_source: ImageSource, credentials_path: str, priority: int = PRIORITY_IMAGE) -> Dict[str, Any]:
+        content = await run_in_threadpool(read_source, image_source)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        group = self._pending.get(credentials_path)
+        if group and sum(len(queued) for queued, _, _ in group) + len(content) > self.max_batch_bytes:
+            self._flush(credentials_path)
+        group = self._pending.setdefault(credentials_path, [])
+        group.append((content, future, priority))
+        if len(group) >= self.max_batch or sum(len(queued) for queued, _, _ in group) >= self.max_batch_bytes:
+            self._flush(credentials_path)
+        elif credentials_path not in self._timers:
+            self._timers[credentials_path] = loop.call_later(self.window, self._flush, credentials_path)
+        return await future
+
+    def _flush(self, credentials_path: str) -> None:
+        timer = self._timers.pop(credentials_path, None)
+        if timer is not None:
+            timer.cancel()
+        group = self._pending.pop(credentials_path, [])
+        if group:
+            task = asyncio.ensure_future(self._run(group, credentials_path))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run(self, group: List[Any], credentials_path: str) -> None:
+        self.stats["requests"] += 1
+        self.stats["images"] += len(group)
+        contents = [content for content, _, _ in group]
+        try:
+            # Quota is counted in images; the batch is scheduled at its most urgent member's priority.
+            # The blocking call runs on Google Vision's own bounded thread pool behind its circuit breaker.
+            results = await get_rate_limiter("google", credentials_path).run(
+                lambda: get_provider_guard("google_vision").run_blocking(batch_annotate, contents, credentials_path),
+                priority=min(priority for _, _, priority in group),
+                requests=len(group),
+            )
+        except ProviderUnavailableError as e:
+            results = [{"success": False, "error": str(e), "retry_after": e.retry_after} for _ in group]
+        except Exception as e:
+            results = [{"success": False, "error": f"Exception: {str(e)}"} for _ in group]
+        for (_, future, _), result in zip(group, results):
+            if not future.done():
+                future.set_result(result)
+        # A response with fewer results than images must not leave the remaining callers waiting
+        for _, future, _ in group[len(results):]:
+            if not future.done():
+                future.set_result({"success": False, "error": "Google Vision returned no result for this image"})
+
+
+_batcher: Optional[GoogleVisionBatcher] = None
+
+
+def get_google_batcher() -> GoogleVisionBatcher:
+    global _batcher
+    if _batcher is None:
+        _batcher = GoogleVisionBatcher()
+    return _batcher
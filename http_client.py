@@ -0,0 +1,49 @@
+"""
+Shared async HTTP client for outbound provider calls (OpenAI REST API)
+"""
+import os
+from typing import Optional
+
+import httpx
+
+# Base URL for the OpenAI REST API. Override to point at a proxy or a local fake server.
+OPENAI_API_BASE = os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1").rstrip("/")
+
+# Connection pool sizing - one worker keeps many vision calls in flight over a few keep-alive connections
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+HTTP_TIMEOUT_SECONDS = float(os.getenv("HTTP_TIMEOUT_SECONDS", "60"))
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+def create_http_client() -> httpx.AsyncClient:
+    """Build a pooled AsyncClient with keep-alive connections"""
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+        ),
+        timeout=httpx.Timeout(HTTP_TIMEOUT_SECONDS, connect=10.0),
+    )
+
+
+def start_http_client() -> httpx.AsyncClient:
+    """Create the process-wide client (called on app startup)"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = create_http_client()
+    return _client
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Return the shared client, creating it lazily if startup did not run (scripts, benchmarks)"""
+    return start_http_client()
+
+
+async def close_http_client() -> None:
+    """Close the shared client and its pooled connections (called on app shutdown)"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
@@ -0,0 +1,105 @@
+"""
+Image preprocessing before sending uploads to a vision provider.
+
+Camera uploads are often 10-20 MB JPEGs or PNGs. GPT-4o downsamples them on its side anyway, so
+shipping the original only inflates request size, upload time and token cost. This stage applies
+the EXIF orientation, downscales to a configurable longest edge and re-encodes to JPEG or WebP.
+"""
+import os
+import threading
+from io import BytesIO
+from typing import Any, Dict, Tuple
+
+from PIL import Image, ImageOps
+
+# Longest edge sent to OpenAI - "high" detail tiles are computed after fitting into 2048x2048
+OPENAI_IMAGE_MAX_EDGE = int(os.getenv("OPENAI_IMAGE_MAX_EDGE", "2048"))
+OPENAI_IMAGE_FORMAT = os.getenv("OPENAI_IMAGE_FORMAT", "JPEG").upper()  # JPEG or WEBP
+OPENAI_IMAGE_QUALITY = int(os.getenv("OPENAI_IMAGE_QUALITY", "85"))
+# Images whose longest edge fits in a single 512px tile gain nothing from "high" detail
+OPENAI_LOW_DETAIL_MAX_EDGE = int(os.getenv("OPENAI_LOW_DETAIL_MAX_EDGE", "512"))
+
+MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png", "GIF": "image/gif"}
+
+_stats_lock = threading.Lock()
+PREPROCESS_STATS = {"images": 0, "original_bytes": 0, "sent_bytes": 0, "passthrough": 0}
+
+
+def choose_detail(width: int, height: int) -> str:
+    """Pick the OpenAI image detail level from the (processed) image size"""
+    return "low" if max(width, height) <= OPENAI_LOW_DETAIL_MAX_EDGE else "high"
+
+
+def orient_and_fit(source: Image.Image, max_edge: int) -> Tuple[Image.Image, bool]:
+    """Apply the EXIF orientation and downscale to max_edge; returns (picture, resized)"""
+    if max(source.size) > max_edge and source.format == "JPEG":
+        source.draft("RGB", (max_edge, max_edge))  # decode at a reduced scale directly
+    picture = ImageOps.exif_transpose(source)
+    resized = max(picture.size) > max_edge
+    if resized:
+        picture.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+    return picture, resized
+
+
+def encode_picture(picture: Image.Image, image_format: str, quality: int) -> bytes:
+    """Re-encode a decoded image, flattening transparency onto white for JPEG"""
+    if image_format == "JPEG" and picture.mode not in ("RGB", "L"):
+        background = Image.new("RGB", picture.size, (255, 255, 255))
+        rgba = picture.convert("RGBA")
+        background.paste(rgba, mask=rgba.getchannel("A"))
+        picture = background
+    elif picture.mode not in ("RGB", "RGBA", "L"):
+        picture = picture.convert("RGBA" if "A" in picture.getbands() else "RGB")
+    buffer = BytesIO()
+    picture.save(buffer, format=image_format, quality=quality, optimize=True)
+    return buffer.getvalue()
+
+
+def prepare_picture(
+    source: Image.Image,
+    original_size: int,
+    max_edge: int = OPENAI_IMAGE_MAX_EDGE,
+    image_format: str = OPENAI_IMAGE_FORMAT,
+    quality: int = OPENAI_IMAGE_QUALITY,
+) -> Dict[str, Any]:
+    """Orient, downscale (orient_and_fit) and re-encode (encode_picture) an opened image for a
+    vision provider. CPU-bound: preprocess_pool.py runs it in a worker process.
+
+    Returns a dict with the bytes to send, their MIME type, the final size and the suggested OpenAI
+    detail level. "bytes" is None (with "passthrough" set) when re-encoding would not make the image
+    smaller and no resize or rotation was needed: the original bytes should be sent as they are."""
+    source_format = source.format
+    exif_orientation = source.getexif().get(0x0112, 1)
+    picture, resized = orient_and_fit(source, max_edge)
+    encoded = encode_picture(picture, image_format, quality)
+    width, height = picture.size
+    passthrough = (
+        not resized
+        and exif_orientation == 1
+        and source_format in MIME_TYPES
+        and len(encoded) >= original_size
+    )
+    return {
+        "bytes": None if passthrough else encoded,
+        "mime_type": MIME_TYPES[source_format] if passthrough else MIME_TYPES[image_format],
+        "width": width,
+        "height": height,
+        "original_bytes": original_size,
+        "passthrough": passthrough,
+        "detail": choose_detail(width, height),
+    }
+
+
+def record_prepared(prepared: Dict[str, Any]) -> None:
+    """Count a prepared image in the preprocessing stats (bytes filled in)"""
+    prepared["bytes_saved"] = prepared["original_bytes"] - len(prepared["bytes"])
+    with _stats_lock:
+        PREPROCESS_STATS["images"] += 1
+        PREPROCESS_STATS["original_bytes"] += prepared["original_bytes"]
+        PREPROCESS_STATS["sent_bytes"] += len(prepared["bytes"])
+        PREPROCESS_STATS["passthrough"] += int(prepared["passthrough"])
+
+
+def preprocess_stats() -> Dict[str, int]:
+    with _stats_lock:
+        return {**PREPROCESS_STATS, "bytes_saved": PREPROCESS_STATS["original_bytes"] - PREPROCESS_STATS["sent_bytes"]}
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""
+Incremental ingestion of an image folder tree (the local stand-in for a storage bucket).
+
+A crawl walks the tree with INGEST_WORKERS threads (one os.scandir per directory, so stat data
+comes from the directory listing) and compares every image - and every zip archive of images -
+with the manifest of path, size, mtime and SHA-256 content hash kept for earlier crawls:
+  - unchanged size and mtime: skipped without being read,
+  - new or changed: hashed (in parallel); if the content hash still matches the manifest (a touched
+    file) only the manifest is updated, otherwise the file is enqueued for analysis,
+  - gone from the tree: dropped from the manifest,
+  - unchanged, but an item analysed from it in the previous job failed for good (provider outage,
+    quota, retries used up): enqueued again, so a failure is not remembered as "already ingested".
+New and changed files are submitted as one background job (jobs.py), read in place from the tree;
+zip archives are expanded into the job's own directory. Re-crawling an unchanged tree therefore
+reads no file content and makes no provider calls.
+
+    python ingest.py /mnt/archive --model openai [--dry-run]
+
+The CLI enqueues into the job database the server's job workers poll (they use the provider
+credentials from the server environment). POST /ingest does the same for directories under
+INGEST_ROOTS.
+"""
+import argparse
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Dict, List, Optional, Tuple
+
+from batch import IMAGE_EXTENSIONS, iter_zip_images
+from jobs import JobStore, get_job_queue, persist_job_files
+from uploads import hash_file
+from utils import data_path, ensure_parent_dir
+
+INGEST_DB = os.getenv("INGEST_DB") or data_path("ingest.sqlite3")
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "8"))
+# Directories POST /ingest may crawl (os.pathsep-separated); the endpoint is disabled when unset
+INGEST_ROOTS = [os.path.realpath(root) for root in os.getenv("INGEST_ROOTS", "").split(os.pathsep) if root]
+
+
+def scan_directory(path: str) -> Tuple[List[Tuple[str, int, int]], List[str]]:
+    """(files as (path, size, mtime_ns), subdirectories) of one directory"""
+    files, directories = [], []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS + (".zip",)):
+                    stat = entry.stat()
+                    files.append((entry.path, stat.st_size, stat.st_mtime_ns))
+    except OSError as e:
+        print(f"Ingest: cannot scan {path}: {e}")
+    return files, directories
+
+
+def walk_parallel(root: str, pool: ThreadPoolExecutor) -> List[Tuple[str, int, int]]:
+    """All candidate files under root, scanning directories concurrently"""
+    found: List[Tuple[str, int, int]] = []
+    pending = {pool.submit(scan_directory, root)}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            files, directories = future.result()
+            found.extend(files)
+            pending.update(pool.submit(scan_directory, directory) for directory in directories)
+    return found
+
+
+def hash_path(path: str) -> Optional[str]:
+    try:
+        with open(path, "rb") as f:
+            return hash_file(f)[0]
+    except OSError as e:
+        print(f"Ingest: cannot read {path}: {e}")
+        return None
+
+
+class Manifest:
+    """path -> (size, mtime_ns, sha256, id of the last job it was enqueued in) of every file seen by earlier crawls"""
+
+    def __init__(self, db_path: str = INGEST_DB):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(ensure_parent_dir(db_path), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS ingest_manifest ("
+            " path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, digest TEXT NOT NULL,"
+            " job_id TEXT, updated_at REAL NOT NULL)"
+        )
+        self._db.commit()
+
+    def entries_under(self, root: str) -> Dict[str, Tuple[int, int, str, Optional[str]]]:
+        # Range scan on the primary key: every path that starts with root + separator
+        prefix = root.rstrip(os.sep) + os.sep
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT path, size, mtime_ns, digest, job_id FROM ingest_manifest WHERE path >= ? AND path < ?",
+                (prefix, prefix[:-1] + chr(ord(os.sep) + 1)),
+            ).fetchall()
+        return {path: (size, mtime_ns, digest, job_id) for path, size, mtime_ns, digest, job_id in rows}
+
+    def update(self, rows: List[Tuple[str, int, int, str, Optional[str]]], removed: List[str]) -> None:
+        now = time.time()
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT INTO ingest_manifest (path, size, mtime_ns, digest, job_id, updated_at) VALUES (?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT(path) DO UPDATE SET size = excluded.size, mtime_ns = excluded.mtime_ns,"
+                " digest = excluded.digest, job_id = COALESCE(excluded.job_id, job_id), updated_at = excluded.updated_at",
+                [row + (now,) for row in rows],
+            )
+            self._db.executemany("DELETE FROM ingest_manifest WHERE path = ?", [(path,) for path in removed])
+
+
+def crawl(root: str, manifest: Manifest, jobs: Optional[JobStore] = None, workers: int = INGEST_WORKERS) -> Dict[str, Any]:
+    """Walk root and classify every file against the manifest (blocking). Returns the summary
+    counts plus "changed": [(path, size, mtime_ns, digest)] of files that need analysing. With
+    `jobs`, unchanged files whose last job failed them are included again ("retried")."""
+    root = os.path.realpath(root)
+    if not os.path.isdir(root):
+        raise ValueError(f"Not a directory: {root}")
+    started = time.perf_counter()
+    known = manifest.entries_under(root)
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="ingest") as pool:
+        files = walk_parallel(root, pool)
+        candidates = [(path, size, mtime_ns) for path, size, mtime_ns in files
+                      if known.get(path, (None, None))[:2] != (size, mtime_ns)]
+        digests = list(pool.map(hash_path, [path for path, _, _ in candidates]))
+
+    # Files whose item in the job they were last enqueued in failed for good
+    failed_pairs = jobs.failed_sources({entry[3] for entry in known.values() if entry[3]}) if jobs else set()
+    failed = {path for job_id, path in failed_pairs if known.get(path, (None,) * 4)[3] == job_id}
+    changed, touched, retried, new = [], [], [], 0
+    for (path, size, mtime_ns), digest in zip(candidates, digests):
+        if digest is None:
+            continue
+        previous = known.get(path)
+        if previous is not None and previous[2] == digest:
+            (retried if path in failed else touched).append((path, size, mtime_ns, digest))
+        else:
+            new += previous is None
+            changed.append((path, size, mtime_ns, digest))
+    seen = {path for path, _, _ in files}
+    candidate_paths = {path for path, _, _ in candidates}
+    failed_unchanged = [(path, size, mtime_ns, known[path][2]) for path, size, mtime_ns in files
+                        if path in failed and path not in candidate_paths]
+    retried.extend(failed_unchanged)
+    modified = len(changed) - new
+    changed.extend(retried)
+    removed = [path for path in known if path not in seen]
+    return {
+        "root": root,
+        "scanned": len(files),
+        "unchanged": len(files) - len(candidates) - len(failed_unchanged),
+        "new": new,
+        "modified": modified,
+        "retried": len(retried),
+        "touched": len(touched),
+        "removed": removed,
+        "unreadable": sum(digest is None for digest in digests),
+        "changed": changed,
+        "touched_files": touched,
+        "scan_seconds": round(time.perf_counter() - started, 3),
+    }
+
+
+def job_items(root: str, job_id: str, changed: List[Tuple[str, int, int, str]]) -> List[Dict[str, Any]]:
+    """Job items for the changed files: images in place, zip archives expanded into the job directory"""
+    items, archives = [], []
+    for path, _, _, digest in changed:
+        filename = os.path.relpath(path, root)
+        if path.lower().endswith(".zip"):
+            archives.append((path, filename))
+        else:
+            items.append({"filename": filename, "path": path, "digest": digest, "source": path})
+    for path, filename in archives:
+        with open(path, "rb") as f:
+            extracted = persist_job_files(f"{job_id}/{len(items):06d}", iter_zip_images(f, filename))
+        items.extend({**item, "source": path} for item in extracted)
+    return items
+
+
+def ingest(root: str, provider: str, reuse_similar: bool = True, dry_run: bool = False) -> Dict[str, Any]:
+    """Crawl root, enqueue new and changed files as one job and record the manifest (blocking).
+    The manifest is only updated once the job is stored, so an interrupted run is simply repeated."""
+    manifest = get_manifest()
+    store = get_job_queue().store
+    summary = crawl(root, manifest, store)
+    changed, touched, removed = summary.pop("changed"), summary.pop("touched_files"), summary.pop("removed")
+    summary.update(removed=len(removed), enqueued=0, job_id=None)
+    if dry_run:
+        return summary
+    if changed:
+        job_id = uuid.uuid4().hex
+        items = job_items(summary["root"], job_id, changed)
+        store.create_job(job_id, provider, reuse_similar, items)
+        summary.update(enqueued=len(items), job_id=job_id)
+    manifest.update([row + (summary["job_id"],) for row in changed] + [row + (None,) for row in touched], removed)
+    return summary
+
+
+_manifest: Optional[Manifest] = None
+
+
+def get_manifest() -> Manifest:
+    global _manifest
+    if _manifest is None:
+        _manifest = Manifest()
+    return _manifest
+
+
+def allowed_root(root: str) -> bool:
+    """Whether POST /ingest may crawl this directory"""
+    root = os.path.realpath(root)
+    return any(root == allowed or root.startswith(allowed + os.sep) for allowed in INGEST_ROOTS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Enqueue new and changed images under a directory for analysis")
+    parser.add_argument("root")
+    parser.add_argument("--model", default="openai", choices=["openai", "google", "clip"])
+    parser.add_argument("--no-reuse-similar", action="store_true", help="Do not reuse analyses of near-duplicate images")
+    parser.add_argument("--dry-run", action="store_true", help="Report what would be enqueued without recording anything")
+    args = parser.parse_args()
+
+    summary = ingest(args.root, args.model, not args.no_reuse_similar, args.dry_run)
+    print(f"Scanned {summary['scanned']} files in {summary['scan_seconds']}s: {summary['new']} new, {summary['modified']} modified, "
+          f"{summary['unchanged']} unchanged, {summary['touched']} touched, {summary['removed']} removed, "
+          f"{summary['retried']} retried after a failed analysis")
+    if summary["job_id"]:
+        print(f"Enqueued {summary['enqueued']} images as job {summary['job_id']} (poll /jobs/{summary['job_id']})")
+
+
+if __name__ == "__main__":
+    main()
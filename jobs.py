@@ -0,0 +1,318 @@
+"""
+Persistent background job queue for large image-analysis batches.
+
+Local stand-in for the Celery + Redis task queue described in mvp2.md: jobs and their items live in
+a SQLite database in WAL mode, uploaded images are copied under DATA_DIR/jobs/<job id>/ (files found
+by ingest.py are read in place), and a pool of asyncio workers claims pending items, analyses them
+through the cached provider path and records per-item results. Failed items are retried with exponential backoff up to JOB_MAX_ATTEMPTS.
+
+Items that were in flight when the process stopped are requeued on startup; completed items are
+never analysed again. API keys passed at submission are held in memory only - after a restart the
+remaining items use the credentials from the environment. The startup requeue assumes a single
+process owns the queue, which matches the Dockerfile's single uvicorn worker.
+"""
+import asyncio
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from fastapi import UploadFile
+from fastapi.concurrency import run_in_threadpool
+
+from analysis import AnalysisRequestError, analyze_image, resolve_provider
+from batch import iter_batch_images, provider_semaphore
+from rate_limit import PRIORITY_BATCH
+from utils import DATA_DIR, data_path, ensure_parent_dir
+
+JOBS_DB = os.getenv("JOBS_DB") or data_path("jobs.sqlite3")
+JOB_FILES_DIR = os.path.join(DATA_DIR, "jobs")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETRY_BASE_SECONDS = float(os.getenv("JOB_RETRY_BASE_SECONDS", "2"))
+JOB_POLL_SECONDS = 1.0
+
+
+def is_job_file(path: Optional[str]) -> bool:
+    return bool(path) and os.path.abspath(path).startswith(os.path.abspath(JOB_FILES_DIR) + os.sep)
+
+
+def persist_job_files(job_id: str, entries: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Copy iter_batch_images() entries under JOB_FILES_DIR/<job id>/ and return the job items (blocking)"""
+    job_dir = os.path.join(JOB_FILES_DIR, job_id)
+    os.makedirs(job_dir, exist_ok=True)
+    items = []
+    for seq, item in enumerate(entries):
+        if "error" not in item:
+            path = os.path.join(job_dir, f"{seq:06d}")
+            with open(path, "wb") as f:
+                item["file"].seek(0)
+                shutil.copyfileobj(item["file"], f)
+            if item["owned"]:
+                item["file"].close()
+            item = {"filename": item["filename"], "path": path, "digest": item["digest"]}
+        items.append(item)
+    return items
+
+
+class JobStore:
+    """SQLite-backed storage of jobs and their items (thread-safe, blocking)"""
+
+    def __init__(self, db_path: str = JOBS_DB):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(ensure_parent_dir(db_path), check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                provider TEXT NOT NULL,
+                reuse_similar INTEGER NOT NULL,
+                total INTEGER NOT NULL,
+                created_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS job_items (
+                job_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                filename TEXT,
+                path TEXT,
+                digest TEXT,
+                source TEXT,  -- the crawled file an ingested item came from (ingest.py)
+                status TEXT NOT NULL,  -- pending, running, done, failed
+                attempts INTEGER NOT NULL DEFAULT 0,
+                not_before REAL NOT NULL DEFAULT 0,
+                finished_order INTEGER,
+                result TEXT,
+                error TEXT,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (job_id, seq)
+            );
+            CREATE INDEX IF NOT EXISTS job_items_pending ON job_items (status, not_before);
+            CREATE INDEX IF NOT EXISTS job_items_finished ON job_items (job_id, finished_order);
+            """
+        )
+        self._db.commit()
+
+    def create_job(self, job_id: str, provider: str, reuse_similar: bool, items: List[Dict[str, Any]]) -> None:
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO jobs (id, provider, reuse_similar, total, created_at) VALUES (?, ?, ?, ?, ?)",
+                (job_id, provider, int(reuse_similar), len(items), now),
+            )
+            self._db.executemany(
+                "INSERT INTO job_items (job_id, seq, filename, path, digest, source, status, error, finished_order, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (job_id, seq, item["filename"], item.get("path"), item.get("digest"), item.get("source"),
+                     "failed" if item.get("error") else "pending", item.get("error"), None, now)
+                    for seq, item in enumerate(items)
+                ],
+            )
+            # Items rejected at submission (bad zip member, too large) are finished immediately
+            self._db.execute(
+                "UPDATE job_items SET finished_order = seq + 1 WHERE job_id = ? AND status = 'failed'", (job_id,)
+            )
+
+    def requeue_interrupted(self) -> int:
+        """Return items left 'running' by a previous process to the queue"""
+        with self._lock, self._db:
+            return self._db.execute("UPDATE job_items SET status = 'pending' WHERE status = 'running'").rowcount
+
+    def claim_next(self) -> Optional[sqlite3.Row]:
+        """Atomically mark the oldest due pending item as running and return it"""
+        with self._lock, self._db:
+            return self._db.execute(
+                "UPDATE job_items SET status = 'running', attempts = attempts + 1, updated_at = ?"
+                " WHERE rowid = (SELECT job_items.rowid FROM job_items JOIN jobs ON jobs.id = job_items.job_id"
+                "   WHERE status = 'pending' AND not_before <= ? ORDER BY jobs.created_at, seq LIMIT 1)"
+                " RETURNING job_id, seq, filename, path, digest, attempts,"
+                "   (SELECT provider FROM jobs WHERE id = job_id) AS provider,"
+                "   (SELECT reuse_similar FROM jobs WHERE id = job_id) AS reuse_similar",
+                (time.time(), time.time()),
+            ).fetchone()
+
+    def finish_item(self, job_id: str, seq: int, status: str, result: Optional[Dict[str, Any]], error: Optional[str]) -> None:
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE job_items SET status = ?, result = ?, error = ?, updated_at = ?,"
+                " finished_order = (SELECT COALESCE(MAX(finished_order), 0) + 1 FROM job_items WHERE job_id = ?)"
+                " WHERE job_id = ? AND seq = ?",
+                (status, json.dumps(result) if result is not None else None, error, time.time(), job_id, job_id, seq),
+            )
+
+    def retry_item(self, job_id: str, seq: int, error: str, delay: float) -> None:
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE job_items SET status = 'pending', error = ?, not_before = ?, updated_at = ? WHERE job_id = ? AND seq = ?",
+                (error, time.time() + delay, time.time(), job_id, seq),
+            )
+
+    def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            job = self._db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if job is None:
+                return None
+            counts = dict(self._db.execute(
+                "SELECT status, COUNT(*) FROM job_items WHERE job_id = ? GROUP BY status", (job_id,)
+            ).fetchall())
+            updated_at = self._db.execute("SELECT MAX(updated_at) FROM job_items WHERE job_id = ?", (job_id,)).fetchone()[0]
+        finished = counts.get("done", 0) + counts.get("failed", 0)
+        return {
+            "job_id": job_id,
+            "status": "completed" if finished == job["total"] else ("running" if finished or counts.get("running") else "queued"),
+            "provider": job["provider"],
+            "total": job["total"],
+            "succeeded": counts.get("done", 0),
+            "failed": counts.get("failed", 0),
+            "running": counts.get("running", 0),
+            "pending": counts.get("pending", 0),
+            "progress": round(finished / job["total"], 4) if job["total"] else 1.0,
+            "created_at": job["created_at"],
+            "updated_at": updated_at,
+        }
+
+    def get_results(self, job_id: str, cursor: int, limit: int) -> Dict[str, Any]:
+        """Finished items in completion order after `cursor`; pass next_cursor back to continue"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT seq, filename, status, attempts, result, error, finished_order FROM job_items"
+                " WHERE job_id = ? AND finished_order > ? ORDER BY finished_order LIMIT ?",
+                (job_id, cursor, limit),
+            ).fetchall()
+        items = [
+            {
+                "index": row["seq"],
+                "filename": row["filename"],
+                "success": row["status"] == "done",
+                "attempts": row["attempts"],
+                "error": row["error"] if row["status"] == "failed" else None,
+                **(json.loads(row["result"]) if row["result"] else {}),
+            }
+            for row in rows
+        ]
+        return {"items": items, "next_cursor": rows[-1]["finished_order"] if rows else cursor}
+
+    def failed_sources(self, job_ids: Iterable[str]) -> Set[Tuple[str, str]]:
+        """(job id, source file) of the given jobs' items that failed after being analysed (items
+        rejected at submission, such as a corrupt zip, are not retried)"""
+        job_ids = list(job_ids)
+        sources: Set[Tuple[str, str]] = set()
+        with self._lock:
+            # Chunked to stay under SQLite's bound-parameter limit
+            for start in range(0, len(job_ids), 500):
+                chunk = job_ids[start:start + 500]
+                sources.update(tuple(row) for row in self._db.execute(
+                    "SELECT DISTINCT job_id, source FROM job_items WHERE status = 'failed' AND attempts > 0 AND source IS NOT NULL"
+                    f" AND job_id IN ({', '.join('?' * len(chunk))})",
+                    chunk,
+                ))
+        return sources
+
+    def queue_depth(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._db.execute("SELECT status, COUNT(*) FROM job_items GROUP BY status").fetchall())
+
+
+class JobQueue:
+    """Accepts job submissions and runs a pool of workers over the JobStore"""
+
+    def __init__(self, store: JobStore, workers: int = JOB_WORKERS):
+        self.store = store
+        self.workers = workers
+        self._credentials: Dict[str, str] = {}  # job id -> credential passed at submission (memory only)
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup = asyncio.Event()
+
+    async def submit(self, uploads: List[UploadFile], provider: str, credential: str, reuse_similar: bool = True) -> Dict[str, Any]:
+        """Persist the uploaded images (expanding zips) and enqueue one item per image"""
+        job_id = uuid.uuid4().hex
+        items = await run_in_threadpool(persist_job_files, job_id, iter_batch_images(uploads))
+        await run_in_threadpool(self.store.create_job, job_id, provider, reuse_similar, items)
+        self._credentials[job_id] = credential
+        self._wakeup.set()
+        return {"job_id": job_id, "total": len(items)}
+
+    def register(self, job_id: str, credential: Optional[str]) -> None:
+        """Hand the workers a job stored directly in the JobStore (e.g. by ingest.py)"""
+        if credential:
+            self._credentials[job_id] = credential
+        self._wakeup.set()
+
+    def start(self) -> None:
+        requeued = self.store.requeue_interrupted()
+        if requeued:
+            print(f"Job queue: requeued {requeued} interrupted item(s)")
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Anything cancelled mid-flight goes back to the queue for the next process
+        await run_in_threadpool(self.store.requeue_interrupted)
+
+    async def _worker(self) -> None:
+        while True:
+            item = await run_in_threadpool(self.store.claim_next)
+            if item is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=JOB_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._process(item)
+
+    async def _process(self, item: sqlite3.Row) -> None:
+        job_id, seq = item["job_id"], item["seq"]
+        retryable = True
+        retry_after = 0
+        try:
+            provider, credential = resolve_provider(item["provider"], *self._credential_args(job_id, item["provider"]))
+            async with provider_semaphore(provider):
+                with open(item["path"], "rb") as image_file:
+                    result, _ = await analyze_image(image_file, item["digest"], provider, credential, bool(item["reuse_similar"]), PRIORITY_BATCH)
+            error = None if result.get("success") else result.get("error", "Analysis failed")
+            retry_after = result.get("retry_after", 0)
+        except AnalysisRequestError as e:
+            result, error, retryable = None, str(e), False
+        except Exception as e:
+            result, error = None, f"Exception: {str(e)}"
+
+        if error is None:
+            await run_in_threadpool(self.store.finish_item, job_id, seq, "done", result, None)
+        elif retryable and item["attempts"] < JOB_MAX_ATTEMPTS:
+            # Wait at least as long as an unavailable provider asked for
+            delay = max(JOB_RETRY_BASE_SECONDS * 2 ** (item["attempts"] - 1), retry_after)
+            await run_in_threadpool(self.store.retry_item, job_id, seq, error, delay)
+            return
+        else:
+            await run_in_threadpool(self.store.finish_item, job_id, seq, "failed", None, error)
+        # Only the queue's own copies are deleted; ingested files are read in place
+        if is_job_file(item["path"]):
+            try:
+                os.remove(item["path"])
+            except OSError:
+                pass
+
+    def _credential_args(self, job_id: str, provider: str):
+        credential = self._credentials.get(job_id)
+        return (credential, None) if provider == "openai" else (None, credential)
+
+
+_queue: Optional[JobQueue] = None
+
+
+def get_job_queue() -> JobQueue:
+    global _queue
+    if _queue is None:
+        _queue = JobQueue(JobStore())
+    return _queue
@@ -4,20 +4,53 @@ Skypad Image Tagging & Explanation - FastAPI Application
 """
 import os
 import sys
+import asyncio
 import json
+import math
+import time
 import warnings
 from io import BytesIO
+from contextlib import asynccontextmanager
 from PIL import Image
-import requests
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Request
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware # Import CORS middleware
 import openai
 from dotenv import load_dotenv
-from bella_prompt import BELLA_SYSTEM_PROMPT
+from chat import (
+    CHAT_MAX_TOKENS, CHAT_MODEL, bella_messages, chat_stats, get_prompt_prefix, open_chat_stream, prefix_messages,
+    record_usage, stream_chat_events,
+)
+from chat_sessions import CHAT_SESSION_COOKIE, chat_turn, get_chat_sessions, set_session_cookie
+from chat_summary import get_chat_compactor
+from http_client import start_http_client, close_http_client
+from openai_clients import get_openai_client, get_openai_client_registry
+from analysis_cache import get_analysis_cache
+from perceptual_hash import get_near_duplicate_index
+from image_preprocess import preprocess_stats
+from preprocess_pool import get_image_details, get_preprocess_pool
+from uploads import MAX_UPLOAD_BYTES, UploadLimitMiddleware, configure_upload_spooling, hash_upload
+from analysis import (
+    AnalysisRequestError,
+    analyze_image,
+    get_api_key,
+    resolve_provider,
+)
+from batch import MAX_BATCH_UPLOAD_BYTES, analyze_batch, ndjson_lines
+from jobs import get_job_queue
+from ensemble import ENSEMBLE_MODES, analyze_ensemble, resolve_ensemble
+from google_vision import get_google_batcher, get_google_client_registry, warm_default_google_client
+from clip_engine import clip_options, get_clip_engine, warm_clip_engine
+from rate_limit import PRIORITY_CHAT, get_rate_limiter, rate_limit_stats
+from circuit_breaker import ProviderUnavailableError, get_provider_guard, provider_status, shutdown_provider_guards
+from taxonomy import get_taxonomy
+from embedding_store import embedding_stats, find_similar, get_embedding_store
+from tag_index import QuerySyntaxError, get_tag_index
+from ingest import allowed_root, ingest
 
 # Load environment variables from .env file
 load_dotenv()
@@ -39,26 +72,30 @@ try:
 except ImportError:
     print("Warning: python-dotenv not installed. Environment variables must be set manually.")
 
-# Try to import Google Vision - not critical
-try:
-    from google.oauth2 import service_account
-    from google.cloud import vision
-    has_google_vision = True
-except ImportError:
-    has_google_vision = False
-    print("Warning: Google Cloud Vision not installed. Google Vision API will not be available.")
-
-# Try to import CLIP dependencies - not critical
-# try:
-#     import torch
-#     import open_clip
-#     has_clip = True
-# except ImportError:
-#     has_clip = False
-#     print("Warning: CLIP dependencies not installed. CLIP model will not be available.")
-has_clip = False # Explicitly disable CLIP
-
-app = FastAPI(title="Skypad AI Platform", version="1.0")
+# --- Application lifespan ---
+# Shared resources (pooled HTTP client, Google Vision clients, job workers, ...) are created once at startup and released on shutdown.
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    start_http_client()
+    get_prompt_prefix()  # tokenize the static prompt prefix once, before the first chat
+    google_warmup = asyncio.create_task(warm_default_google_client())
+    clip_warmup = asyncio.create_task(warm_clip_engine())
+    preprocess_warmup = asyncio.create_task(get_preprocess_pool().warm())
+    get_job_queue().start()
+    yield
+    await get_job_queue().stop()
+    await get_chat_compactor().close()
+    google_warmup.cancel()
+    clip_warmup.cancel()
+    preprocess_warmup.cancel()
+    get_clip_engine().close()
+    get_preprocess_pool().close()
+    await run_in_threadpool(get_google_client_registry().close_all)
+    await get_openai_client_registry().close_all()
+    shutdown_provider_guards()
+    await close_http_client()
+
+app = FastAPI(title="Skypad AI Platform", version="1.0", lifespan=lifespan)
 
 # --- CORS Middleware --- 
 # This will allow your frontend (running on a different port) to communicate with the backend.
@@ -71,6 +108,19 @@ origins = [
     "*",                         # Allow any domain - needed for Cloud Run which has dynamic URLs
 ]
 
+# --- Upload handling ---
+# Multipart uploads spool to disk above UPLOAD_SPOOL_THRESHOLD; oversized bodies are rejected while streaming.
+configure_upload_spooling()
+app.add_middleware(
+    UploadLimitMiddleware,
+    limits={
+        "/analyze-image/": MAX_UPLOAD_BYTES,
+        "/analyze-images/": MAX_BATCH_UPLOAD_BYTES,
+        "/jobs": MAX_BATCH_UPLOAD_BYTES,
+        "/images/similar": MAX_UPLOAD_BYTES,
+    },
+)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -85,31 +135,6 @@ app.add_middleware(
 # in your Dockerfile or build process.
 app.mount("/static", StaticFiles(directory="static", html=True), name="static_assets")
 
-# --- Helper functions (copied and adapted from app.py) ---
-def get_api_key(service_name: str) -> Optional[str]:
-    """Get API key from environment variables or return None"""
-    if service_name == "OpenAI":
-        api_key = os.environ.get("OPENAI_API_KEY")
-        if api_key:
-            print(f"Found {service_name} API key in environment variables (length: {len(api_key)})")
-        else:
-            print(f"No {service_name} API key found in environment variables")
-        return api_key
-    return None
-
-def get_google_credentials_path() -> Optional[str]:
-    """Get Google credentials path from environment variables or return None"""
-    cred_path = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS")
-    if cred_path:
-        print(f"Found Google credentials path: {cred_path}")
-        if os.path.exists(cred_path):
-            print(f"Google credentials file exists.")
-        else:
-            print(f"Warning: Google credentials file not found at {cred_path}")
-    else:
-        print("No Google credentials path found in environment variables")
-    return cred_path
-
 # --- Pydantic Models for Request/Response ---
 class ImageAnalysisResponse(BaseModel):
     success: bool
@@ -119,6 +144,12 @@ class ImageAnalysisResponse(BaseModel):
     raw_response: Optional[Dict[str, Any]] = None
     error: Optional[str] = None
     traceback: Optional[str] = None
+    retry_after: Optional[float] = None # set when the provider is temporarily unavailable
+    taxonomy: Optional[Dict[str, Any]] = None # canonical Skypad taxonomy ids for the tags
+    image_id: Optional[str] = None # content digest, usable with /images/similar
+
+class TaxonomyNormalizeRequest(BaseModel):
+    tags: List[str]
 
 class BellaChatRequest(BaseModel):
     message: str
@@ -142,78 +173,281 @@ class ChatResponse(BaseModel):
 async def serve_react_app(request: Request): # Add request: Request
     return FileResponse("static/index.html")
 
+@app.get("/metrics")
+async def metrics():
+    return {
+        "analysis_cache": get_analysis_cache().stats(),
+        "near_duplicate_index": get_near_duplicate_index().stats(),
+        "image_preprocess": preprocess_stats(),
+        "preprocess_pool": get_preprocess_pool().snapshot(),
+        "job_queue": get_job_queue().store.queue_depth(),
+        "google_vision_batches": get_google_batcher().stats,
+        "google_vision_clients": get_google_client_registry().snapshot(),
+        "openai_clients": get_openai_client_registry().snapshot(),
+        "rate_limits": rate_limit_stats(),
+        "providers": provider_status(),
+        "clip": get_clip_engine().snapshot(),
+        "taxonomy": {"version": get_taxonomy().version, **get_taxonomy().stats},
+        "embeddings": await run_in_threadpool(embedding_stats),
+        "tag_index": get_tag_index().snapshot(),
+        "chat": chat_stats(),
+        "chat_sessions": get_chat_sessions().snapshot(),
+        "chat_compaction": get_chat_compactor().snapshot(),
+    }
+
+@app.get("/providers/status")
+async def providers_status():
+    """Circuit breaker and bulkhead state per provider (closed, open or half_open)"""
+    return provider_status()
+
+@app.get("/taxonomy")
+async def taxonomy():
+    """The loaded Skypad taxonomy: version and canonical concept ids per facet"""
+    return get_taxonomy().describe()
+
+@app.post("/taxonomy/normalize")
+async def normalize_taxonomy_tags(request: TaxonomyNormalizeRequest):
+    """Map free-form tags to canonical taxonomy ids"""
+    return get_taxonomy().normalize_tags(request.tags)
+
+def set_unavailable(response: Response, retry_after: float) -> None:
+    """Turn a fast provider rejection into 503 Service Unavailable with a Retry-After hint"""
+    response.status_code = 503
+    response.headers["Retry-After"] = str(math.ceil(retry_after))
+
 @app.post("/analyze-image/", response_model=ImageAnalysisResponse)
 async def analyze_image_endpoint(
-    model_name: str = Form(...), # openai, google
+    response: Response,
+    model_name: str = Form(...), # openai, google, clip, ensemble
     image: UploadFile = File(...),
     openai_api_key: Optional[str] = Form(None),
-    google_credentials_path: Optional[str] = Form(None)
-    # Remove CLIP specific form parameters:
-    # use_furniture_categories: bool = Form(True),
-    # clip_min_confidence: float = Form(0.05),
-    # clip_temperature: float = Form(0.9)
+    google_credentials_path: Optional[str] = Form(None),
+    reuse_similar: bool = Form(True), # reuse the analysis of a near-duplicate image (perceptual hash)
+    ensemble_mode: str = Form("fuse"), # ensemble only: "fuse" both providers' tags, or return the "first" to answer
+    # CLIP specific form parameters:
+    use_furniture_categories: bool = Form(True),
+    clip_min_confidence: float = Form(0.05),
+    clip_temperature: float = Form(0.9)
 ):
+    if model_name.lower() == "ensemble":
+        return await analyze_ensemble_upload(response, image, openai_api_key, google_credentials_path, reuse_similar, ensemble_mode)
+
+    try:
+        provider, credential = resolve_provider(model_name, openai_api_key, google_credentials_path)
+    except AnalysisRequestError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # Work from the spooled upload file: hash it in chunks instead of reading it into memory
+    image_digest, _ = await hash_upload(image)
+    clip_settings = clip_options(use_furniture_categories, clip_min_confidence, clip_temperature)
+    result, cache_status = await analyze_image(image.file, image_digest, provider, credential, reuse_similar, clip_settings=clip_settings)
+    if cache_status:
+        response.headers["Cache-Status"] = cache_status
+    if result.get("retry_after"):
+        set_unavailable(response, result["retry_after"])
+    return result
+
+async def analyze_ensemble_upload(
+    response: Response,
+    image: UploadFile,
+    openai_api_key: Optional[str],
+    google_credentials_path: Optional[str],
+    reuse_similar: bool,
+    ensemble_mode: str,
+) -> Dict[str, Any]:
+    """Run OpenAI and Google Vision concurrently on one upload (model_name=ensemble)"""
+    if ensemble_mode not in ENSEMBLE_MODES:
+        raise HTTPException(status_code=400, detail=f"Unsupported ensemble_mode: {ensemble_mode}. Choose 'fuse' or 'first'.")
+    try:
+        credentials = resolve_ensemble(openai_api_key, google_credentials_path)
+    except AnalysisRequestError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    image_digest, _ = await hash_upload(image)
+    # Providers read the image concurrently (and possibly after the response in "first" mode),
+    # so they share an immutable bytes copy rather than the upload's file handle
     image_bytes = await image.read()
+    result, cache_status, providers = await analyze_ensemble(image_bytes, image_digest, credentials, reuse_similar, ensemble_mode)
+    if cache_status:
+        response.headers["Cache-Status"] = cache_status
+    response.headers["X-Analysis-Providers"] = ", ".join(providers)
+    if result.get("retry_after"):
+        set_unavailable(response, result["retry_after"])
+    return result
+
+@app.post("/analyze-images/")
+async def analyze_images_endpoint(
+    model_name: str = Form(...), # openai, google, clip
+    images: List[UploadFile] = File(...), # image files and/or zip archives of images
+    openai_api_key: Optional[str] = Form(None),
+    google_credentials_path: Optional[str] = Form(None),
+    reuse_similar: bool = Form(True),
+):
+    """Analyse many images; each result is streamed back as one NDJSON line as soon as it finishes"""
+    try:
+        provider, credential = resolve_provider(model_name, openai_api_key, google_credentials_path)
+    except AnalysisRequestError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    results = analyze_batch(images, provider, credential, reuse_similar)
+    return StreamingResponse(ndjson_lines(results), media_type="application/x-ndjson")
 
-    if model_name.lower() == "openai":
-        api_key_to_use = openai_api_key or get_api_key("OpenAI")
-        if not api_key_to_use:
-            raise HTTPException(status_code=400, detail="OpenAI API key not provided or found in environment.")
-        return analyze_image_with_openai(image_bytes, api_key_to_use)
-    elif model_name.lower() == "google":
-        creds_path_to_use = google_credentials_path or get_google_credentials_path()
-        if not creds_path_to_use:
-            raise HTTPException(status_code=400, detail="Google credentials path not provided or found in environment.")
-        if not has_google_vision:
-             return ImageAnalysisResponse(success=False, error="Google Cloud Vision API is not installed on the server.")
-        return analyze_image_with_google(image_bytes, creds_path_to_use)
-    # elif model_name.lower() == "clip": # REMOVE CLIP BLOCK
-    #     if not has_clip:
-    #         return ImageAnalysisResponse(success=False, error="CLIP dependencies not installed on the server.")
-    #     clip_params = {
-    #         "use_furniture_categories": use_furniture_categories,
-    #         "min_confidence": clip_min_confidence,
-    #         "temperature": clip_temperature
-    #     }
-    #     return analyze_image_with_clip(image_bytes, **clip_params)
+@app.post("/jobs")
+async def submit_job_endpoint(
+    model_name: str = Form(...), # openai, google, clip
+    images: List[UploadFile] = File(...), # image files and/or zip archives of images
+    openai_api_key: Optional[str] = Form(None),
+    google_credentials_path: Optional[str] = Form(None),
+    reuse_similar: bool = Form(True),
+):
+    """Queue a large batch for background analysis; poll /jobs/{job_id} for progress"""
+    try:
+        provider, credential = resolve_provider(model_name, openai_api_key, google_credentials_path)
+    except AnalysisRequestError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return await get_job_queue().submit(images, provider, credential, reuse_similar)
+
+@app.get("/images/search")
+async def search_images_endpoint(q: str = "", facets: Optional[str] = None, limit: int = 50, offset: int = 0):
+    """Analysed images matching a tag query, e.g. `lounge chair AND (velvet OR leather) NOT outdoor`
+    (adjacent words that form a taxonomy label or alias are one phrase; quote any other phrase), with
+    taxonomy facet counts (restricted to a comma-separated list of `facets` if given)"""
+    facet_names = [name.strip() for name in facets.split(",") if name.strip()] if facets else None
+    try:
+        result = await run_in_threadpool(get_tag_index().search, q, facet_names, limit, max(0, offset))
+    except QuerySyntaxError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid query: {e}")
+    return {"success": True, "query": q, **result}
+
+@app.get("/images/similar")
+async def similar_images_endpoint(image_id: str, k: int = 10):
+    """Images most similar to an already analysed image (image_id from /analyze-image/)"""
+    result = await find_similar(image_id=image_id, k=k)
+    if not result["success"]:
+        raise HTTPException(status_code=404, detail=result["error"])
+    return result
+
+@app.post("/images/similar")
+async def similar_images_upload_endpoint(image: UploadFile = File(...), k: int = Form(10)):
+    """Images most similar to an uploaded image ("show me images like this one")"""
+    image_digest, _ = await hash_upload(image)
+    if await run_in_threadpool(get_embedding_store().has, image_digest):
+        result = await find_similar(image_id=image_digest, k=k)
     else:
-        raise HTTPException(status_code=400, detail=f"Unsupported model: {model_name}. Choose 'openai' or 'google'.")
+        result = await find_similar(image=await image.read(), k=k)
+    if not result["success"]:
+        raise HTTPException(status_code=400, detail=result["error"])
+    return result
+
+@app.get("/images/{image_id}")
+async def image_details_endpoint(image_id: str):
+    """Size and EXIF details (capture date, camera, GPS) of an analysed image"""
+    details = await run_in_threadpool(get_image_details().get, image_id)
+    if details is None:
+        raise HTTPException(status_code=404, detail=f"No details stored for image {image_id}")
+    return details
+
+@app.get("/images/{image_id}/thumbnail")
+async def image_thumbnail_endpoint(image_id: str):
+    """JPEG thumbnail of an analysed image"""
+    thumbnail = await run_in_threadpool(get_image_details().thumbnail, image_id)
+    if thumbnail is None:
+        raise HTTPException(status_code=404, detail=f"No thumbnail stored for image {image_id}")
+    return Response(content=thumbnail, media_type="image/jpeg", headers={"Cache-Control": "public, max-age=31536000, immutable"})
+
+@app.post("/ingest")
+async def ingest_endpoint(
+    root: str = Form(...), # directory to crawl; must be under INGEST_ROOTS
+    model_name: str = Form(...), # openai, google, clip
+    openai_api_key: Optional[str] = Form(None),
+    google_credentials_path: Optional[str] = Form(None),
+    reuse_similar: bool = Form(True),
+    dry_run: bool = Form(False),
+):
+    """Crawl a directory tree and queue its new and changed images as a background job"""
+    if not allowed_root(root):
+        raise HTTPException(status_code=403, detail="Directory is not under INGEST_ROOTS.")
+    try:
+        provider, credential = resolve_provider(model_name, openai_api_key, google_credentials_path)
+        summary = await run_in_threadpool(ingest, root, provider, reuse_similar, dry_run)
+    except (AnalysisRequestError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if summary["job_id"]:
+        get_job_queue().register(summary["job_id"], credential)
+    return summary
+
+@app.get("/jobs/{job_id}")
+async def job_status_endpoint(job_id: str):
+    job = await run_in_threadpool(get_job_queue().store.get_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found.")
+    return job
+
+@app.get("/jobs/{job_id}/results")
+async def job_results_endpoint(job_id: str, cursor: int = 0, limit: int = 100):
+    """Finished items in completion order; pass the returned next_cursor to fetch the next page"""
+    store = get_job_queue().store
+    if await run_in_threadpool(store.get_job, job_id) is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found.")
+    return await run_in_threadpool(store.get_results, job_id, cursor, max(1, min(limit, 1000)))
 
 @app.post("/chat-with-bella/", response_model=BellaChatResponse)
-async def chat_with_bella_endpoint(request: BellaChatRequest):
-    if not has_openai:
-        return BellaChatResponse(response="", error="OpenAI library is not installed on the server.")
-
+async def chat_with_bella_endpoint(request: BellaChatRequest, response: Response):
     api_key_to_use = request.api_key or get_api_key("OpenAI")
     if not api_key_to_use:
         return BellaChatResponse(response="", error="OpenAI API key not provided or found in environment.")
 
+    messages, prompt_tokens = prefix_messages(request.message)
     try:
-        response_content = chat_with_bella(request.message, api_key_to_use, request.chat_model)
+        # Interactive: scheduled ahead of image analysis sharing the same OpenAI quota
+        response_content = await get_rate_limiter("openai", api_key_to_use).run(
+            lambda: get_provider_guard("openai_chat").call(
+                lambda: bella_completion(messages, api_key_to_use, request.chat_model)
+            ),
+            tokens=prompt_tokens + CHAT_MAX_TOKENS,
+            priority=PRIORITY_CHAT,
+        )
         return BellaChatResponse(response=response_content)
+    except ProviderUnavailableError as e:
+        set_unavailable(response, e.retry_after)
+        return BellaChatResponse(response="", error=str(e))
     except Exception as e:
         return BellaChatResponse(response="", error=f"Sorry, I encountered an error: {str(e)}")
 
 @app.post("/api/chat", response_model=ChatResponse)
-async def chat_with_bella(chat_message: ChatMessage):
+async def chat_with_bella(chat_message: ChatMessage, request: Request, response: Response):
     if not openai.api_key:
         raise HTTPException(status_code=500, detail="OpenAI API key not configured.")
+    sessions = get_chat_sessions()
+    session = await run_in_threadpool(sessions.get, request.cookies.get(CHAT_SESSION_COOKIE))
+    turn = chat_turn("user", chat_message.message)
+    messages, prompt_tokens = bella_messages(session, turn)
     try:
-        # For simplicity, we are not maintaining conversation history here yet.
-        # In a more advanced setup, you would manage a list of messages (system, user, assistant).
-        completion = openai.chat.completions.create(
-            model="gpt-3.5-turbo",  # Or your preferred model, e.g., "gpt-4"
-            messages=[
-                {"role": "system", "content": BELLA_SYSTEM_PROMPT},
-                {"role": "user", "content": chat_message.message}
-            ]
+        # Interactive: scheduled ahead of image analysis sharing the same OpenAI quota. The raw
+        # response exposes the x-ratelimit-* headers the scheduler learns the budget from.
+        client = get_openai_client(openai.api_key)
+        raw_completion = await get_rate_limiter("openai", openai.api_key).run(
+            lambda: get_provider_guard("openai_chat").call(
+                lambda: client.chat.completions.with_raw_response.create(model=CHAT_MODEL, messages=messages)
+            ),
+            tokens=prompt_tokens + CHAT_MAX_TOKENS,
+            priority=PRIORITY_CHAT,
         )
+        completion = raw_completion.parse()
+        if completion.usage is not None:
+            record_usage(completion.usage.model_dump(exclude_none=True))
         # Correct way to access the message content from the response
         reply_content = completion.choices[0].message.content
         if reply_content is None:
             # Handle cases where content might be None, though rare for successful completions
             raise HTTPException(status_code=500, detail="OpenAI API returned an empty message.")
+        session.add(turn, chat_turn("assistant", reply_content))
+        await run_in_threadpool(sessions.save, session)
+        get_chat_compactor().schedule(session, sessions, openai.api_key)
+        set_session_cookie(response, session)
         return ChatResponse(reply=reply_content)
+    except ProviderUnavailableError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(math.ceil(e.retry_after))})
     except openai.APIError as e:
         print(f"OpenAI API Error: {e}")
         raise HTTPException(status_code=500, detail=f"An error occurred with the OpenAI API: {e}")
@@ -221,138 +455,64 @@ async def chat_with_bella(chat_message: ChatMessage):
         print(f"An unexpected error occurred: {e}")
         raise HTTPException(status_code=500, detail="An unexpected error occurred.")
 
-# --- Analysis Functions (copied and adapted from app.py) ---
+@app.post("/api/chat/stream")
+async def chat_with_bella_stream(chat_message: ChatMessage, request: Request):
+    """Bella's reply as Server-Sent Events: `token` events as the text is generated, then one `done`
+    event with the token usage and latency (see chat.py)"""
+    if not openai.api_key:
+        raise HTTPException(status_code=500, detail="OpenAI API key not configured.")
+    started = time.perf_counter()
+    sessions = get_chat_sessions()
+    session = await run_in_threadpool(sessions.get, request.cookies.get(CHAT_SESSION_COOKIE))
+    turn = chat_turn("user", chat_message.message)
+    messages, prompt_tokens = bella_messages(session, turn)
+
+    async def remember(reply: str) -> None:
+        session.add(turn, chat_turn("assistant", reply))
+        await run_in_threadpool(sessions.save, session)
+        get_chat_compactor().schedule(session, sessions, openai.api_key)
 
-def analyze_image_with_openai(image_bytes: bytes, api_key: str) -> Dict[str, Any]:
-    try:
-        import base64
-        base64_image = base64.b64encode(image_bytes).decode('utf-8')
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}"
-        }
-        payload = {
-            "model": "gpt-4o",
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": "Analyze this image and provide: 1) A short caption, 2) Five specific tags that categorize what's in the image, 3) A brief explanation about the image content and context. Format your response as JSON with keys: caption, tags, explanation."
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}"
-                            }
-                        }
-                    ]
-                }
-            ],
-            "response_format": {"type": "json_object"}
-        }
-        response = requests.post(
-            "https://api.openai.com/v1/chat/completions",
-            headers=headers,
-            json=payload
-        )
-        if response.status_code == 200:
-            result = response.json()
-            content = json.loads(result["choices"][0]["message"]["content"])
-            return {
-                "success": True,
-                "tags": content.get("tags", []),
-                "caption": content.get("caption", ""),
-                "explanation": content.get("explanation", ""),
-                "raw_response": content
-            }
-        else:
-            return {
-                "success": False,
-                "error": f"Error: {response.status_code} - {response.text}"
-            }
-    except Exception as e:
-        return {
-            "success": False,
-            "error": f"Exception: {str(e)}"
-        }
-
-def analyze_image_with_google(image_bytes: bytes, credentials_path: str) -> Dict[str, Any]:
-    if not has_google_vision: # Should be caught by endpoint, but good to double check
-        return {
-            "success": False,
-            "error": "Google Cloud Vision API is not installed. Install with: pip install google-cloud-vision"
-        }
     try:
-        credentials = service_account.Credentials.from_service_account_file(credentials_path)
-        client = vision.ImageAnnotatorClient(credentials=credentials)
-        image = vision.Image(content=image_bytes)
-        
-        label_detection = client.label_detection(image=image, max_results=10)
-        web_detection = client.web_detection(image=image)
-        text_detection = client.text_detection(image=image)
-        
-        labels = []
-        if label_detection.label_annotations:
-            labels = [
-                {"description": label.description, "score": float(label.score) if hasattr(label, 'score') else 0.0}
-                for label in label_detection.label_annotations[:5]
-            ]
-        
-        web_entities = []
-        if hasattr(web_detection, 'web_entities'):
-            for entity in web_detection.web_entities:
-                if hasattr(entity, 'description') and entity.description:
-                    score = float(entity.score) if hasattr(entity, 'score') else 0.0
-                    web_entities.append({"description": entity.description, "score": score})
-            web_entities = web_entities[:5]
-        
-        text = ""
-        if hasattr(text_detection, 'text_annotations') and text_detection.text_annotations:
-            text = text_detection.text_annotations[0].description
-        
-        caption_parts = [label["description"] for label in labels[:3]] if labels else ["Image"]
-        caption = "Image containing " + ", ".join(caption_parts)
-        
-        explanation = "This image was analyzed. "
-        if labels:
-            explanation = f"This image appears to show {', '.join([label['description'] for label in labels[:3]])}. "
-        if web_entities:
-            explanation += f"Web analysis suggests it's related to {', '.join([entity['description'] for entity in web_entities[:3]])}. "
-        if text:
-            explanation += f"The image contains text: '{text[:100]}{'...' if len(text) > 100 else ''}'"
-        
-        return {
-            "success": True,
-            "tags": [label["description"] for label in labels],
-            "caption": caption,
-            "explanation": explanation,
-            "raw_response": {"labels": labels, "webEntities": web_entities, "text": text}
-        }
+        upstream = await open_chat_stream(messages, prompt_tokens, openai.api_key, CHAT_MODEL)
+    except ProviderUnavailableError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(math.ceil(e.retry_after))})
+    except openai.APIStatusError as e:
+        print(f"OpenAI API Error: {e}")
+        raise HTTPException(status_code=502 if e.status_code >= 500 else 500, detail=f"An error occurred with the OpenAI API: {e}")
+    except openai.APIError as e:
+        print(f"OpenAI API Error: {e}")
+        raise HTTPException(status_code=502, detail=f"An error occurred with the OpenAI API: {e}")
     except Exception as e:
-        import traceback
-        tb_str = traceback.format_exc()
-        return {"success": False, "error": f"Exception: {str(e)}", "traceback": tb_str}
-
-# def analyze_image_with_clip(image_bytes: bytes, use_furniture_categories: bool = True, min_confidence: float = 0.05, temperature: float = 0.9) -> Dict[str, Any]: # REMOVE ENTIRE FUNCTION
-#     # ... entire function content ...
-#     pass # Placeholder if the function is completely removed or commented out
-
-def chat_with_bella(message: str, api_key: str, chat_model: str = "gpt-3.5-turbo") -> str:
-    if not has_openai: # Should be caught by endpoint
-        raise Exception("OpenAI library is not installed.")
-    
-    client = openai.OpenAI(api_key=api_key)
-    response = client.chat.completions.create(
+        print(f"An unexpected error occurred: {e}")
+        raise HTTPException(status_code=500, detail="An unexpected error occurred.")
+    streaming = StreamingResponse(
+        stream_chat_events(upstream, started, on_reply=remember),
+        media_type="text/event-stream",
+        # No caching or proxy buffering: every event should reach the browser as soon as it is sent
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    set_session_cookie(streaming, session)
+    return streaming
+
+@app.delete("/api/chat/session")
+async def end_chat_session(request: Request, response: Response):
+    """Forget the conversation: the next message starts a new session"""
+    session_id = request.cookies.get(CHAT_SESSION_COOKIE)
+    if session_id:
+        await run_in_threadpool(get_chat_sessions().delete, session_id)
+    response.delete_cookie(CHAT_SESSION_COOKIE)
+    return {"success": True}
+
+async def bella_completion(messages: List[Dict[str, str]], api_key: str, chat_model: str = "gpt-3.5-turbo") -> str:
+    client = get_openai_client(api_key)
+    response = await client.chat.completions.create(
         model=chat_model,
-        messages=[
-            {"role": "system", "content": BELLA_SYSTEM_PROMPT},
-            {"role": "user", "content": message}
-        ],
-        max_tokens=800,
+        messages=messages,
+        max_tokens=CHAT_MAX_TOKENS,
         temperature=0.7
     )
+    if response.usage is not None:
+        record_usage(response.usage.model_dump(exclude_none=True))
     return response.choices[0].message.content
 
 # --- Main application runner (for local development) ---
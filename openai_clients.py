@@ -0,0 +1,103 @@
+"""
+Process-wide AsyncOpenAI clients for the chat endpoints, one per API key.
+
+Building an SDK client per message means a new connection pool, TCP connection and TLS handshake
+for every reply. The registry keeps one AsyncOpenAI client per distinct key - keyed by the key's
+SHA-256, so keys are not held as dict keys or shown in /metrics - each with its own pooled
+keep-alive transport, HTTP/2 when the h2 package is installed (OPENAI_HTTP2). At most
+OPENAI_CLIENT_MAX clients are kept; the least recently used one is closed once requests that may
+still be running on it have timed out. All clients are closed on shutdown.
+
+SDK retries are off: 429s and transient errors are retried by the rate-limit scheduler.
+"""
+import asyncio
+import importlib.util
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+import openai
+
+from http_client import HTTP_TIMEOUT_SECONDS, OPENAI_API_BASE
+from utils import sha256_hex
+
+OPENAI_CLIENT_MAX = int(os.getenv("OPENAI_CLIENT_MAX", "16"))
+OPENAI_HTTP2 = os.getenv("OPENAI_HTTP2", "true").lower() in ("1", "true", "yes")
+
+has_h2 = importlib.util.find_spec("h2") is not None
+
+
+class OpenAIClientRegistry:
+    """LRU of AsyncOpenAI clients keyed by the SHA-256 of their API key"""
+
+    def __init__(self, max_clients: int = OPENAI_CLIENT_MAX, http2: bool = OPENAI_HTTP2 and has_h2):
+        self.max_clients = max(1, max_clients)
+        self.http2 = http2
+        self._clients: "OrderedDict[str, list]" = OrderedDict()  # key hash -> [client, last_used]
+        self._retiring: Dict[asyncio.Task, openai.AsyncOpenAI] = {}  # eviction close task -> client
+        self.stats = {"hits": 0, "builds": 0, "evictions": 0}
+
+    def get(self, api_key: str) -> openai.AsyncOpenAI:
+        key = sha256_hex(api_key.encode())
+        entry = self._clients.get(key)
+        if entry is not None:
+            entry[1] = time.monotonic()
+            self._clients.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[0]
+        client = openai.AsyncOpenAI(
+            api_key=api_key,
+            base_url=OPENAI_API_BASE,
+            timeout=HTTP_TIMEOUT_SECONDS,
+            max_retries=0,
+            http_client=openai.DefaultAsyncHttpxClient(http2=self.http2),
+        )
+        self._clients[key] = [client, time.monotonic()]
+        self.stats["builds"] += 1
+        while len(self._clients) > self.max_clients:
+            _, (evicted, _) = self._clients.popitem(last=False)
+            self.stats["evictions"] += 1
+            self._retire(evicted)
+        return client
+
+    def _retire(self, client: openai.AsyncOpenAI) -> None:
+        """Close an evicted client after the longest a request on it can still take"""
+
+        async def close_later() -> None:
+            await asyncio.sleep(HTTP_TIMEOUT_SECONDS)
+            await client.close()
+
+        task = asyncio.get_running_loop().create_task(close_later())
+        self._retiring[task] = client
+        task.add_done_callback(lambda done: self._retiring.pop(done, None))
+
+    async def close_all(self) -> None:
+        clients = [client for client, _ in self._clients.values()] + list(self._retiring.values())
+        for task in list(self._retiring):
+            task.cancel()
+        self._clients.clear()
+        self._retiring.clear()
+        for client in clients:
+            try:
+                await client.close()
+            except Exception as e:
+                print(f"Error closing OpenAI client: {e}")
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {**self.stats, "clients": len(self._clients), "retiring": len(self._retiring), "http2": self.http2}
+
+
+_registry: Optional[OpenAIClientRegistry] = None
+
+
+def get_openai_client_registry() -> OpenAIClientRegistry:
+    global _registry
+    if _registry is None:
+        _registry = OpenAIClientRegistry()
+    return _registry
+
+
+def get_openai_client(api_key: str) -> openai.AsyncOpenAI:
+    """The shared AsyncOpenAI client for an API key (call from the event loop)"""
+    return get_openai_client_registry().get(api_key)
@@ -0,0 +1,132 @@
+"""
+Perceptual hashing and near-duplicate lookup for uploaded images.
+
+A 64-bit difference hash (dHash) survives re-exports, resizes and mild JPEG re-compression, so
+images within a small Hamming distance of an already analysed image can reuse its result.
+Hashes are kept in a BK-tree per (model, prompt version) namespace and persisted next to the
+analysis cache so the index survives restarts.
+"""
+import os
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from PIL import Image, ImageOps
+
+from analysis_cache import ANALYSIS_CACHE_DB
+from utils import ImageSource, ensure_parent_dir, open_source
+
+# Maximum Hamming distance (out of 64 bits) for two images to count as near-duplicates; -1 disables reuse
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", "6"))
+
+
+def dhash_image(image: Image.Image, hash_size: int = 8) -> int:
+    """Difference hash of an already decoded image"""
+    image = ImageOps.exif_transpose(image)
+    gray = image.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS)
+    pixels = gray.tobytes()
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def dhash(image_source: ImageSource, hash_size: int = 8) -> int:
+    """Difference hash of encoded image bytes or an image file"""
+    with Image.open(open_source(image_source)) as image:
+        image.draft("L", (hash_size * 8, hash_size * 8))  # cheap JPEG downscale while decoding
+        return dhash_image(image, hash_size)
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    """Burkhard-Keller tree over integer hashes with Hamming distance as the metric"""
+
+    def __init__(self):
+        # node = [hash, value, {distance: child_node}]
+        self._root: Optional[list] = None
+        self.size = 0
+
+    def add(self, item_hash: int, value: Any) -> None:
+        self.size += 1
+        if self._root is None:
+            self._root = [item_hash, value, {}]
+            return
+        node = self._root
+        while True:
+            distance = hamming(item_hash, node[0])
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [item_hash, value, {}]
+                return
+            node = child
+
+    def search(self, item_hash: int, max_distance: int) -> List[Tuple[int, Any]]:
+        """Return (distance, value) pairs within max_distance, closest first"""
+        if self._root is None:
+            return []
+        matches = []
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            distance = hamming(item_hash, node[0])
+            if distance <= max_distance:
+                matches.append((distance, node[1]))
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        matches.sort(key=lambda match: match[0])
+        return matches
+
+
+class NearDuplicateIndex:
+    """Per-namespace BK-trees mapping perceptual hashes to analysis cache keys"""
+
+    def __init__(self, db_path: str = ANALYSIS_CACHE_DB):
+        self._trees: Dict[str, BKTree] = {}
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(ensure_parent_dir(db_path), check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS analysis_phash ("
+            " namespace TEXT NOT NULL, phash TEXT NOT NULL, cache_key TEXT NOT NULL,"
+            " PRIMARY KEY (namespace, cache_key))"
+        )
+        self._db.commit()
+        for namespace, phash_hex, cache_key in self._db.execute("SELECT namespace, phash, cache_key FROM analysis_phash"):
+            self._trees.setdefault(namespace, BKTree()).add(int(phash_hex, 16), cache_key)
+
+    def add(self, namespace: str, image_hash: int, cache_key: str) -> None:
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT OR IGNORE INTO analysis_phash (namespace, phash, cache_key) VALUES (?, ?, ?)",
+                (namespace, f"{image_hash:016x}", cache_key),
+            )
+            self._db.commit()
+            if cursor.rowcount:
+                self._trees.setdefault(namespace, BKTree()).add(image_hash, cache_key)
+
+    def find(self, namespace: str, image_hash: int, max_distance: int = PHASH_MAX_DISTANCE) -> Optional[Tuple[int, str]]:
+        """Return (distance, cache_key) of the closest stored image, or None"""
+        with self._lock:
+            tree = self._trees.get(namespace)
+            matches = tree.search(image_hash, max_distance) if tree else []
+        return matches[0] if matches else None
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {namespace: tree.size for namespace, tree in self._trees.items()}
+
+
+_index: Optional[NearDuplicateIndex] = None
+
+
+def get_near_duplicate_index() -> NearDuplicateIndex:
+    global _index
+    if _index is None:
+        _index = NearDuplicateIndex()
+    return _index
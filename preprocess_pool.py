@@ -0,0 +1,306 @@
+"""
+Image preprocessing in a pool of worker processes.
+
+Decoding, EXIF parsing, resizing, re-encoding and hashing are CPU-bound, and running them in the
+server's threads lets one large upload hold up every other request that needs the GIL. The pool
+runs them in PREPROCESS_WORKERS spawned processes instead. The encoded image is handed over through
+a multiprocessing.shared_memory block - the server copies the upload into it once and the worker
+decodes straight from the mapping - so multi-megabyte images are not pickled through a pipe.
+
+One call decodes the image once and returns:
+  - sha256 and the 64-bit perceptual dHash (perceptual_hash.py),
+  - width, height and EXIF details: capture date, camera make/model, GPS position,
+  - a small JPEG thumbnail (PREPROCESS_THUMBNAIL_EDGE),
+  - with encode=True, the oriented, downscaled and re-encoded bytes for a vision provider
+    (image_preprocess.py).
+Thumbnails and EXIF details are kept per image_id (ImageDetailsStore) for GET /images/{image_id}.
+PREPROCESS_WORKERS=0 runs the same code in the server's thread pool.
+"""
+import asyncio
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from multiprocessing import shared_memory
+from typing import Any, Dict, Optional
+
+from fastapi.concurrency import run_in_threadpool
+from PIL import Image
+
+from analysis_cache import ANALYSIS_CACHE_DB
+from image_preprocess import (
+    OPENAI_IMAGE_FORMAT, OPENAI_IMAGE_MAX_EDGE, OPENAI_IMAGE_QUALITY, encode_picture, orient_and_fit,
+    prepare_picture, record_prepared,
+)
+from perceptual_hash import dhash
+from uploads import UPLOAD_CHUNK_SIZE
+from utils import ImageSource, ensure_parent_dir, open_source, read_source, source_size
+
+PREPROCESS_WORKERS = int(os.getenv("PREPROCESS_WORKERS", str(os.cpu_count() or 1)))
+PREPROCESS_THUMBNAIL_EDGE = int(os.getenv("PREPROCESS_THUMBNAIL_EDGE", "256"))
+PREPROCESS_THUMBNAIL_QUALITY = 80
+
+# EXIF tags and IFDs
+EXIF_IFD, GPS_IFD = 0x8769, 0x8825
+EXIF_MAKE, EXIF_MODEL, EXIF_DATETIME, EXIF_DATETIME_ORIGINAL = 0x010F, 0x0110, 0x0132, 0x9003
+GPS_LATITUDE_REF, GPS_LATITUDE, GPS_LONGITUDE_REF, GPS_LONGITUDE, GPS_ALTITUDE = 1, 2, 3, 4, 6
+
+
+class SharedBufferFile(io.RawIOBase):
+    """Read-only seekable file over a memoryview (the shared memory block), without copying it"""
+
+    def __init__(self, buffer: memoryview):
+        self._buffer = buffer
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, target) -> int:
+        chunk = self._buffer[self._position:self._position + len(target)]
+        target[:len(chunk)] = chunk
+        self._position += len(chunk)
+        return len(chunk)
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self._position, os.SEEK_END: len(self._buffer)}[whence]
+        self._position = max(0, base + offset)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def close(self) -> None:
+        self._buffer = memoryview(b"")
+        super().close()
+
+
+def _degrees(value) -> Optional[float]:
+    try:
+        degrees, minutes, seconds = (float(part) for part in value)
+        return degrees + minutes / 60 + seconds / 3600
+    except (TypeError, ValueError, ZeroDivisionError):
+        return None
+
+
+def exif_details(exif: Image.Exif) -> Dict[str, Any]:
+    """Capture date (ISO 8601, camera local time), camera and GPS position of an image's EXIF data"""
+    details: Dict[str, Any] = {}
+    captured = exif.get_ifd(EXIF_IFD).get(EXIF_DATETIME_ORIGINAL) or exif.get(EXIF_DATETIME)
+    if isinstance(captured, str):
+        try:
+            details["captured_at"] = datetime.strptime(captured.strip("\0 "), "%Y:%m:%d %H:%M:%S").isoformat()
+        except ValueError:
+            pass
+    camera = " ".join(str(exif.get(tag, "")).strip("\0 ") for tag in (EXIF_MAKE, EXIF_MODEL)).strip()
+    if camera:
+        details["camera"] = camera
+    gps = exif.get_ifd(GPS_IFD)
+    latitude, longitude = _degrees(gps.get(GPS_LATITUDE)), _degrees(gps.get(GPS_LONGITUDE))
+    if latitude is not None and longitude is not None:
+        position = {
+            "latitude": round(-latitude if gps.get(GPS_LATITUDE_REF) == "S" else latitude, 6),
+            "longitude": round(-longitude if gps.get(GPS_LONGITUDE_REF) == "W" else longitude, 6),
+        }
+        if gps.get(GPS_ALTITUDE) is not None:
+            position["altitude"] = round(float(gps[GPS_ALTITUDE]), 1)
+        details["gps"] = position
+    return details
+
+
+def preprocess_buffer(buffer, encode: bool, max_edge: int = OPENAI_IMAGE_MAX_EDGE, image_format: str = OPENAI_IMAGE_FORMAT,
+                      quality: int = OPENAI_IMAGE_QUALITY, thumbnail_edge: int = PREPROCESS_THUMBNAIL_EDGE) -> Dict[str, Any]:
+    """Hashes, size, EXIF details, thumbnail and (with encode) provider bytes of an encoded image"""
+    view = memoryview(buffer)
+    details: Dict[str, Any] = {"sha256": hashlib.sha256(view).hexdigest(), "dhash": dhash(SharedBufferFile(view))}
+    with Image.open(SharedBufferFile(view)) as source:
+        details.update(width=source.width, height=source.height, exif=exif_details(source.getexif()))
+        if encode:
+            details["prepared"] = prepare_picture(source, len(view), max_edge, image_format, quality)
+    # A separate decode: JPEGs are decoded at a fraction of their size for the thumbnail
+    with Image.open(SharedBufferFile(view)) as source:
+        picture, _ = orient_and_fit(source, thumbnail_edge)
+        details["thumbnail"] = encode_picture(picture, "JPEG", PREPROCESS_THUMBNAIL_QUALITY)
+    return details
+
+
+def _preprocess_shared(name: str, size: int, encode: bool) -> Dict[str, Any]:
+    """Worker process side: preprocess the image in shared memory block `name`"""
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        buffer = block.buf[:size]
+        try:
+            return preprocess_buffer(buffer, encode)
+        finally:
+            buffer.release()
+    finally:
+        try:
+            block.close()
+        except BufferError:
+            pass  # a traceback still references the buffer; the mapping goes with it
+
+
+def _ping() -> bool:
+    return True
+
+
+def share_source(image: ImageSource) -> shared_memory.SharedMemory:
+    """Copy an image payload into a new shared memory block (blocking)"""
+    size = source_size(image)
+    block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    try:
+        if isinstance(image, (bytes, bytearray)):
+            block.buf[:size] = image
+        else:
+            source, position = open_source(image), 0
+            while position < size:
+                read = source.readinto(block.buf[position:min(position + UPLOAD_CHUNK_SIZE, size)])
+                if not read:
+                    break
+                position += read
+            source.seek(0)
+    except BaseException:
+        block.close()
+        block.unlink()
+        raise
+    return block
+
+
+class PreprocessPool:
+    """Runs preprocess_buffer() in worker processes, passing the image through shared memory"""
+
+    def __init__(self, workers: int = PREPROCESS_WORKERS):
+        self.workers = max(0, workers)
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self.stats = {"images": 0, "bytes": 0, "failures": 0, "pool_restarts": 0, "seconds": 0.0, "in_flight": 0}
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # spawn: the workers must not inherit the server's threads and sockets
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    async def warm(self) -> None:
+        """Start every worker process before the first request"""
+        if self.workers:
+            loop = asyncio.get_running_loop()
+            await asyncio.gather(*(loop.run_in_executor(self.pool, _ping) for _ in range(self.workers)))
+
+    async def run(self, image: ImageSource, encode: bool = False) -> Dict[str, Any]:
+        """Preprocess an image (bytes or a spooled upload file); see preprocess_buffer().
+        With encode, details["prepared"] is the prepare_picture() result for the provider, its
+        bytes filled in."""
+        started = time.perf_counter()
+        self.stats["in_flight"] += 1
+        try:
+            if not self.workers:
+                details = await run_in_threadpool(lambda: preprocess_buffer(read_source(image), encode))
+            else:
+                block = await run_in_threadpool(share_source, image)
+                pool = self.pool
+                try:
+                    details = await asyncio.get_running_loop().run_in_executor(
+                        pool, _preprocess_shared, block.name, source_size(image), encode
+                    )
+                except BrokenProcessPool:
+                    # A worker died (e.g. on a decompression bomb): shut the broken pool down (its
+                    # management thread and surviving workers) and start fresh next time
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    if self._pool is pool:
+                        self._pool = None
+                        self.stats["pool_restarts"] += 1
+                    raise
+                finally:
+                    block.close()
+                    block.unlink()
+        except Exception:
+            self.stats["failures"] += 1
+            raise
+        finally:
+            self.stats["in_flight"] -= 1
+        prepared = details.get("prepared")
+        if prepared is not None:
+            if prepared["passthrough"]:
+                prepared["bytes"] = await run_in_threadpool(read_source, image)
+            record_prepared(prepared)
+        self.stats["images"] += 1
+        self.stats["bytes"] += source_size(image)
+        self.stats["seconds"] += time.perf_counter() - started
+        return details
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def snapshot(self) -> Dict[str, Any]:
+        images = self.stats["images"]
+        return {
+            **{key: value for key, value in self.stats.items() if key != "seconds"},
+            "avg_ms": round(1000 * self.stats["seconds"] / images, 2) if images else 0.0,
+            "workers": self.workers,
+            "started": self._pool is not None,
+        }
+
+
+class ImageDetailsStore:
+    """Thumbnail and EXIF details of every preprocessed image, by image_id, in SQLite"""
+
+    def __init__(self, db_path: str = ANALYSIS_CACHE_DB):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(ensure_parent_dir(db_path), check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS image_details ("
+            " image_id TEXT PRIMARY KEY, width INTEGER NOT NULL, height INTEGER NOT NULL, exif TEXT NOT NULL,"
+            " thumbnail BLOB NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._db.commit()
+
+    def add(self, image_id: str, details: Dict[str, Any]) -> None:
+        with self._lock:
+            self._db.execute(
+                "INSERT OR IGNORE INTO image_details (image_id, width, height, exif, thumbnail, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (image_id, details["width"], details["height"], json.dumps(details["exif"]), details["thumbnail"], time.time()),
+            )
+            self._db.commit()
+
+    def get(self, image_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._db.execute("SELECT width, height, exif FROM image_details WHERE image_id = ?", (image_id,)).fetchone()
+        if row is None:
+            return None
+        return {"image_id": image_id, "width": row[0], "height": row[1], "exif": json.loads(row[2])}
+
+    def thumbnail(self, image_id: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._db.execute("SELECT thumbnail FROM image_details WHERE image_id = ?", (image_id,)).fetchone()
+        return None if row is None else row[0]
+
+
+_pool: Optional[PreprocessPool] = None
+_details: Optional[ImageDetailsStore] = None
+
+
+def get_preprocess_pool() -> PreprocessPool:
+    global _pool
+    if _pool is None:
+        _pool = PreprocessPool()
+    return _pool
+
+
+def get_image_details() -> ImageDetailsStore:
+    global _details
+    if _details is None:
+        _details = ImageDetailsStore()
+    return _details
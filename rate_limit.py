@@ -0,0 +1,284 @@
+"""
+Rate-limit aware scheduling of provider calls.
+
+Every outbound provider call (OpenAI vision and chat completions, Google Vision batches) goes through
+a RateLimiter for its quota - one per API key / credentials file. A limiter keeps two token buckets,
+requests per minute and tokens per minute, which start from configured defaults and are corrected
+from the x-ratelimit-* headers on every OpenAI response. Work that would exceed the budget waits in a
+priority queue instead of failing: interactive chat is served before single-image analysis, which is
+served before batch and job work. A 429 (or 5xx) pauses the whole quota and the call is retried with
+jittered exponential backoff, honouring Retry-After / retry-after-ms when the provider sends it.
+"""
+import asyncio
+import heapq
+import itertools
+import os
+import random
+import re
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from utils import sha256_hex
+
+# Lower value = served first
+PRIORITY_CHAT = 0
+PRIORITY_IMAGE = 1
+PRIORITY_BATCH = 2
+
+# Starting budgets per quota, until response headers report the real ones. Generous on purpose: the
+# first response's x-ratelimit-* headers (or a 429) correct them, while a low guess would throttle a
+# key to a handful of vision calls a minute for no reason
+OPENAI_RPM_LIMIT = int(os.getenv("OPENAI_RPM_LIMIT", "10000"))
+OPENAI_TPM_LIMIT = int(os.getenv("OPENAI_TPM_LIMIT", "2000000"))
+GOOGLE_VISION_RPM_LIMIT = int(os.getenv("GOOGLE_VISION_RPM_LIMIT", "1800"))  # counted in images
+
+RATE_LIMIT_MAX_ATTEMPTS = int(os.getenv("RATE_LIMIT_MAX_ATTEMPTS", "6"))
+RATE_LIMIT_BACKOFF_BASE_SECONDS = float(os.getenv("RATE_LIMIT_BACKOFF_BASE_SECONDS", "1"))
+RATE_LIMIT_BACKOFF_MAX_SECONDS = float(os.getenv("RATE_LIMIT_BACKOFF_MAX_SECONDS", "60"))
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token) for budgeting before the call"""
+    return len(text) // 4 + 1
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """Parse OpenAI reset durations such as "20ms", "1s" or "6m0s" into seconds"""
+    if not value:
+        return None
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    scale = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(number) * scale[unit] for number, unit in parts)
+
+
+def retry_after_seconds(headers) -> Optional[float]:
+    """Delay requested by the provider (retry-after-ms or Retry-After in seconds), if any"""
+    if not headers:
+        return None
+    for name, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        value = headers.get(name)
+        if value:
+            try:
+                return max(0.0, float(value) * scale)
+            except ValueError:
+                continue  # HTTP-date form: fall back to backoff
+    return None
+
+
+class TokenBucket:
+    """Continuously refilling budget of `capacity` units per `period` seconds"""
+
+    def __init__(self, capacity: float, period: float = 60.0):
+        self.capacity = float(capacity)
+        self.period = period
+        self.level = float(capacity)
+        self.updated = time.monotonic()
+
+    @property
+    def rate(self) -> float:
+        return self.capacity / self.period
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: float) -> float:
+        """Seconds until `amount` units are available (0 if they are now)"""
+        self._refill()
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount: float) -> None:
+        self._refill()
+        self.level -= min(amount, self.capacity)
+
+    def sync(self, limit: Optional[float], remaining: Optional[float]) -> None:
+        """Adopt the provider's view: its limit, and never more remaining than it reports"""
+        self._refill()
+        if limit:
+            self.capacity = float(limit)
+        if remaining is not None:
+            self.level = min(self.level, float(remaining))
+
+
+class RateLimiter:
+    """Requests/tokens budget for one provider quota with a priority wait queue and retries"""
+
+    def __init__(self, name: str, requests_per_minute: int, tokens_per_minute: Optional[int] = None):
+        self.name = name
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.paused_until = 0.0
+        self._waiting: List[Tuple[int, int]] = []  # heap of (priority, arrival) tickets
+        self._wakeups: Dict[Tuple[int, int], asyncio.Event] = {}
+        self._arrivals = itertools.count()
+        self.in_flight = 0
+        self.stats = {"calls": 0, "waited": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0, "throttled": 0, "retries": 0, "failures": 0}
+
+    # --- Admission ---
+
+    def _delay(self, requests: int, tokens: int) -> float:
+        delay = max(0.0, self.paused_until - time.monotonic(), self.requests.delay(requests))
+        if self.tokens is not None and tokens:
+            delay = max(delay, self.tokens.delay(tokens))
+        return delay
+
+    def _wake_head(self) -> None:
+        if self._waiting:
+            self._wakeups[self._waiting[0]].set()
+
+    async def acquire(self, tokens: int = 0, priority: int = PRIORITY_BATCH, requests: int = 1) -> None:
+        """Wait until this call fits the budget and every higher-priority or earlier caller has gone"""
+        ticket = (priority, next(self._arrivals))
+        wakeup = asyncio.Event()
+        heapq.heappush(self._waiting, ticket)
+        self._wakeups[ticket] = wakeup
+        self._wake_head()
+        started = time.monotonic()
+        try:
+            while True:
+                # Only the head of the queue may take budget; everyone else waits to become the head
+                delay = self._delay(requests, tokens) if self._waiting[0] == ticket else None
+                if delay is not None and delay <= 0:
+                    break
+                wakeup.clear()
+                try:
+                    await asyncio.wait_for(wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._waiting.remove(ticket)
+            heapq.heapify(self._waiting)
+            del self._wakeups[ticket]
+            self._wake_head()
+
+        self.requests.take(requests)
+        if self.tokens is not None and tokens:
+            self.tokens.take(tokens)
+        waited = time.monotonic() - started
+        if waited > 0.001:
+            self.stats["waited"] += 1
+            self.stats["wait_seconds"] += waited
+            self.stats["max_wait_seconds"] = max(self.stats["max_wait_seconds"], waited)
+
+    # --- Feedback from the provider ---
+
+    def update_from_headers(self, headers) -> None:
+        """Correct the buckets from x-ratelimit-limit/remaining-requests/tokens response headers"""
+        if not headers:
+            return
+
+        def number(name: str) -> Optional[float]:
+            try:
+                return float(headers.get(name))
+            except (TypeError, ValueError):
+                return None
+
+        self.requests.sync(number("x-ratelimit-limit-requests"), number("x-ratelimit-remaining-requests"))
+        if self.tokens is not None:
+            self.tokens.sync(number("x-ratelimit-limit-tokens"), number("x-ratelimit-remaining-tokens"))
+
+    def backoff(self, attempt: int, headers=None) -> float:
+        """Delay before retry `attempt` (1-based): Retry-After or the rate-limit reset if known, else full-jitter exponential backoff"""
+        retry_after = retry_after_seconds(headers)
+        if retry_after is None and headers:
+            # No Retry-After: wait for whichever exhausted budget resets
+            resets = [
+                parse_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+                for kind in ("requests", "tokens")
+                if headers.get(f"x-ratelimit-remaining-{kind}") == "0"
+            ]
+            retry_after = max((reset for reset in resets if reset is not None), default=None)
+        if retry_after is not None:
+            return retry_after + random.uniform(0, RATE_LIMIT_BACKOFF_BASE_SECONDS / 4)
+        return random.uniform(0, min(RATE_LIMIT_BACKOFF_MAX_SECONDS, RATE_LIMIT_BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+    # --- Calls ---
+
+    async def run(
+        self,
+        send: Callable[[], Awaitable[Any]],
+        tokens: int = 0,
+        priority: int = PRIORITY_BATCH,
+        requests: int = 1,
+    ) -> Any:
+        """Schedule `send()` within the budget, retrying throttled and transient failures.
+
+        `send` returns a result - an HTTP response (httpx or OpenAI raw response) is checked for its
+        status - or raises an exception carrying one (`status_code` / `code`, e.g. openai.APIStatusError,
+        google.api_core errors). The
+        last response is returned, or the last exception raised, once attempts are exhausted."""
+        for attempt in range(1, RATE_LIMIT_MAX_ATTEMPTS + 1):
+            await self.acquire(tokens, priority, requests)
+            self.in_flight += 1
+            self.stats["calls"] += 1
+            error: Optional[BaseException] = None
+            try:
+                response = await send()
+                status, headers = getattr(response, "status_code", None), getattr(response, "headers", None)
+            except Exception as e:
+                error, response = e, None
+                status = getattr(e, "status_code", None) or getattr(e, "code", None)
+                headers = getattr(getattr(e, "response", None), "headers", None)
+            finally:
+                self.in_flight -= 1
+
+            self.update_from_headers(headers)
+            if status not in RETRYABLE_STATUS or attempt == RATE_LIMIT_MAX_ATTEMPTS:
+                if status in RETRYABLE_STATUS:
+                    self.stats["failures"] += 1
+                if error is not None:
+                    raise error
+                return response
+
+            delay = self.backoff(attempt, headers)
+            if status == 429:
+                # The quota is exhausted for everyone sharing it, not just this call
+                self.stats["throttled"] += 1
+                self.paused_until = max(self.paused_until, time.monotonic() + delay)
+                self._wake_head()
+            self.stats["retries"] += 1
+            print(f"Rate limiter {self.name}: status {status}, retrying in {delay:.2f}s (attempt {attempt})")
+            await asyncio.sleep(delay)
+
+    def snapshot(self) -> Dict[str, Any]:
+        waits = self.stats["waited"]
+        return {
+            **self.stats,
+            "wait_seconds": round(self.stats["wait_seconds"], 3),
+            "max_wait_seconds": round(self.stats["max_wait_seconds"], 3),
+            "avg_wait_seconds": round(self.stats["wait_seconds"] / waits, 3) if waits else 0.0,
+            "queue_depth": len(self._waiting),
+            "queued_by_priority": {str(p): sum(1 for priority, _ in self._waiting if priority == p) for p in (PRIORITY_CHAT, PRIORITY_IMAGE, PRIORITY_BATCH)},
+            "in_flight": self.in_flight,
+            "paused_for_seconds": round(max(0.0, self.paused_until - time.monotonic()), 3),
+            "requests_limit": self.requests.capacity,
+            "tokens_limit": self.tokens.capacity if self.tokens else None,
+        }
+
+
+_limiters: Dict[str, RateLimiter] = {}
+
+
+def get_rate_limiter(provider: str, credential: Optional[str]) -> RateLimiter:
+    """The shared limiter for a provider quota, keyed by a hash of the API key or credentials path"""
+    name = f"{provider}:{sha256_hex((credential or '').encode())[:12]}"
+    if name not in _limiters:
+        if provider == "openai":
+            _limiters[name] = RateLimiter(name, OPENAI_RPM_LIMIT, OPENAI_TPM_LIMIT)
+        else:
+            _limiters[name] = RateLimiter(name, GOOGLE_VISION_RPM_LIMIT)
+    return _limiters[name]
+
+
+def rate_limit_stats() -> Dict[str, Any]:
+    return {name: limiter.snapshot() for name, limiter in _limiters.items()}
@@ -0,0 +1,303 @@
+"""
+Versioned, memory-mapped segment files for the image embedding store.
+
+A segment is one file with a 4 KiB header followed by page-aligned fixed-width columns:
+
+    header     magic "SKYPADSG", format version, dim, vector dtype, capacity, count,
+               generation, merged_generation
+    ids        S64         image id (content digest)
+    vectors    dim x f4/f2 L2-normalized embedding
+    created_at f8          unix time
+    tags       S256        tags joined with \\x1f, utf-8, cut at a tag boundary
+    caption    S128        utf-8, truncated
+    sorted_ids S64, sorted_rows u4   (base segments only) ids in sorted order for binary search
+
+Every column is a numpy.memmap view of the file, so opening a segment reads only the header: the
+OS page cache shares the pages between all processes that map the same file, and pages are only
+read when a search touches them. Looking up an id in a base segment is a binary search over the
+mapped sorted_ids column.
+
+A store directory holds two segments:
+  - base.seg:   immutable, capacity == count, with the sorted id index,
+  - append.seg: preallocated to SEGMENT_CAPACITY rows (sparse on disk); rows are written in place
+                and published by bumping the header count, which other processes see through the
+                shared mapping.
+When the append segment is full, merge() writes base + append into a new base file and a new empty
+append segment, and atomically renames both into place. Each append segment carries a generation
+number and each base the generation it has merged, so a reader never counts the same rows twice.
+Writers in any process serialize on an flock()ed lock file.
+"""
+import fcntl
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+SEGMENT_MAGIC = b"SKYPADSG"
+SEGMENT_FORMAT_VERSION = 1
+HEADER_SIZE = 4096
+ID_WIDTH = 64
+TAGS_WIDTH = 256
+CAPTION_WIDTH = 128
+TAG_SEPARATOR = "\x1f"
+COPY_CHUNK_ROWS = 65536
+
+HEADER_DTYPE = np.dtype([
+    ("magic", "S8"), ("version", "<u4"), ("dim", "<u4"), ("dtype", "<u4"), ("flags", "<u4"),
+    ("capacity", "<u8"), ("count", "<u8"), ("generation", "<u8"), ("merged_generation", "<u8"),
+])
+VECTOR_DTYPES = {0: np.dtype("<f4"), 1: np.dtype("<f2")}
+FLAG_SORTED_INDEX = 1
+
+
+def _align(offset: int) -> int:
+    return (offset + HEADER_SIZE - 1) // HEADER_SIZE * HEADER_SIZE
+
+
+def column_layout(capacity: int, dim: int, vector_dtype: np.dtype, sorted_index: bool) -> Dict[str, Tuple[int, np.dtype, tuple]]:
+    """name -> (offset, dtype, shape) of every column, in file order"""
+    columns = [
+        ("ids", np.dtype(f"S{ID_WIDTH}"), (capacity,)),
+        ("vectors", vector_dtype, (capacity, dim)),
+        ("created_at", np.dtype("<f8"), (capacity,)),
+        ("tags", np.dtype(f"S{TAGS_WIDTH}"), (capacity,)),
+        ("caption", np.dtype(f"S{CAPTION_WIDTH}"), (capacity,)),
+    ]
+    if sorted_index:
+        columns += [("sorted_ids", np.dtype(f"S{ID_WIDTH}"), (capacity,)), ("sorted_rows", np.dtype("<u4"), (capacity,))]
+    layout, offset = {}, HEADER_SIZE
+    for name, dtype, shape in columns:
+        layout[name] = (offset, dtype, shape)
+        offset = _align(offset + dtype.itemsize * int(np.prod(shape)))
+    layout["_end"] = (offset, None, ())
+    return layout
+
+
+def pack_tags(tags: List[str]) -> bytes:
+    """Tags joined into the fixed-width column, dropping whole tags that do not fit"""
+    packed = b""
+    for tag in tags:
+        encoded = tag.replace(TAG_SEPARATOR, " ").encode("utf-8")
+        candidate = packed + TAG_SEPARATOR.encode() + encoded if packed else encoded
+        if len(candidate) > TAGS_WIDTH:
+            break
+        packed = candidate
+    return packed
+
+
+def pack_text(text: str, width: int) -> bytes:
+    return text.encode("utf-8")[:width].decode("utf-8", "ignore").encode("utf-8")
+
+
+class Segment:
+    """One memory-mapped segment file (read-only, or read-write for the append segment)"""
+
+    def __init__(self, path: str, writable: bool = False):
+        self.path = path
+        mode = "r+" if writable else "r"
+        self.header = np.memmap(path, dtype=HEADER_DTYPE, mode=mode, shape=(1,))
+        if self.header["magic"][0] != SEGMENT_MAGIC:
+            raise ValueError(f"{path} is not an embedding segment file")
+        if self.header["version"][0] != SEGMENT_FORMAT_VERSION:
+            raise ValueError(f"{path} has segment format version {self.header['version'][0]}, expected {SEGMENT_FORMAT_VERSION}")
+        self.dim = int(self.header["dim"][0])
+        self.capacity = int(self.header["capacity"][0])
+        self.generation = int(self.header["generation"][0])
+        self.merged_generation = int(self.header["merged_generation"][0])
+        self.sorted_index = bool(self.header["flags"][0] & FLAG_SORTED_INDEX)
+        self.vector_dtype = VECTOR_DTYPES[int(self.header["dtype"][0])]
+        layout = column_layout(self.capacity, self.dim, self.vector_dtype, self.sorted_index)
+        self.columns: Dict[str, np.ndarray] = {}
+        for name, (offset, dtype, shape) in layout.items():
+            if dtype is not None and self.capacity:
+                self.columns[name] = np.memmap(path, dtype=dtype, mode=mode, offset=offset, shape=shape)
+        self.stat = os.stat(path)
+        # Append segments: id -> row for the rows seen so far (extended as the count grows)
+        self._rows: Dict[str, int] = {}
+
+    @property
+    def count(self) -> int:
+        """Published rows (re-read from the shared header, so appends by other processes show up)"""
+        return int(self.header["count"][0])
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return self.columns["vectors"][:self.count] if self.capacity else np.empty((0, self.dim), dtype=np.float32)
+
+    def find(self, image_id: str) -> int:
+        """Row of image_id, or -1"""
+        count = self.count
+        if not count:
+            return -1
+        key = image_id.encode()
+        if self.sorted_index:
+            sorted_ids = self.columns["sorted_ids"]
+            position = int(np.searchsorted(sorted_ids, key))
+            if position < count and sorted_ids[position] == key:
+                return int(self.columns["sorted_rows"][position])
+            return -1
+        if len(self._rows) < count:
+            ids = self.columns["ids"]
+            for row in range(len(self._rows), count):
+                self._rows[ids[row].decode()] = row
+        return self._rows.get(image_id, -1)
+
+    def image_id(self, row: int) -> str:
+        return self.columns["ids"][row].decode()
+
+    def metadata(self, row: int) -> Dict[str, Any]:
+        tags = self.columns["tags"][row].decode("utf-8", "ignore")
+        return {"tags": tags.split(TAG_SEPARATOR) if tags else [], "caption": self.columns["caption"][row].decode("utf-8", "ignore")}
+
+    def append(self, image_id: str, vector: np.ndarray, tags: List[str], caption: str) -> bool:
+        """Write one row and publish it; False when the segment is full. Call with the store lock held."""
+        row = self.count
+        if row >= self.capacity:
+            return False
+        if len(image_id) > ID_WIDTH:
+            raise ValueError(f"Image id longer than {ID_WIDTH} characters")
+        self.columns["ids"][row] = image_id.encode()
+        self.columns["vectors"][row] = vector
+        self.columns["created_at"][row] = time.time()
+        self.columns["tags"][row] = pack_tags(tags)
+        self.columns["caption"][row] = pack_text(caption, CAPTION_WIDTH)
+        # Publish after the row data is in place
+        self.header["count"][0] = row + 1
+        return True
+
+    def changed_on_disk(self) -> bool:
+        """True once the file has been replaced by a merge (possibly in another process)"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return True
+        return (stat.st_ino, stat.st_dev) != (self.stat.st_ino, self.stat.st_dev)
+
+
+def write_segment(path: str, dim: int, vector_dtype: np.dtype, sources: List[Segment], capacity: int = 0,
+                  generation: int = 0, merged_generation: int = 0) -> None:
+    """Write a new segment holding the rows of `sources` (a base segment when capacity is 0: sized
+    to fit, with the sorted id index), via a temporary file renamed into place"""
+    counts = [source.count for source in sources]
+    count = sum(counts)
+    sorted_index = capacity == 0
+    capacity = capacity or count
+    layout = column_layout(capacity, dim, vector_dtype, sorted_index)
+    temporary = f"{path}.tmp"
+    with open(temporary, "wb") as f:
+        f.truncate(layout["_end"][0])  # sparse: untouched capacity takes no disk space
+    header = np.memmap(temporary, dtype=HEADER_DTYPE, mode="r+", shape=(1,))
+    header[0] = (SEGMENT_MAGIC, SEGMENT_FORMAT_VERSION, dim, {v: k for k, v in VECTOR_DTYPES.items()}[vector_dtype],
+                 FLAG_SORTED_INDEX if sorted_index else 0, capacity, count, generation, merged_generation)
+    if count:
+        for name in ("ids", "vectors", "created_at", "tags", "caption"):
+            offset, dtype, shape = layout[name]
+            column = np.memmap(temporary, dtype=dtype, mode="r+", offset=offset, shape=shape)
+            position = 0
+            for source, source_count in zip(sources, counts):
+                for start in range(0, source_count, COPY_CHUNK_ROWS):
+                    block = source.columns[name][start:min(start + COPY_CHUNK_ROWS, source_count)]
+                    column[position:position + len(block)] = block
+                    position += len(block)
+            column.flush()
+            del column
+        if sorted_index:
+            ids = np.memmap(temporary, dtype=layout["ids"][1], mode="r", offset=layout["ids"][0], shape=layout["ids"][2])
+            order = np.argsort(ids, kind="stable")
+            for name, values in (("sorted_ids", ids[order]), ("sorted_rows", order.astype(np.uint32))):
+                offset, dtype, shape = layout[name]
+                column = np.memmap(temporary, dtype=dtype, mode="r+", offset=offset, shape=shape)
+                column[:] = values
+                column.flush()
+                del column
+            del ids
+    header.flush()
+    del header
+    with open(temporary, "rb+") as f:
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+
+@contextmanager
+def directory_lock(directory: str) -> Iterator[None]:
+    """Exclusive cross-process lock on a store directory"""
+    with open(os.path.join(directory, "lock"), "a") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class SegmentedStore:
+    """base.seg + append.seg of one store directory"""
+
+    def __init__(self, directory: str, dim: int, vector_dtype: np.dtype, capacity: int):
+        self.directory = directory
+        self.vector_dtype = np.dtype(vector_dtype).newbyteorder("<")
+        self.capacity = capacity
+        self.base_path = os.path.join(directory, "base.seg")
+        self.append_path = os.path.join(directory, "append.seg")
+        os.makedirs(directory, exist_ok=True)
+        with directory_lock(directory):
+            if not os.path.exists(self.base_path):
+                write_segment(self.base_path, dim, self.vector_dtype, [])
+            if not os.path.exists(self.append_path):
+                write_segment(self.append_path, dim, self.vector_dtype, [], capacity=capacity, generation=1)
+        self.base: Segment
+        self.append_segment: Segment
+        self.open()
+
+    def open(self) -> None:
+        self.base = Segment(self.base_path)
+        self.append_segment = Segment(self.append_path, writable=True)
+        # An existing store keeps the dtype it was created with
+        self.vector_dtype = self.base.vector_dtype
+
+    @property
+    def dim(self) -> int:
+        return self.base.dim
+
+    def refresh(self) -> bool:
+        """Reopen the segments if another process merged them; True when they changed"""
+        if self.base.changed_on_disk() or self.append_segment.changed_on_disk():
+            self.open()
+            return True
+        return False
+
+    def segments(self) -> List[Segment]:
+        if self.append_segment.generation <= self.base.merged_generation:
+            # Opened between the two renames of a merge: the base already holds these rows
+            return [self.base]
+        return [self.base, self.append_segment]
+
+    def find(self, image_id: str) -> Tuple[Optional[Segment], int]:
+        for segment in self.segments():
+            row = segment.find(image_id)
+            if row >= 0:
+                return segment, row
+        return None, -1
+
+    def add_many(self, rows: Iterable[Tuple[str, np.ndarray, List[str], str]]) -> int:
+        """Append (image_id, vector, tags, caption) rows whose id is not stored yet, merging whenever
+        the append segment fills up; returns the number of rows added"""
+        added = 0
+        with directory_lock(self.directory):
+            self.refresh()
+            for image_id, vector, tags, caption in rows:
+                if self.find(image_id)[0] is not None:
+                    continue
+                if not self.append_segment.append(image_id, vector, tags, caption):
+                    self.merge()
+                    self.append_segment.append(image_id, vector, tags, caption)
+                added += 1
+        return added
+
+    def merge(self) -> None:
+        """Fold the append segment into a new base segment. Call with the directory lock held."""
+        generation = self.append_segment.generation
+        write_segment(self.base_path, self.dim, self.vector_dtype, self.segments(), merged_generation=generation)
+        write_segment(self.append_path, self.dim, self.vector_dtype, [], capacity=self.capacity, generation=generation + 1)
+        self.open()
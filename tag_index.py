@@ -0,0 +1,355 @@
+"""
+Inverted index from normalized tag to the analysed images carrying it, with boolean and faceted queries.
+
+Each image (by image_id, its content digest) gets a dense document number in indexing order. Its
+terms are the canonical taxonomy ids of its tags ("furniture_type.lounge_chair") and the normalized
+raw tags ("lounge chair"). Every term has a sorted posting list of document numbers, stored
+compressed as patched frame-of-reference deltas: one uint8/uint16/uint32 array of gaps (the width
+that minimizes the size), with the few gaps that do not fit kept in an exception array. Decoding
+is a handful of vectorized numpy operations, not a per-item loop. New documents go to a small
+uncompressed tail that is folded into the compressed list once it grows; hot decoded lists are
+kept in an LRU.
+
+Queries combine terms with AND, OR, NOT and parentheses (adjacent terms are ANDed, -term is NOT),
+evaluated with boolean masks over the document numbers. Runs of adjacent bare words are first
+grouped by a longest-match pass over the taxonomy trie, so `lounge chair` is the lounge_chair
+phrase rather than "lounge" AND "chair"; quote words to keep them a single phrase either way. Facet counts are the sizes of the result
+intersected with the posting of each taxonomy id.
+
+The index is updated incrementally as images finish analysing and rebuilt from SQLite at startup.
+"""
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from analysis_cache import ANALYSIS_CACHE_DB
+from taxonomy import get_taxonomy, normalize_text
+from utils import ensure_parent_dir
+
+TAG_SEARCH_MAX_LIMIT = 1000
+# Decoded posting lists kept in memory
+DECODED_CACHE_TERMS = 512
+# Fold the uncompressed tail into the compressed list once it reaches 1/8 of the list, within these bounds
+TAIL_FOLD_MIN = 256
+TAIL_FOLD_MAX = 4096
+
+_WIDTHS = (np.uint8, np.uint16, np.uint32)
+_QUERY_TOKEN = re.compile(r'\(|\)|-?"[^"]*"|[^\s()]+')
+_OPERATORS = ("AND", "OR", "NOT")
+
+
+def _is_bare_word(token: str) -> bool:
+    return token not in ("(", ")") and token.upper() not in _OPERATORS and not token.startswith(('"', "-"))
+
+
+def group_phrases(tokens: List[str]) -> List[str]:
+    """Quote runs of adjacent bare words that form a taxonomy label or alias, longest match first:
+    ["lounge", "chair", "AND", ...] -> ['"lounge chair"', "AND", ...]"""
+    taxonomy = get_taxonomy()
+    grouped: List[str] = []
+    position = 0
+    while position < len(tokens):
+        if not _is_bare_word(tokens[position]):
+            grouped.append(tokens[position])
+            position += 1
+            continue
+        run_end = position
+        while run_end < len(tokens) and _is_bare_word(tokens[run_end]):
+            run_end += 1
+        words = tokens[position:run_end]
+        # Normalized tokens of the run, where each word's tokens start, and word boundaries by token offset
+        normalized: List[str] = []
+        starts: List[int] = []
+        for word in words:
+            starts.append(len(normalized))
+            normalized.extend(normalize_text(word))
+        boundaries = {start: index for index, start in enumerate(starts)}
+        boundaries[len(normalized)] = len(words)
+        index = 0
+        while index < len(words):
+            end = boundaries.get(taxonomy.phrase_end(tuple(normalized), starts[index]), index + 1)
+            if end > index + 1:
+                grouped.append(f'"{" ".join(words[index:end])}"')
+            else:
+                grouped.append(words[index])
+                end = index + 1
+            index = end
+        position = run_end
+    return grouped
+
+
+def encode_postings(docs: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Sorted unique document numbers -> (gaps, exception positions, exception gaps)"""
+    gaps = np.diff(docs, prepend=0).astype(np.int64)
+    best = None
+    for width in _WIDTHS:
+        limit = np.iinfo(width).max
+        exceptions = np.flatnonzero(gaps >= limit)
+        size = len(gaps) * np.dtype(width).itemsize + 8 * len(exceptions)
+        if best is None or size < best[0]:
+            best = (size, width, exceptions)
+    _, width, exceptions = best
+    limit = np.iinfo(width).max
+    return np.minimum(gaps, limit).astype(width), exceptions.astype(np.int32), gaps[exceptions].astype(np.int32)
+
+
+def decode_postings(gaps: np.ndarray, positions: np.ndarray, values: np.ndarray) -> np.ndarray:
+    decoded = gaps.astype(np.int32)
+    decoded[positions] = values
+    return np.cumsum(decoded, dtype=np.int32)
+
+
+class PostingList:
+    """Compressed sorted document numbers plus an uncompressed tail of recent additions"""
+
+    __slots__ = ("gaps", "positions", "values", "count", "last", "tail")
+
+    def __init__(self):
+        self.gaps = np.empty(0, dtype=np.uint8)
+        self.positions = np.empty(0, dtype=np.int32)
+        self.values = np.empty(0, dtype=np.int32)
+        self.count = 0
+        self.last = -1
+        self.tail: List[int] = []
+
+    def add(self, doc: int) -> None:
+        self.tail.append(doc)
+        if len(self.tail) >= min(max(TAIL_FOLD_MIN, self.count // 8), TAIL_FOLD_MAX):
+            self.fold()
+
+    def fold(self) -> None:
+        docs = self.decode()
+        self.gaps, self.positions, self.values = encode_postings(docs)
+        self.count = len(docs)
+        self.last = int(docs[-1]) if len(docs) else -1
+        self.tail = []
+
+    def decode(self) -> np.ndarray:
+        docs = decode_postings(self.gaps, self.positions, self.values)
+        if self.tail:
+            tail = np.array(self.tail, dtype=np.int32)
+            # Documents normally arrive in order; a re-analysed image can add an older one
+            if tail[0] > self.last and np.all(tail[1:] > tail[:-1]):
+                docs = np.concatenate((docs, tail))
+            else:
+                docs = np.union1d(docs, tail).astype(np.int32)
+        return docs
+
+    def __len__(self) -> int:
+        return self.count + len(self.tail)
+
+    def nbytes(self) -> int:
+        return self.gaps.nbytes + self.positions.nbytes + self.values.nbytes + 8 * len(self.tail)
+
+
+class QuerySyntaxError(ValueError):
+    """Raised for a malformed search query (maps to HTTP 400)"""
+
+
+class TagIndex:
+    """In-memory inverted index over analysed images, persisted as per-image terms in SQLite"""
+
+    def __init__(self, db_path: str = ANALYSIS_CACHE_DB):
+        self._image_ids: List[str] = []
+        self._docs: Dict[str, int] = {}
+        self._terms: Dict[str, set] = {}  # image_id -> indexed terms
+        self._postings: Dict[str, PostingList] = {}
+        self._decoded: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"queries": 0, "decoded_cache_hits": 0, "decoded_cache_misses": 0, "last_query_ms": 0.0}
+
+        self._db = sqlite3.connect(ensure_parent_dir(db_path), check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS image_tags ("
+            " image_id TEXT PRIMARY KEY, terms TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._db.commit()
+        for image_id, terms in self._db.execute("SELECT image_id, terms FROM image_tags ORDER BY rowid"):
+            self._index(image_id, json.loads(terms))
+        for postings in self._postings.values():
+            if postings.tail:
+                postings.fold()
+
+    @staticmethod
+    def terms_for(result: Dict[str, Any]) -> List[str]:
+        """Index terms of an analysis result: taxonomy ids and normalized raw tags"""
+        terms = list((result.get("taxonomy") or {}).get("ids", []))
+        for tag in result.get("tags") or []:
+            normalized = " ".join(normalize_text(tag))
+            if normalized and normalized not in terms:
+                terms.append(normalized)
+        return terms
+
+    def _index(self, image_id: str, terms: Iterable[str]) -> List[str]:
+        """Add terms to an image (assigning it a document number if new); returns the new terms"""
+        doc = self._docs.get(image_id)
+        if doc is None:
+            doc = self._docs[image_id] = len(self._image_ids)
+            self._image_ids.append(image_id)
+            self._terms[image_id] = set()
+        known = self._terms[image_id]
+        added = [term for term in terms if term not in known]
+        for term in added:
+            known.add(term)
+            self._postings.setdefault(term, PostingList()).add(doc)
+            self._decoded.pop(term, None)
+        return added
+
+    def add(self, image_id: str, result: Dict[str, Any]) -> None:
+        """Index (or extend the terms of) an analysed image"""
+        terms = self.terms_for(result)
+        with self._lock:
+            if not terms or not self._index(image_id, terms):
+                return
+            # The upsert keeps the row's rowid, so reloading in rowid order reproduces the document numbers
+            self._db.execute(
+                "INSERT INTO image_tags (image_id, terms, updated_at) VALUES (?, ?, ?)"
+                " ON CONFLICT(image_id) DO UPDATE SET terms = excluded.terms, updated_at = excluded.updated_at",
+                (image_id, json.dumps(sorted(self._terms[image_id])), time.time()),
+            )
+            self._db.commit()
+
+    def _posting(self, term: str) -> np.ndarray:
+        docs = self._decoded.get(term)
+        if docs is not None:
+            self._decoded.move_to_end(term)
+            self.stats["decoded_cache_hits"] += 1
+            return docs
+        self.stats["decoded_cache_misses"] += 1
+        postings = self._postings.get(term)
+        docs = postings.decode() if postings is not None else np.empty(0, dtype=np.int32)
+        self._decoded[term] = docs
+        if len(self._decoded) > DECODED_CACHE_TERMS:
+            self._decoded.popitem(last=False)
+        return docs
+
+    # --- Query evaluation ---
+    # Results are boolean masks over all document numbers: AND/OR/NOT are single vectorized ops
+
+    def _term_mask(self, text: str, size: int) -> np.ndarray:
+        mask = np.zeros(size, dtype=bool)
+        taxonomy = get_taxonomy()
+        if text in taxonomy.concepts:
+            terms = [text]
+        else:
+            normalized = " ".join(normalize_text(text))
+            terms = [normalized] + taxonomy.normalize_tag(text)["ids"]
+        for term in terms:
+            mask[self._posting(term)] = True
+        return mask
+
+    def _parse(self, tokens: List[str], size: int) -> np.ndarray:
+        position = 0
+
+        def peek() -> Optional[str]:
+            return tokens[position] if position < len(tokens) else None
+
+        def take() -> str:
+            nonlocal position
+            position += 1
+            return tokens[position - 1]
+
+        def parse_or() -> np.ndarray:
+            mask = parse_and()
+            while peek() is not None and peek().upper() == "OR":
+                take()
+                mask = mask | parse_and()
+            return mask
+
+        def parse_and() -> np.ndarray:
+            mask = parse_not()
+            while peek() is not None and peek() != ")" and peek().upper() != "OR":
+                if peek().upper() == "AND":
+                    take()
+                mask = mask & parse_not()
+            return mask
+
+        def parse_not() -> np.ndarray:
+            token = peek()
+            if token is None:
+                raise QuerySyntaxError("Query ends where a term was expected")
+            if token.upper() == "NOT":
+                take()
+                return ~parse_not()
+            if token.startswith("-") and len(token) > 1:
+                take()
+                return ~self._term_mask(token[1:].strip('"'), size)
+            return parse_atom()
+
+        def parse_atom() -> np.ndarray:
+            token = take()
+            if token == "(":
+                mask = parse_or()
+                if peek() != ")":
+                    raise QuerySyntaxError("Missing closing parenthesis")
+                take()
+                return mask
+            if token == ")" or token.upper() in ("AND", "OR"):
+                raise QuerySyntaxError(f"Unexpected '{token}'")
+            return self._term_mask(token.strip('"'), size)
+
+        mask = parse_or()
+        if position != len(tokens):
+            raise QuerySyntaxError(f"Unexpected '{tokens[position]}'")
+        return mask
+
+    def search(self, query: str, facets: Optional[List[str]] = None, limit: int = 50, offset: int = 0) -> Dict[str, Any]:
+        """Evaluate a boolean query; returns matching image ids (newest first) and taxonomy facet counts"""
+        started = time.perf_counter()
+        tokens = group_phrases(_QUERY_TOKEN.findall(query))
+        with self._lock:
+            size = len(self._image_ids)
+            mask = self._parse(tokens, size) if tokens else np.ones(size, dtype=bool)
+            docs = np.flatnonzero(mask)
+            page = docs[::-1][offset:offset + max(0, min(limit, TAG_SEARCH_MAX_LIMIT))]
+            image_ids = [self._image_ids[doc] for doc in page]
+
+            taxonomy = get_taxonomy()
+            counts: Dict[str, Dict[str, int]] = {}
+            for concept_id, concept in taxonomy.concepts.items():
+                if facets is not None and concept["facet"] not in facets:
+                    continue
+                if concept_id not in self._postings:
+                    continue
+                posting = self._posting(concept_id)
+                if len(docs) * 8 < len(posting):
+                    # Few results: look them up in the posting instead of gathering the whole posting
+                    found = np.searchsorted(posting, docs)
+                    count = int(np.count_nonzero(posting[np.minimum(found, len(posting) - 1)] == docs))
+                else:
+                    count = int(np.count_nonzero(mask[posting]))
+                if count:
+                    counts.setdefault(concept["facet"], {})[concept_id] = count
+            self.stats["queries"] += 1
+            self.stats["last_query_ms"] = round((time.perf_counter() - started) * 1000, 3)
+        return {
+            "total": len(docs),
+            "image_ids": image_ids,
+            "facets": {facet: dict(sorted(values.items(), key=lambda item: -item[1])) for facet, values in counts.items()},
+        }
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                **self.stats,
+                "images": len(self._image_ids),
+                "terms": len(self._postings),
+                "postings": sum(len(postings) for postings in self._postings.values()),
+                "compressed_bytes": sum(postings.nbytes() for postings in self._postings.values()),
+            }
+
+
+_index: Optional[TagIndex] = None
+
+
+def get_tag_index() -> TagIndex:
+    global _index
+    if _index is None:
+        _index = TagIndex()
+    return _index
@@ -0,0 +1,216 @@
+"""
+Skypad taxonomy normalization of free-form model tags.
+
+The taxonomy (skypad_taxonomy.json, or a YAML file when PyYAML is installed) is versioned and groups
+concepts by facet - furniture type, space, style, material, project stage. Each concept has a label
+and aliases. On load it is compiled into:
+  - a word-level trie of every normalized label and alias, for exact/alias matches of a whole tag
+    and longest-match scanning inside longer tags ("velvet lounge chair" -> velvet + lounge chair),
+  - a precomputed matrix of character-trigram embeddings of the same phrases: a tag the trie misses
+    ("loungechair", "tekwood") is matched to the most similar phrase with one matrix-vector product
+    if the cosine similarity clears TAXONOMY_SIMILARITY_THRESHOLD. Only phrases of about the same
+    length compete (TAXONOMY_SIMILARITY_MIN_LENGTH_RATIO), so a one-word tag does not match every
+    longer alias that starts with it.
+Results are memoized per normalized tag, so normalizing is a dictionary lookup after the first time
+and never needs a model call.
+"""
+import os
+import re
+import unicodedata
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+# Try to import PyYAML - not critical (the bundled taxonomy is JSON)
+try:
+    import yaml
+    has_yaml = True
+except ImportError:
+    has_yaml = False
+
+TAXONOMY_PATH = os.getenv("SKYPAD_TAXONOMY", os.path.join(os.path.dirname(os.path.abspath(__file__)), "skypad_taxonomy.json"))
+TAXONOMY_SIMILARITY_THRESHOLD = float(os.getenv("TAXONOMY_SIMILARITY_THRESHOLD", "0.6"))
+# Shorter/longer letter count a similar phrase may have, so "floor" is not matched to "floor mirror"
+TAXONOMY_SIMILARITY_MIN_LENGTH_RATIO = float(os.getenv("TAXONOMY_SIMILARITY_MIN_LENGTH_RATIO", "0.75"))
+TAXONOMY_CACHE_SIZE = int(os.getenv("TAXONOMY_CACHE_SIZE", "50000"))
+EMBEDDING_DIM = 2048
+
+_NON_WORD = re.compile(r"[^a-z0-9]+")
+_TERMINAL = "$"
+
+
+def singular(token: str) -> str:
+    """Cheap English singularization so "chairs" and "chair" share a trie path"""
+    if len(token) <= 3 or token.endswith(("ss", "us", "is")):
+        return token
+    if token.endswith("ies"):
+        return token[:-3] + "y"
+    if token.endswith(("ches", "shes", "xes", "sses")):
+        return token[:-2]
+    if token.endswith("s"):
+        return token[:-1]
+    return token
+
+
+def normalize_text(text: str) -> Tuple[str, ...]:
+    """Casefold, strip accents and punctuation, singularize: "Bouclé Armchairs" -> ("boucle", "armchair")"""
+    text = unicodedata.normalize("NFKD", str(text)).encode("ascii", "ignore").decode().casefold()
+    return tuple(singular(token) for token in _NON_WORD.sub(" ", text).split())
+
+
+def trigram_embedding(text: str, dim: int = EMBEDDING_DIM) -> np.ndarray:
+    """L2-normalized hashed bag of character trigrams (word boundaries marked), e.g. for typo/spacing variants"""
+    vector = np.zeros(dim, dtype=np.float32)
+    padded = f"#{text.replace(' ', '#')}#"
+    for i in range(len(padded) - 2):
+        vector[zlib.crc32(padded[i:i + 3].encode()) % dim] += 1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def load_taxonomy_file(path: str) -> Dict[str, Any]:
+    import json
+
+    with open(path, encoding="utf-8") as f:
+        if path.endswith((".yaml", ".yml")):
+            if not has_yaml:
+                raise RuntimeError("PyYAML is required for a YAML taxonomy. Install with: pip install pyyaml")
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+class Taxonomy:
+    """A compiled taxonomy: canonical concepts, synonym trie and trigram similarity matrix"""
+
+    def __init__(self, data: Dict[str, Any]):
+        self.name = data.get("name", "skypad")
+        self.version = str(data["version"])
+        self.concepts: Dict[str, Dict[str, str]] = {}
+        self._trie: Dict[str, Any] = {}
+        phrases: Dict[Tuple[str, ...], List[str]] = {}
+        for facet, concepts in data["facets"].items():
+            for concept in concepts:
+                concept_id = f"{facet}.{concept['id']}"
+                self.concepts[concept_id] = {"id": concept_id, "facet": facet, "label": concept["label"]}
+                for phrase, kind in [(concept["label"], "exact"), (concept["id"].replace("_", " "), "exact")] + [(alias, "alias") for alias in concept.get("aliases", [])]:
+                    tokens = normalize_text(phrase)
+                    if tokens:
+                        self._insert(tokens, concept_id, kind)
+                        phrases.setdefault(tokens, [])
+                        if concept_id not in phrases[tokens]:
+                            phrases[tokens].append(concept_id)
+
+        self._phrase_ids = list(phrases.values())
+        self._matrix = np.stack([trigram_embedding(" ".join(tokens)) for tokens in phrases])
+        self._phrase_letters = np.array([sum(len(token) for token in tokens) for tokens in phrases], dtype=np.float32)
+        self._cache: "OrderedDict[Tuple[str, ...], Dict[str, Any]]" = OrderedDict()
+        self.stats = {"lookups": 0, "cache_hits": 0, "exact": 0, "alias": 0, "partial": 0, "similar": 0, "unmatched": 0}
+
+    def _insert(self, tokens: Tuple[str, ...], concept_id: str, kind: str) -> None:
+        node = self._trie
+        for token in tokens:
+            node = node.setdefault(token, {})
+        matches = node.setdefault(_TERMINAL, {})
+        # A label beats an alias when the same phrase is both
+        if matches.get(concept_id) != "exact":
+            matches[concept_id] = kind
+
+    def _longest_match(self, tokens: Tuple[str, ...], start: int) -> Tuple[int, Optional[Dict[str, str]]]:
+        node, end, found = self._trie, start, None
+        for i in range(start, len(tokens)):
+            node = node.get(tokens[i])
+            if node is None:
+                break
+            if _TERMINAL in node:
+                end, found = i + 1, node[_TERMINAL]
+        return end, found
+
+    def phrase_end(self, tokens: Tuple[str, ...], start: int) -> int:
+        """End of the longest label or alias starting at tokens[start], or `start` when none does"""
+        end, found = self._longest_match(tokens, start)
+        return end if found else start
+
+    def _match(self, tokens: Tuple[str, ...]) -> Dict[str, Any]:
+        end, found = self._longest_match(tokens, 0)
+        if found and end == len(tokens):
+            kind = "exact" if "exact" in found.values() else "alias"
+            return {"ids": list(found), "match": kind, "score": 1.0}
+
+        # Scan for known phrases inside the tag, longest first at each position
+        ids: List[str] = []
+        start = 0
+        while start < len(tokens):
+            end, found = self._longest_match(tokens, start)
+            if found:
+                ids.extend(concept_id for concept_id in found if concept_id not in ids)
+                start = end
+            else:
+                start += 1
+        if ids:
+            return {"ids": ids, "match": "partial", "score": 1.0}
+
+        similarities = self._matrix @ trigram_embedding(" ".join(tokens))
+        letters = sum(len(token) for token in tokens)
+        ratios = np.minimum(self._phrase_letters, letters) / np.maximum(self._phrase_letters, letters)
+        similarities[ratios < TAXONOMY_SIMILARITY_MIN_LENGTH_RATIO] = 0.0
+        best = int(np.argmax(similarities))
+        if similarities[best] >= TAXONOMY_SIMILARITY_THRESHOLD:
+            return {"ids": list(self._phrase_ids[best]), "match": "similar", "score": round(float(similarities[best]), 3)}
+        return {"ids": [], "match": None, "score": 0.0}
+
+    def normalize_tag(self, tag: str) -> Dict[str, Any]:
+        """Canonical concept ids for one free-form tag, with how they were matched"""
+        self.stats["lookups"] += 1
+        tokens = normalize_text(tag)
+        match = self._cache.get(tokens)
+        if match is not None:
+            self.stats["cache_hits"] += 1
+            self._cache.move_to_end(tokens)
+        else:
+            match = self._match(tokens) if tokens else {"ids": [], "match": None, "score": 0.0}
+            self._cache[tokens] = match
+            if len(self._cache) > TAXONOMY_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        self.stats[match["match"] or "unmatched"] += 1
+        return {"tag": tag, **match}
+
+    def normalize_tags(self, tags: List[str]) -> Dict[str, Any]:
+        """Normalize a result's tags: per-tag matches plus the de-duplicated ids grouped by facet"""
+        matches = [self.normalize_tag(tag) for tag in tags]
+        ids: List[str] = []
+        for match in matches:
+            ids.extend(concept_id for concept_id in match["ids"] if concept_id not in ids)
+        facets: Dict[str, List[str]] = {}
+        for concept_id in ids:
+            facets.setdefault(self.concepts[concept_id]["facet"], []).append(concept_id)
+        return {"version": self.version, "ids": ids, "facets": facets, "tags": matches}
+
+    def describe(self) -> Dict[str, Any]:
+        facets: Dict[str, List[Dict[str, str]]] = {}
+        for concept in self.concepts.values():
+            facets.setdefault(concept["facet"], []).append({"id": concept["id"], "label": concept["label"]})
+        return {"name": self.name, "version": self.version, "facets": facets}
+
+
+_taxonomy: Optional[Taxonomy] = None
+
+
+def get_taxonomy() -> Taxonomy:
+    global _taxonomy
+    if _taxonomy is None:
+        _taxonomy = Taxonomy(load_taxonomy_file(TAXONOMY_PATH))
+    return _taxonomy
+
+
+def with_taxonomy(result: Dict[str, Any]) -> Dict[str, Any]:
+    """A copy of a successful analysis result with canonical taxonomy ids next to its raw tags.
+    Applied after the cache, so a new taxonomy version takes effect without invalidating analyses."""
+    if not result.get("success") or not result.get("tags"):
+        return result
+    try:
+        return {**result, "taxonomy": get_taxonomy().normalize_tags(result["tags"])}
+    except Exception as e:
+        print(f"Taxonomy normalization failed: {e}")
+        return result
@@ -0,0 +1,16 @@
+import os
+import shutil
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Stores opened by the tests (analysis cache, job queue, embeddings...) live in a throwaway directory,
+# never in the working tree's data/
+DATA_DIR = tempfile.mkdtemp(prefix="skypad-tests-")
+os.environ["SKYPAD_DATA_DIR"] = DATA_DIR
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(DATA_DIR, ignore_errors=True)
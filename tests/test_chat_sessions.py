@@ -0,0 +1,78 @@
+import time
+
+from chat_sessions import ChatSession, ChatSessionStore, chat_turn
+
+
+def turn(role, tokens):
+    return {"role": role, "content": f"{role} message", "tokens": tokens}
+
+
+def conversation(*token_counts):
+    roles = ("user", "assistant")
+    return ChatSession("session", [turn(roles[i % 2], tokens) for i, tokens in enumerate(token_counts)])
+
+
+def test_window_keeps_the_most_recent_messages_within_budget():
+    session = conversation(50, 50, 30, 20, 10, 5)
+    messages, used = session.window(70)
+    assert used == 65  # 30 + 20 + 10 + 5; the next 50 would go over
+    assert [message["role"] for message in messages] == ["user", "assistant", "user", "assistant"]
+
+
+def test_window_never_opens_on_an_orphaned_reply():
+    session = conversation(50, 50, 30, 20, 10, 5)
+    # 20 + 10 + 5 fit, but the 20-token reply would lose its question
+    messages, used = session.window(40)
+    assert [message["role"] for message in messages] == ["user", "assistant"]
+    assert used == 15
+    assert all(set(message) == {"role", "content"} for message in messages)
+
+
+def test_window_with_everything_in_budget():
+    session = conversation(10, 10, 10)
+    messages, used = session.window(1000)
+    assert len(messages) == 3 and used == 30
+
+
+def test_message_cap_drops_the_oldest(monkeypatch):
+    import chat_sessions
+
+    monkeypatch.setattr(chat_sessions, "CHAT_SESSION_MAX_MESSAGES", 4)
+    session = ChatSession("session")
+    for i in range(3):
+        session.add(chat_turn("user", f"question {i}"), chat_turn("assistant", f"answer {i}"))
+    assert [message["content"] for message in session.messages] == ["question 1", "answer 1", "question 2", "answer 2"]
+
+
+def test_compaction_replaces_the_folded_turns_and_rejects_stale_results():
+    session = conversation(10, 10, 10, 10)
+    folded = session.messages[:2]
+    assert session.compact(folded, "The customer wants a velvet sofa.", version=0)
+    assert len(session.messages) == 2
+    assert session.summary_message()["content"].endswith("velvet sofa.")
+    assert session.history_tokens() == 20 + session.summary["tokens"]
+    # A compaction started before this one no longer matches the history
+    assert not session.compact(session.messages[:1], "stale", version=0)
+
+
+def test_store_round_trips_sessions_through_sqlite(tmp_path):
+    db_path = str(tmp_path / "sessions.sqlite3")
+    store = ChatSessionStore(db_path=db_path)
+    session = store.get(None)
+    session.add(chat_turn("user", "Do you have velvet lounge chairs?"), chat_turn("assistant", "Yes, in six colours."))
+    store.save(session)
+
+    restarted = ChatSessionStore(db_path=db_path)
+    loaded = restarted.get(session.session_id)
+    assert loaded.messages == session.messages
+    assert restarted.stats["disk_hits"] == 1
+
+
+def test_expired_sessions_are_replaced(tmp_path):
+    store = ChatSessionStore(ttl_seconds=60, db_path=str(tmp_path / "sessions.sqlite3"))
+    session = store.get(None)
+    session.add(chat_turn("user", "hello"))
+    session.updated_at = time.time() - 120
+    store.save(session)
+    assert store.get(session.session_id).session_id != session.session_id
+    assert store.stats["expired"] == 1
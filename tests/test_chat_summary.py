@@ -0,0 +1,60 @@
+import asyncio
+
+from chat_sessions import ChatSession, ChatSessionStore
+from chat_summary import ConversationCompactor, summary_request, turns_to_fold
+
+
+def session_with(*token_counts):
+    roles = ("user", "assistant")
+    return ChatSession("session", [{"role": roles[i % 2], "content": f"message {i}", "tokens": tokens}
+                                   for i, tokens in enumerate(token_counts)])
+
+
+def test_folds_the_oldest_turns_until_keep_tokens_remain():
+    session = session_with(100, 100, 40, 40, 20, 20)
+    folded = turns_to_fold(session, keep_tokens=120)  # 40 + 40 + 20 + 20 are kept
+    assert [turn["content"] for turn in folded] == ["message 0", "message 1"]
+
+
+def test_kept_history_starts_with_a_user_message():
+    session = session_with(100, 100, 40, 40, 20, 20)
+    # 40 + 20 + 20 fit in 100, which would start the kept part on an assistant reply
+    folded = turns_to_fold(session, keep_tokens=100)
+    assert len(folded) == 4
+    assert session.messages[len(folded)]["role"] == "user"
+
+
+def test_nothing_to_fold_when_everything_fits():
+    assert turns_to_fold(session_with(10, 10), keep_tokens=100) == []
+
+
+def test_summary_request_carries_the_previous_summary_and_transcript():
+    messages = summary_request("Wants a sofa.", session_with(5, 5).messages)
+    assert messages[0]["role"] == "system"
+    assert "Wants a sofa." in messages[1]["content"]
+    assert "Customer: message 0\n\nBella: message 1" in messages[1]["content"]
+
+
+def test_compactor_only_schedules_long_histories(monkeypatch):
+    import chat_summary
+
+    async def summarize(previous, turns, api_key):
+        return f"{len(turns)} turns summarized"
+
+    monkeypatch.setattr(chat_summary, "summarize", summarize)
+
+    async def run():
+        # Longer than the default CHAT_COMPACTION_KEEP_TOKENS (1000) in total, so there is something to fold
+        compactor = ConversationCompactor(trigger_tokens=2000)
+        store = ChatSessionStore(db_path=None)
+        short, long = session_with(500, 500), session_with(1000, 1000, 400, 400, 200, 200)
+        assert not compactor.schedule(short, store, "sk-test")
+        assert compactor.schedule(long, store, "sk-test")
+        assert not compactor.schedule(long, store, "sk-test")  # one at a time per session
+        await asyncio.gather(*compactor._tasks.values())
+        return compactor, long
+
+    compactor, session = asyncio.run(run())
+    assert compactor.stats["compactions"] == 1
+    assert session.summary_message()["content"].endswith("turns summarized")
+    assert [turn["content"] for turn in session.messages] == ["message 4", "message 5"]
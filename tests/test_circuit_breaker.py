@@ -0,0 +1,127 @@
+import asyncio
+
+import pytest
+
+import circuit_breaker
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, ProviderGuard, ProviderUnavailableError, is_failure
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(circuit_breaker.time, "monotonic", clock)
+    return clock
+
+
+def breaker(**kwargs):
+    options = {"window_seconds": 60, "min_calls": 4, "failure_rate": 0.5, "open_seconds": 30, "half_open_calls": 2}
+    return CircuitBreaker(**{**options, **kwargs})
+
+
+def test_opens_once_enough_calls_fail(clock):
+    b = breaker()
+    for succeeded in (True, False, False):
+        b.record(succeeded)
+    assert b.state == CLOSED  # below min_calls
+    b.record(True)
+    assert b.state == OPEN
+    assert not b.allow()
+    assert b.retry_after() == 30
+
+
+def test_failures_outside_the_window_are_forgotten(clock):
+    b = breaker()
+    for _ in range(3):
+        b.record(False)
+    clock.now += 61
+    b.record(False)
+    assert b.state == CLOSED
+    assert b.error_rate() == 1.0
+
+
+def test_half_open_trials_close_or_reopen(clock):
+    b = breaker()
+    for _ in range(4):
+        b.record(False)
+    clock.now += 31
+    assert b.allow() and b.state == HALF_OPEN
+    assert b.allow()
+    assert not b.allow()  # only half_open_calls trials at a time
+    b.record(True)
+    b.record(True)
+    assert b.state == CLOSED
+
+    for _ in range(4):
+        b.record(False)
+    clock.now += 31
+    assert b.allow()
+    b.record(False)
+    assert b.state == OPEN
+    assert b.opened_count == 3  # opened, re-opened after closing, re-opened by the failed trial
+
+
+def test_cancelled_trial_frees_its_slot(clock):
+    b = breaker(half_open_calls=1)
+    for _ in range(4):
+        b.record(False)
+    clock.now += 31
+    assert b.allow()
+    assert not b.allow()
+    b.cancel_trial()
+    assert b.allow()
+
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+class ResourceExhausted(Exception):
+    code = 429
+
+
+class ServiceUnavailable(Exception):
+    code = 503
+
+
+@pytest.mark.parametrize("outcome, failed", [
+    (StatusError(503), True),
+    (StatusError(400), False),
+    (StatusError(429), False),
+    (ServiceUnavailable(), True),
+    (ResourceExhausted(), False),
+    (TimeoutError(), True),
+    (ConnectionResetError(), True),
+    (FileNotFoundError("credentials.json"), False),
+    (ValueError("bad image"), False),
+])
+def test_is_failure_counts_only_upstream_errors(outcome, failed):
+    assert is_failure(outcome) is failed
+
+
+def test_guard_rejects_calls_while_open(clock):
+    guard = ProviderGuard("test", max_concurrency=2, max_queue=2, breaker=breaker(min_calls=2))
+
+    async def fail():
+        raise StatusError(502)
+
+    async def run():
+        for _ in range(2):
+            with pytest.raises(StatusError):
+                await guard.call(fail)
+        with pytest.raises(ProviderUnavailableError) as rejected:
+            await guard.call(fail)
+        return rejected.value
+
+    rejected = asyncio.run(run())
+    assert rejected.retry_after == 30
+    assert guard.stats == {"calls": 2, "failures": 2, "rejected_open": 1, "rejected_full": 0}
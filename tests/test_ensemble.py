@@ -0,0 +1,54 @@
+import pytest
+
+from ensemble import fuse_tags, fused_result, provider_tag_scores
+
+
+def openai_result(tags):
+    return {"success": True, "tags": tags, "caption": "OpenAI caption", "explanation": "", "raw_response": {}}
+
+
+def google_result(labels):
+    return {
+        "success": True,
+        "tags": [description for description, _ in labels],
+        "caption": "Google caption",
+        "raw_response": {"labels": [{"description": description, "score": score} for description, score in labels]},
+    }
+
+
+def test_openai_confidence_decays_with_position():
+    scores = provider_tag_scores("openai", openai_result(["Chair", "velvet", "chair"] + [f"tag {i}" for i in range(10)]))
+    assert scores["chair"] == ("Chair", 1.0)  # the first spelling wins, duplicates are ignored
+    assert scores["velvet"][1] == pytest.approx(0.88)
+    assert scores["tag 9"][1] == 0.3  # floor
+
+
+def test_tags_both_providers_agree_on_rank_first():
+    fused = fuse_tags({
+        "openai": openai_result(["lounge chair", "velvet", "hotel lobby"]),
+        "google": google_result([("Furniture", 0.95), ("Velvet", 0.9), ("Lounge chair", 0.6)]),
+    })
+    assert [entry["tag"] for entry in fused[:2]] == ["velvet", "lounge chair"]
+    velvet = fused[0]
+    assert velvet["score"] == pytest.approx((0.88 + 0.9) / 2)
+    assert velvet["sources"] == {"openai": 0.88, "google": 0.9}
+    # A tag only one provider saw is averaged with a 0 from the other
+    assert next(entry for entry in fused if entry["tag"] == "Furniture")["score"] == pytest.approx(0.95 / 2)
+
+
+def test_failed_providers_do_not_dilute_the_scores():
+    fused = fuse_tags({
+        "openai": openai_result(["sofa"]),
+        "google": {"success": False, "error": "quota"},
+    })
+    assert fused == [{"tag": "sofa", "score": 1.0, "sources": {"openai": 1.0}}]
+
+
+def test_fused_result_reports_all_failures_with_the_shortest_retry_hint():
+    result = fused_result({
+        "openai": {"success": False, "error": "circuit open", "retry_after": 12},
+        "google": {"success": False, "error": "circuit open", "retry_after": 5},
+    })
+    assert not result["success"]
+    assert result["retry_after"] == 5
+    assert "openai: circuit open" in result["error"] and "google: circuit open" in result["error"]
@@ -0,0 +1,70 @@
+import os
+
+import pytest
+
+from ingest import Manifest, crawl, job_items
+from jobs import JobStore
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / "tree"
+    (root / "lobby").mkdir(parents=True)
+    for name in ("a.jpg", "b.jpg", "lobby/c.png"):
+        (root / name).write_bytes(f"image {name}".encode())
+    (root / "notes.txt").write_text("not an image")
+    (root / ".hidden.jpg").write_bytes(b"skipped")
+    return root
+
+
+def record(manifest, summary, job_id=None):
+    manifest.update([row + (job_id,) for row in summary["changed"]] + [row + (None,) for row in summary["touched_files"]],
+                    summary["removed"])
+
+
+def counts(summary):
+    return {key: summary[key] for key in ("scanned", "new", "modified", "touched", "unchanged", "retried")}
+
+
+def test_crawl_classifies_files_against_the_manifest(tree, tmp_path):
+    manifest = Manifest(str(tmp_path / "ingest.sqlite3"))
+    first = crawl(str(tree), manifest)
+    assert counts(first) == {"scanned": 3, "new": 3, "modified": 0, "touched": 0, "unchanged": 0, "retried": 0}
+    record(manifest, first, "job-1")
+
+    assert counts(crawl(str(tree), manifest)) == {"scanned": 3, "new": 0, "modified": 0, "touched": 0, "unchanged": 3, "retried": 0}
+
+    (tree / "a.jpg").write_bytes(b"edited image a")
+    stat = (tree / "b.jpg").stat()
+    os.utime(tree / "b.jpg", ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    (tree / "lobby" / "c.png").unlink()
+    (tree / "d.jpg").write_bytes(b"image d")
+    summary = crawl(str(tree), manifest)
+    assert counts(summary) == {"scanned": 3, "new": 1, "modified": 1, "touched": 1, "unchanged": 0, "retried": 0}
+    assert sorted(os.path.basename(path) for path, _, _, _ in summary["changed"]) == ["a.jpg", "d.jpg"]
+    assert [os.path.basename(path) for path, _, _, _ in summary["touched_files"]] == ["b.jpg"]
+    assert summary["removed"] == [str(tree / "lobby" / "c.png")]
+
+    record(manifest, summary, "job-2")
+    assert counts(crawl(str(tree), manifest))["unchanged"] == 3
+
+
+def test_files_whose_analysis_failed_are_enqueued_again(tree, tmp_path):
+    manifest = Manifest(str(tmp_path / "ingest.sqlite3"))
+    jobs = JobStore(str(tmp_path / "jobs.sqlite3"))
+    summary = crawl(str(tree), manifest, jobs)
+    jobs.create_job("job-1", "openai", True, job_items(summary["root"], "job-1", summary["changed"]))
+    record(manifest, summary, "job-1")
+    while (item := jobs.claim_next()) is not None:
+        failed = item["filename"] == "a.jpg"
+        jobs.finish_item(item["job_id"], item["seq"], "failed" if failed else "done", None if failed else {"success": True},
+                         "quota exhausted" if failed else None)
+
+    retry = crawl(str(tree), manifest, jobs)
+    assert counts(retry) == {"scanned": 3, "new": 0, "modified": 0, "touched": 0, "unchanged": 2, "retried": 1}
+    assert [os.path.basename(path) for path, _, _, _ in retry["changed"]] == ["a.jpg"]
+
+    # Once it has been enqueued in a newer job, the old failure no longer counts
+    jobs.create_job("job-2", "openai", True, job_items(retry["root"], "job-2", retry["changed"]))
+    record(manifest, retry, "job-2")
+    assert counts(crawl(str(tree), manifest, jobs))["unchanged"] == 3
@@ -0,0 +1,108 @@
+import asyncio
+import time
+
+import pytest
+
+import rate_limit
+from rate_limit import PRIORITY_BATCH, PRIORITY_CHAT, PRIORITY_IMAGE, RateLimiter, TokenBucket, parse_duration
+
+
+class Response:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+@pytest.fixture(autouse=True)
+def short_backoff(monkeypatch):
+    monkeypatch.setattr(rate_limit, "RATE_LIMIT_BACKOFF_BASE_SECONDS", 0.01)
+
+
+@pytest.mark.parametrize("value, seconds", [("20ms", 0.02), ("1s", 1.0), ("6m0s", 360.0), ("1h2m", 3720.0), ("2.5", 2.5), ("soon", None), (None, None)])
+def test_parse_duration(value, seconds):
+    if seconds is None:
+        assert parse_duration(value) is None
+    else:
+        assert parse_duration(value) == pytest.approx(seconds)
+
+
+def test_token_bucket_refills_at_its_rate(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(rate_limit.time, "monotonic", lambda: now[0])
+    bucket = TokenBucket(60)  # one unit per second
+    bucket.take(60)
+    assert bucket.delay(3) == pytest.approx(3.0)
+    now[0] += 2
+    assert bucket.delay(3) == pytest.approx(1.0)
+    now[0] += 100
+    assert bucket.delay(3) == 0.0
+    assert bucket.level == 60  # never above capacity
+
+
+def test_headers_correct_the_buckets():
+    limiter = RateLimiter("test", 10000, 2000000)
+    limiter.update_from_headers({
+        "x-ratelimit-limit-requests": "500", "x-ratelimit-remaining-requests": "20",
+        "x-ratelimit-limit-tokens": "30000", "x-ratelimit-remaining-tokens": "100",
+    })
+    assert limiter.requests.capacity == 500
+    assert limiter.requests.level == pytest.approx(20, abs=1)
+    assert limiter.tokens.capacity == 30000
+    assert limiter.tokens.level == pytest.approx(100, abs=1)
+
+
+def test_waiting_calls_are_served_by_priority_then_arrival():
+    async def run():
+        limiter = RateLimiter("test", 6000)  # 100 requests a second
+        limiter.requests.take(limiter.requests.capacity)
+        order = []
+
+        async def call(name, priority):
+            await limiter.acquire(priority=priority)
+            order.append(name)
+
+        tasks = [asyncio.create_task(call(name, priority)) for name, priority in (
+            ("batch-1", PRIORITY_BATCH), ("batch-2", PRIORITY_BATCH), ("image", PRIORITY_IMAGE), ("chat", PRIORITY_CHAT),
+        )]
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(run()) == ["chat", "image", "batch-1", "batch-2"]
+
+
+def test_429_pauses_the_quota_and_retries():
+    async def run():
+        limiter = RateLimiter("test", 10000)
+        responses = [Response(429, {"retry-after-ms": "200"}), Response(200)]
+
+        async def throttled():
+            return responses.pop(0)
+
+        async def other():
+            await asyncio.sleep(0.05)  # starts while the quota is paused
+            started = time.monotonic()
+            await limiter.acquire(priority=PRIORITY_CHAT)
+            return time.monotonic() - started
+
+        result, waited = await asyncio.gather(limiter.run(throttled), other())
+        return limiter, result, waited
+
+    limiter, result, waited = asyncio.run(run())
+    assert result.status_code == 200
+    assert limiter.stats["throttled"] == 1 and limiter.stats["retries"] == 1 and limiter.stats["failures"] == 0
+    assert waited >= 0.1
+
+
+def test_gives_up_after_max_attempts(monkeypatch):
+    monkeypatch.setattr(rate_limit, "RATE_LIMIT_MAX_ATTEMPTS", 3)
+    calls = []
+
+    async def unavailable():
+        calls.append(1)
+        return Response(503)
+
+    limiter = RateLimiter("test", 10000)
+    result = asyncio.run(limiter.run(unavailable))
+    assert result.status_code == 503
+    assert len(calls) == 3
+    assert limiter.stats["failures"] == 1 and limiter.stats["throttled"] == 0
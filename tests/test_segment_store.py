@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+from segment_store import TAGS_WIDTH, SegmentedStore, pack_tags
+
+DIM = 8
+
+
+def unit_vectors(n, seed=0):
+    vectors = np.random.default_rng(seed).normal(size=(n, DIM)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def rows(vectors, offset=0):
+    return [(f"{offset + i:064x}", vector, [f"tag {offset + i}", "velvet"], f"caption {offset + i}") for i, vector in enumerate(vectors)]
+
+
+def stored(store):
+    """(ids, vectors) of every row, in global row order"""
+    segments = store.segments()
+    ids = [segment.image_id(row) for segment in segments for row in range(segment.count)]
+    return ids, np.concatenate([segment.vectors for segment in segments])
+
+
+def test_append_and_merge_round_trip(tmp_path):
+    store = SegmentedStore(str(tmp_path), DIM, np.float32, capacity=4)
+    vectors = unit_vectors(10)
+    assert store.add_many(rows(vectors)) == 10
+    # 10 rows with room for 4 in the append segment: merged twice, rows kept in insertion order
+    assert store.base.count == 8 and store.append_segment.count == 2
+    assert store.base.merged_generation == 2 and store.append_segment.generation == 3
+    ids, matrix = stored(store)
+    assert ids == [f"{i:064x}" for i in range(10)]
+    np.testing.assert_array_equal(matrix, vectors)
+
+    segment, row = store.find(f"{3:064x}")  # binary search in the base segment's sorted id column
+    assert segment is store.base and segment.metadata(row) == {"tags": ["tag 3", "velvet"], "caption": "caption 3"}
+    segment, row = store.find(f"{9:064x}")
+    assert segment is store.append_segment and row == 1
+    assert store.find("missing") == (None, -1)
+
+    # Known ids are skipped
+    assert store.add_many(rows(vectors[:3])) == 0
+
+
+def test_reopened_and_concurrent_readers_see_merged_rows(tmp_path):
+    writer = SegmentedStore(str(tmp_path), DIM, np.float32, capacity=4)
+    reader = SegmentedStore(str(tmp_path), DIM, np.float32, capacity=4)
+    vectors = unit_vectors(6)
+    writer.add_many(rows(vectors[:3]))
+    assert stored(reader)[0] == stored(writer)[0]  # appends show up through the shared mapping
+
+    writer.add_many(rows(vectors[3:], offset=3))  # merges: both files are replaced
+    assert reader.refresh()
+    ids, matrix = stored(reader)
+    assert ids == [f"{i:064x}" for i in range(6)]
+    np.testing.assert_array_equal(matrix, vectors)
+
+    reopened = SegmentedStore(str(tmp_path), DIM, np.float32, capacity=4)
+    assert stored(reopened)[0] == ids
+
+
+def test_half_finished_merge_does_not_count_rows_twice(tmp_path):
+    store = SegmentedStore(str(tmp_path), DIM, np.float32, capacity=4)
+    store.add_many(rows(unit_vectors(3)))
+    old_append = store.append_segment
+    store.merge()
+    # A reader that mapped the new base but still holds the old append segment
+    store.append_segment = old_append
+    assert len(stored(store)[0]) == 3
+
+
+@pytest.mark.parametrize("tags, expected", [
+    (["a", "b"], ["a", "b"]),
+    (["x" * (TAGS_WIDTH - 2), "too long"], ["x" * (TAGS_WIDTH - 2)]),  # whole tags only
+])
+def test_pack_tags_keeps_whole_tags(tags, expected):
+    assert pack_tags(tags).decode().split("\x1f") == expected
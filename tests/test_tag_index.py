@@ -0,0 +1,21 @@
+from tag_index import TagIndex
+from taxonomy import get_taxonomy
+
+
+def add(index, image_id, tags):
+    index.add(image_id, {"tags": tags, "taxonomy": get_taxonomy().normalize_tags(tags)})
+
+
+def test_documented_query_groups_bare_words_into_taxonomy_phrases(tmp_path):
+    index = TagIndex(str(tmp_path / "tags.sqlite3"))
+    add(index, "velvet-lounge-chair", ["lounge chair", "velvet"])
+    add(index, "leather-lounge-chair", ["armchair", "leather"])
+    add(index, "outdoor-lounge-chair", ["lounge chair", "leather", "outdoor"])
+    add(index, "velvet-sofa", ["sofa", "velvet"])
+    add(index, "hotel-lounge", ["lounge", "velvet"])
+
+    result = index.search("lounge chair AND (velvet OR leather) NOT outdoor")
+    assert sorted(result["image_ids"]) == ["leather-lounge-chair", "velvet-lounge-chair"]
+
+    assert index.search("lounge chair")["total"] == 3
+    assert index.search('"lounge chair"')["total"] == 3
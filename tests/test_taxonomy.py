@@ -0,0 +1,69 @@
+import pytest
+
+from taxonomy import Taxonomy, get_taxonomy, normalize_text
+
+SMALL = {
+    "version": "test",
+    "facets": {
+        "furniture_type": [
+            {"id": "lounge_chair", "label": "Lounge chair", "aliases": ["armchair"]},
+            {"id": "mirror", "label": "Mirror", "aliases": ["floor mirror"]},
+        ],
+        "material": [{"id": "velvet", "label": "Velvet"}],
+    },
+}
+
+
+def test_normalize_text():
+    assert normalize_text("Bouclé Armchairs!") == ("boucle", "armchair")
+    assert normalize_text("glass") == ("glass",)
+
+
+@pytest.mark.parametrize("tag, ids, match", [
+    ("Lounge chairs", ["furniture_type.lounge_chair"], "exact"),
+    ("armchair", ["furniture_type.lounge_chair"], "alias"),
+    ("velvet lounge chair", ["material.velvet", "furniture_type.lounge_chair"], "partial"),
+    ("loungechair", ["furniture_type.lounge_chair"], "similar"),
+    ("floor", [], None),  # a prefix of the "floor mirror" alias is not a phrase
+    ("spaceship", [], None),
+])
+def test_match_kinds(tag, ids, match):
+    result = Taxonomy(SMALL).normalize_tag(tag)
+    assert (result["ids"], result["match"]) == (ids, match)
+
+
+def test_results_are_memoized():
+    taxonomy = Taxonomy(SMALL)
+    taxonomy.normalize_tag("Armchair")
+    taxonomy.normalize_tag("armchairs")
+    assert taxonomy.stats["cache_hits"] == 1
+
+
+def test_phrase_end_is_the_longest_match():
+    taxonomy = Taxonomy(SMALL)
+    tokens = normalize_text("velvet floor mirror lounge")
+    assert taxonomy.phrase_end(tokens, 1) == 3
+    assert taxonomy.phrase_end(tokens, 3) == 3  # "lounge" alone is not a phrase
+
+
+# Generic labels Google Vision returns for most interior photos must not land on specific concepts
+@pytest.mark.parametrize("tag", ["Floor", "Room", "Building", "Chair", "Hotel", "Property", "Wall", "Ceiling", "Window"])
+def test_generic_labels_stay_unmatched(tag):
+    assert get_taxonomy().normalize_tag(tag)["ids"] == []
+
+
+@pytest.mark.parametrize("tag, concept_id", [
+    ("Couch", "furniture_type.sofa"),
+    ("Living room", "space.lounge"),
+    ("Hardwood", "material.wood"),
+    ("tekwood", "material.teak"),
+    ("sofaa", "furniture_type.sofa"),
+])
+def test_bundled_taxonomy_matches(tag, concept_id):
+    assert get_taxonomy().normalize_tag(tag)["ids"] == [concept_id]
+
+
+def test_normalize_tags_groups_ids_by_facet():
+    result = get_taxonomy().normalize_tags(["Velvet", "Armchair", "velvet armchair"])
+    assert result["ids"] == ["material.velvet", "furniture_type.lounge_chair"]
+    assert result["facets"] == {"material": ["material.velvet"], "furniture_type": ["furniture_type.lounge_chair"]}
@@ -0,0 +1,91 @@
+import json
+import os
+import socket
+import threading
+import time
+import tracemalloc
+
+import httpx
+import pytest
+import uvicorn
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The upload is ~13 MB; holding it in memory even once (let alone with a base64 copy) breaks the bound
+UPLOAD_MEGAPIXELS = 12
+MAX_PEAK_BYTES = 12 * 1024 * 1024
+
+COMPLETION = json.dumps({"choices": [{"message": {"content": json.dumps(
+    {"caption": "A lounge chair", "tags": ["lounge chair", "velvet"], "explanation": "Fake"}
+)}}]}).encode()
+
+
+async def fake_openai(scope, receive, send):
+    """Chat-completions stand-in that drains the request body chunk by chunk without keeping it"""
+    if scope["type"] != "http":
+        return
+    more_body = True
+    while more_body:
+        more_body = (await receive()).get("more_body", False)
+    await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"application/json")]})
+    await send({"type": "http.response.body", "body": COMPLETION})
+
+
+def serve(app):
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.02)
+    return server, thread, f"http://127.0.0.1:{port}"
+
+
+@pytest.fixture
+def app_url(monkeypatch):
+    monkeypatch.chdir(ROOT)  # the app serves ./static
+    import analysis
+    import main
+
+    fake, fake_thread, fake_url = serve(fake_openai)
+    monkeypatch.setattr(analysis, "OPENAI_API_BASE", f"{fake_url}/v1")
+    monkeypatch.setattr(analysis, "PHASH_MAX_DISTANCE", -1)  # every request goes to the (fake) provider
+    app, app_thread, url = serve(main.app)
+    yield url
+    for server, thread in ((app, app_thread), (fake, fake_thread)):
+        server.should_exit = True
+        thread.join(timeout=10)
+
+
+def test_upload_peak_memory_stays_below_upload_size(app_url, tmp_path):
+    width = int((UPLOAD_MEGAPIXELS * 1e6 * 4 / 3) ** 0.5)
+    image_path = tmp_path / "upload.jpg"
+    Image.effect_noise((width, width * 3 // 4), 60).convert("RGB").save(image_path, format="JPEG", quality=97)
+    assert image_path.stat().st_size > MAX_PEAK_BYTES
+
+    tracemalloc.start()
+    try:
+        with httpx.Client(timeout=120) as client:
+            # The first request warms up the lazily created stores and pools
+            for i in range(2):
+                # Vary one byte so the exact-hash cache does not short-circuit the request
+                with open(image_path, "r+b") as f:
+                    f.seek(-3, os.SEEK_END)
+                    f.write(bytes([i]))
+                tracemalloc.reset_peak()
+                baseline, _ = tracemalloc.get_traced_memory()
+                with open(image_path, "rb") as f:
+                    response = client.post(
+                        f"{app_url}/analyze-image/",
+                        data={"model_name": "openai", "openai_api_key": "sk-test"},
+                        files={"image": ("upload.jpg", f, "image/jpeg")},
+                    )
+                peak = tracemalloc.get_traced_memory()[1] - baseline
+                assert response.status_code == 200
+                assert response.json()["success"], response.json()
+    finally:
+        tracemalloc.stop()
+
+    assert peak < MAX_PEAK_BYTES, f"peak {peak / 1e6:.1f} MB for a {image_path.stat().st_size / 1e6:.1f} MB upload"
@@ -0,0 +1,122 @@
+"""
+Bounded, spooled handling of image uploads.
+
+Multipart file parts are streamed by Starlette into a SpooledTemporaryFile that rolls over to disk
+above UPLOAD_SPOOL_THRESHOLD. The endpoints work from that file directly (incremental hashing,
+Pillow decoding from the file object) instead of `await image.read()` into a bytes copy, and
+UploadLimitMiddleware rejects oversized bodies while they are still streaming in.
+"""
+import hashlib
+import os
+from tempfile import SpooledTemporaryFile
+from typing import BinaryIO, Dict, Tuple
+
+from fastapi import UploadFile
+from fastapi.responses import JSONResponse
+from starlette.formparsers import MultiPartParser
+
+# Uploads larger than this are spooled to a temporary file on disk instead of memory
+UPLOAD_SPOOL_THRESHOLD = int(os.getenv("UPLOAD_SPOOL_THRESHOLD", str(1024 * 1024)))
+# Largest accepted request body for a single-image upload
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(25 * 1024 * 1024)))
+UPLOAD_CHUNK_SIZE = 256 * 1024
+
+
+def configure_upload_spooling(threshold: int = UPLOAD_SPOOL_THRESHOLD) -> None:
+    """Set the in-memory size above which multipart file parts roll over to disk"""
+    MultiPartParser.spool_max_size = threshold
+
+
+async def hash_upload(upload: UploadFile) -> Tuple[str, int]:
+    """SHA-256 hex digest and size of an upload, read chunk by chunk; rewinds the file afterwards"""
+    hasher = hashlib.sha256()
+    size = 0
+    await upload.seek(0)
+    while True:
+        chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        hasher.update(chunk)
+        size += len(chunk)
+    await upload.seek(0)
+    return hasher.hexdigest(), size
+
+
+def hash_file(fileobj: BinaryIO) -> Tuple[str, int]:
+    """Blocking variant of hash_upload for plain file objects"""
+    hasher = hashlib.sha256()
+    size = 0
+    fileobj.seek(0)
+    for chunk in iter(lambda: fileobj.read(UPLOAD_CHUNK_SIZE), b""):
+        hasher.update(chunk)
+        size += len(chunk)
+    fileobj.seek(0)
+    return hasher.hexdigest(), size
+
+
+def spool_stream(stream: BinaryIO, max_bytes: int = MAX_UPLOAD_BYTES) -> Tuple[SpooledTemporaryFile, str]:
+    """Copy a non-seekable stream (e.g. a zip member) into a spooled file while hashing it.
+    Raises ValueError once more than max_bytes have been read."""
+    spooled = SpooledTemporaryFile(max_size=UPLOAD_SPOOL_THRESHOLD)
+    hasher = hashlib.sha256()
+    size = 0
+    for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), b""):
+        size += len(chunk)
+        if size > max_bytes:
+            spooled.close()
+            raise ValueError(f"File exceeds the maximum size of {max_bytes} bytes.")
+        hasher.update(chunk)
+        spooled.write(chunk)
+    spooled.seek(0)
+    return spooled, hasher.hexdigest()
+
+
+class UploadLimitMiddleware:
+    """ASGI middleware that enforces a per-path request body limit while the body streams in.
+
+    Requests announcing a larger Content-Length are rejected up front; chunked or lying clients are
+    cut off with a 413 as soon as the running byte count crosses the limit, before the rest of the
+    body is buffered or spooled.
+    """
+
+    def __init__(self, app, limits: Dict[str, int]):
+        self.app = app
+        self.limits = limits
+
+    async def __call__(self, scope, receive, send):
+        limit = self.limits.get(scope.get("path")) if scope["type"] == "http" else None
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+
+        too_large = JSONResponse(status_code=413, content={"detail": f"Upload exceeds the maximum size of {limit} bytes."})
+        for name, value in scope.get("headers", []):
+            if name == b"content-length" and value.isdigit() and int(value) > limit:
+                await too_large(scope, receive, send)
+                return
+
+        received = 0
+        rejected = False
+
+        async def limited_receive():
+            nonlocal received, rejected
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit and not rejected:
+                    rejected = True
+                    await too_large(scope, receive, send)
+            if rejected:
+                # Make the application stop reading; its own response is discarded below
+                return {"type": "http.disconnect"}
+            return message
+
+        async def guarded_send(message):
+            if not rejected:
+                await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if not rejected:
+                raise
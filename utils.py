@@ -0,0 +1,56 @@
+"""
+Shared helpers for the Skypad backend
+"""
+import hashlib
+import os
+from io import BytesIO
+from typing import BinaryIO, Union
+
+# Root directory for local persistent state (caches, indexes, job queues)
+DATA_DIR = os.getenv("SKYPAD_DATA_DIR", "data")
+
+
+def data_path(*parts: str) -> str:
+    """Return a path under DATA_DIR (nothing is created: stores call ensure_parent_dir() when they open)"""
+    return os.path.join(DATA_DIR, *parts)
+
+
+def ensure_parent_dir(path: str) -> str:
+    """Create the directory a file will be written in, if needed, and return the path"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    return path
+
+
+def sha256_hex(data: bytes) -> str:
+    """Hex SHA-256 digest of a bytes payload"""
+    return hashlib.sha256(data).hexdigest()
+
+
+# An image payload: raw bytes, or a seekable binary file such as a spooled upload
+ImageSource = Union[bytes, BinaryIO]
+
+
+def open_source(source: ImageSource) -> BinaryIO:
+    """Return a readable file object positioned at the start of the payload"""
+    if isinstance(source, (bytes, bytearray)):
+        return BytesIO(source)
+    source.seek(0)
+    return source
+
+
+def source_size(source: ImageSource) -> int:
+    """Size in bytes of the payload without reading it into memory"""
+    if isinstance(source, (bytes, bytearray)):
+        return len(source)
+    source.seek(0, os.SEEK_END)
+    size = source.tell()
+    source.seek(0)
+    return size
+
+
+def read_source(source: ImageSource) -> bytes:
+    """Materialize the payload as bytes (only for APIs that require a single buffer)"""
+    if isinstance(source, (bytes, bytearray)):
+        return bytes(source)
+    source.seek(0)
+    return source.read()